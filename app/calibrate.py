@@ -0,0 +1,41 @@
+# picks the bcrypt cost factor (FASTAPI_BCRYPT_ROUNDS) for the machine it runs on
+# the cost should be as high as login latency allows: every extra round doubles the work
+# for an attacker, and for the server
+#
+# usage: python -m app.calibrate --target-ms 250
+import argparse
+import time
+
+from .utils import pwd_context
+
+
+def time_hash(rounds: int, samples: int = 3):
+    """Returns the best time, in milliseconds, to hash a password with 'rounds'"""
+    bcrypt = pwd_context.handler("bcrypt").using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        bcrypt.hash("calibration-password")
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def calibrate_rounds(target_ms: float):
+    """Returns the highest bcrypt cost whose hash time stays within target_ms"""
+    # 4 is the lowest cost bcrypt accepts
+    rounds = 4
+    while rounds < 31 and time_hash(rounds + 1) <= target_ms:
+        rounds += 1
+    return rounds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Picks the bcrypt cost factor")
+    parser.add_argument(
+        "--target-ms", type=float, default=250, help="time budget per hash (ms)"
+    )
+    args = parser.parse_args()
+
+    rounds = calibrate_rounds(args.target_ms)
+    print(f"{rounds} rounds ({time_hash(rounds):.0f} ms per hash on this machine)")
+    print(f"set FASTAPI_BCRYPT_ROUNDS={rounds}")
@@ -1,9 +1,22 @@
 # some necessary imports
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
 from .config import config_settings
 from .models import SQLModel
 
+logger = logging.getLogger("app.database")
+
 # to define the network connection credentials for the SQL ORM engine
 # engine - object that handles communication with the database
 
@@ -16,17 +29,230 @@ postgresql_port = config_settings.fastapi_postgresql_db_port
 
 # URL = 'postgresql://<username>:<password>@<ip-address/hostname>/<database_name>'
 SQLMODEL_DATABASE_URL = f"postgresql://{postgresql_username}:{postgresql_password}@{postgresql_hostname}:{postgresql_port}/{postgreql_db_name}"
+# same database, reached through the asyncio-native asyncpg driver
+SQLMODEL_ASYNC_DATABASE_URL = f"postgresql+asyncpg://{postgresql_username}:{postgresql_password}@{postgresql_hostname}:{postgresql_port}/{postgreql_db_name}"
+
+
+class PoolWaitTimer:
+    """Pool mixin that times how long each checkout took to get a connection
+    (waiting for one to be returned to the pool, or opening a new one)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # plain counters, a stray lost update under contention is fine for statistics
+        self.wait_count = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            self.wait_count += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+class TimedQueuePool(PoolWaitTimer, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(PoolWaitTimer, AsyncAdaptedQueuePool):
+    pass
+
+
+# pool settings shared by both engines, see config.py
+pool_settings = {
+    "echo": config_settings.fastapi_database_echo,
+    "pool_size": config_settings.fastapi_database_pool_size,
+    "max_overflow": config_settings.fastapi_database_max_overflow,
+    "pool_timeout": config_settings.fastapi_database_pool_timeout,
+    "pool_recycle": config_settings.fastapi_database_pool_recycle,
+    "pool_pre_ping": config_settings.fastapi_database_pool_pre_ping,
+}
+
+
+def create_engines(url: str, async_url: str):
+    """The blocking and the asyncpg engine of one database server, each with its own
+    pool (see pool_settings). Their statements are counted and timed per request"""
+    # connect_args = {"check_same_thread": False}
+    sync_engine = create_engine(url, poolclass=TimedQueuePool, **pool_settings)
+    asyncpg_engine = create_async_engine(
+        async_url,
+        poolclass=TimedAsyncAdaptedQueuePool,
+        connect_args={
+            "prepared_statement_cache_size": config_settings.fastapi_database_statement_cache_size
+        },
+        **pool_settings,
+    )
+    instrument_engine(sync_engine)
+    instrument_engine(asyncpg_engine.sync_engine)
+    return sync_engine, asyncpg_engine
+
+
+def pool_stats(pool):
+    """Returns a snapshot of a connection pool's usage"""
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        # negative while the pool has not even filled up to pool_size yet
+        "overflow": pool.overflow(),
+        "wait_count": pool.wait_count,
+        "wait_seconds_total": pool.wait_seconds_total,
+        "wait_seconds_max": pool.wait_seconds_max,
+    }
+
+
+class SQLTimings:
+    """SQL statements sent, and the time spent executing them, while serving one request"""
+
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# the current request's SQLTimings, set by ServerTimingMiddleware (see middleware.py)
+# None -> not being measured, the engine hooks below then return straight away
+# context variables follow the request into threadpool workers and asyncpg's greenlets
+sql_timings: ContextVar = ContextVar("sql_timings", default=None)
+
+
+def _start_statement_timer(conn, cursor, statement, parameters, context, many):
+    if sql_timings.get() is not None:
+        # the execution context lives exactly as long as this one statement
+        context._timer_start = time.perf_counter()
+
+
+def _stop_statement_timer(conn, cursor, statement, parameters, context, many):
+    timings = sql_timings.get()
+    if timings is not None:
+        timings.count += 1
+        timings.seconds += time.perf_counter() - context._timer_start
+
+
+def instrument_engine(sync_engine):
+    """Hooks an engine so the statements it executes are counted and timed per request.
+    Takes a blocking Engine, for an AsyncEngine pass its .sync_engine"""
+    event.listen(sync_engine, "before_cursor_execute", _start_statement_timer)
+    event.listen(sync_engine, "after_cursor_execute", _stop_statement_timer)
+
+
+# to create the engines of the primary, the database every write goes to (reads may be
+# served by replicas, see replicas.py)
+# the blocking engine is still used outside of requests (e.g. python -m app.reconcile)
+# and by the API itself when config_settings.fastapi_database_async is off
+engine, async_engine = create_engines(
+    SQLMODEL_DATABASE_URL, SQLMODEL_ASYNC_DATABASE_URL
+)
 
-# to create the engine
-# connect_args = {"check_same_thread": False}
-engine = create_engine(SQLMODEL_DATABASE_URL, echo=True)
 
 # not needed anymore, DB migrations handled by alembic
 # def create_db_and_tables():
 #     SQLModel.metadata.create_all(engine)
 
 
+class ThreadedSession:
+    """Wraps a blocking Session so it can be awaited like an AsyncSession.
+    Every database call is handed to the Starlette threadpool, exactly as FastAPI used
+    to do with the old sync 'def' endpoints, so the event loop itself never blocks"""
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    def add(self, instance):
+        # no database work, only stages the object
+        self.sync_session.add(instance)
+
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+
+    async def exec(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.exec, *args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, *args, **kwargs)
+
+    async def delete(self, instance):
+        return await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self):
+        return await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        return await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        return await run_in_threadpool(self.sync_session.rollback)
+
+    async def refresh(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.refresh, *args, **kwargs)
+
+    async def close(self):
+        return await run_in_threadpool(self.sync_session.close)
+
+    async def stream(self, statement, **kwargs):
+        # stream_results -> psycopg2 reads through a server-side (named) cursor
+        result = await run_in_threadpool(
+            self.sync_session.execute,
+            statement.execution_options(stream_results=True),
+            **kwargs,
+        )
+        return ThreadedResult(result)
+
+
+class ThreadedResult:
+    """Wraps a blocking streamed Result so it can be consumed like an AsyncResult"""
+
+    def __init__(self, result):
+        self.sync_result = result
+
+    async def partitions(self, size: int = None):
+        partitions = self.sync_result.partitions(size)
+        # each fetch from the server-side cursor is handed to the threadpool
+        while partition := await run_in_threadpool(next, partitions, None):
+            yield partition
+
+
+# a DB session on whichever stack config_settings.fastapi_database_async picks
+# NOTE: expire_on_commit=False, otherwise every attribute read after a commit
+# would have to go back to the database (which an AsyncSession cannot do implicitly)
+# 'engines' -> a (blocking, asyncpg) pair of create_engines, the primary's by default
+@asynccontextmanager
+async def open_session(engines: tuple = None):
+    sync_bind, async_bind = engines or (engine, async_engine)
+    if config_settings.fastapi_database_async:
+        async with AsyncSession(async_bind, expire_on_commit=False) as session:
+            yield session
+    else:
+        session = ThreadedSession(Session(sync_bind, expire_on_commit=False))
+        try:
+            yield session
+        finally:
+            await session.close()
+
+
 # getting DB sessions as a dependency, to eliminate 'with' and make life easier
-def start_session():
-    with Session(engine) as session:
+async def start_session():
+    async with open_session() as session:
         yield session
+
+
+async def run_periodically(job, interval: float, immediately: bool = False):
+    """Runs 'job' (an async function taking a session) every 'interval' seconds, each
+    time in a session of its own, until cancelled. 'immediately' -> a first run right
+    away instead of after one interval"""
+    if not immediately:
+        await asyncio.sleep(interval)
+    while True:
+        try:
+            async with open_session() as session:
+                await job(session)
+        except Exception:
+            # whatever the job left behind stays up, try again on the next round
+            logger.exception("Periodic job %s failed", job.__name__)
+        await asyncio.sleep(interval)
@@ -3,12 +3,19 @@
 # import psycopg2 <- database driver, used when not using an ORM
 # from psycopg2.extras import RealDictCursor -> to extract the column names
 
+import asyncio
+
 from fastapi.middleware.cors import CORSMiddleware
 
 from fastapi import FastAPI
 
+from . import replicas, revocation, timeline, trending
+from .config import config_settings
+from .database import run_periodically
+from .middleware import MetricsMiddleware, ServerTimingMiddleware
+
 # to import our app routes
-from .routers import auth, posts, users, vote
+from .routers import auth, feed, follow, internal, metrics, posts, users, vote
 
 # below imports not required because of alembic
 # from .database import SQLModel, create_db_and_tables
@@ -32,6 +39,55 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# per-request SQL statistics -> Server-Timing header (when fastapi_sql_timing is on)
+app.add_middleware(ServerTimingMiddleware)
+# request counts, latencies and in-flight requests -> served at /metrics
+app.add_middleware(MetricsMiddleware)
+
+# maintenance jobs run in the background of every API process, each one every
+# 'interval' seconds (0 -> off)
+@app.on_event("startup")
+async def start_periodic_jobs():
+    app.state.periodic_jobs = [
+        asyncio.create_task(run_periodically(job, interval, immediately))
+        for job, interval, immediately in (
+            # see trending.py
+            (
+                trending.refresh_trending_scores,
+                config_settings.fastapi_trending_refresh_interval,
+                False,
+            ),
+            # see timeline.py
+            (
+                timeline.trim_timelines,
+                config_settings.fastapi_feed_trim_interval,
+                False,
+            ),
+            # see replicas.py. checked at once, no reads go to a replica before
+            (
+                replicas.check_replicas,
+                config_settings.fastapi_database_replica_check_interval
+                if replicas.replicas.replicas
+                else 0,
+                True,
+            ),
+            # see revocation.py. loaded at once, a process that just started must
+            # not accept tokens revoked before
+            (
+                revocation.sync_revoked_tokens,
+                config_settings.fastapi_jwt_revocation_sync_interval,
+                True,
+            ),
+        )
+        if interval > 0
+    ]
+
+
+@app.on_event("shutdown")
+async def stop_periodic_jobs():
+    for job in getattr(app.state, "periodic_jobs", []):
+        job.cancel()
+
 
 # to create our database tables (does not need a session)
 # commented out because DB will be created with alemmbic
@@ -47,6 +103,10 @@ app.include_router(posts.router)
 app.include_router(users.router)
 app.include_router(auth.router)
 app.include_router(vote.router)
+app.include_router(follow.router)
+app.include_router(feed.router)
+app.include_router(internal.router)
+app.include_router(metrics.router)
 
 # path operation/route/endpoint
 @app.get("/")
@@ -0,0 +1,316 @@
+# request metrics and operational gauges, exposed in the Prometheus text format at /metrics
+import threading
+from bisect import bisect_left
+
+from . import oauth2, utils
+from .database import async_engine, engine, pool_stats
+from .ratelimit import rate_limiter
+from .replicas import replicas
+from .response_cache import posts_cache
+from .revocation import revoked_tokens
+
+# upper bounds (seconds) of the request latency histogram buckets, +Inf is implied
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Shard:
+    """One thread's share of the request metrics, only ever written by that thread"""
+
+    __slots__ = ("in_flight", "requests", "latencies")
+
+    def __init__(self):
+        self.in_flight = 0
+        # (method, route, status) -> number of requests
+        self.requests = {}
+        # (method, route) -> [count, sum, hits per bucket..., hits above the last bucket]
+        self.latencies = {}
+
+
+class RequestMetrics:
+    """Request counters, in-flight gauge and latency histograms.
+    Each thread records into its own shard without any locking, the shards are only
+    added up when /metrics is scraped -> recording never contends with other threads"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = []
+        # only taken when a thread records its very first request, and by scrapes
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def started(self):
+        self._shard().in_flight += 1
+
+    def finished(self, method: str, route: str, status: int, seconds: float):
+        shard = self._shard()
+        shard.in_flight -= 1
+
+        key = (method, route, status)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+
+        latency = shard.latencies.get((method, route))
+        if latency is None:
+            latency = shard.latencies[(method, route)] = [0, 0.0] + [0] * (
+                len(self.buckets) + 1
+            )
+        latency[0] += 1
+        latency[1] += seconds
+        # first bucket whose upper bound is >= seconds
+        latency[2 + bisect_left(self.buckets, seconds)] += 1
+
+    def collect(self):
+        """Adds up all the shards -> (in flight, requests, latencies)"""
+        in_flight = 0
+        requests = {}
+        latencies = {}
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            in_flight += shard.in_flight
+            # copying a dict happens in one go under the GIL, so a thread adding a new
+            # series meanwhile cannot break the iteration. a count read mid-update is at
+            # worst one request behind, which the next scrape catches up on
+            for key, count in list(shard.requests.items()):
+                requests[key] = requests.get(key, 0) + count
+            for key, latency in list(shard.latencies.items()):
+                total = latencies.setdefault(key, [0] * len(latency))
+                for index, value in enumerate(latency):
+                    total[index] += value
+        return in_flight, requests, latencies
+
+
+request_metrics = RequestMetrics()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sample(name, labels, value):
+    if labels:
+        label_pairs = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        return f"{name}{{{label_pairs}}} {value}"
+    return f"{name} {value}"
+
+
+def _family(lines, name, kind, description, samples):
+    """Appends one metric family, 'samples' being (labels, value) pairs"""
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {kind}")
+    lines.extend(_sample(name, labels, value) for labels, value in samples)
+
+
+def render_metrics():
+    """Returns every metric in the Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+
+    in_flight, requests, latencies = request_metrics.collect()
+    _family(
+        lines,
+        "http_requests_total",
+        "counter",
+        "Requests served, by route template and status code.",
+        [
+            ({"method": method, "route": route, "status": status}, count)
+            for (method, route, status), count in sorted(requests.items())
+        ],
+    )
+    _family(
+        lines,
+        "http_requests_in_flight",
+        "gauge",
+        "Requests currently being served.",
+        [({}, in_flight)],
+    )
+
+    lines.append(
+        "# HELP http_request_duration_seconds Time taken to serve requests, by route template."
+    )
+    lines.append("# TYPE http_request_duration_seconds histogram")
+    for (method, route), latency in sorted(latencies.items()):
+        labels = {"method": method, "route": route}
+        # Prometheus buckets are cumulative, hits are recorded per bucket
+        cumulative = 0
+        for bound, hits in zip([*request_metrics.buckets, "+Inf"], latency[2:]):
+            cumulative += hits
+            lines.append(
+                _sample(
+                    "http_request_duration_seconds_bucket",
+                    {**labels, "le": bound},
+                    cumulative,
+                )
+            )
+        lines.append(_sample("http_request_duration_seconds_sum", labels, latency[1]))
+        lines.append(_sample("http_request_duration_seconds_count", labels, latency[0]))
+
+    pools = {"async": pool_stats(async_engine.pool), "sync": pool_stats(engine.pool)}
+    for stat, kind, description in (
+        ("size", "gauge", "Connections the pool keeps open."),
+        ("checked_in", "gauge", "Idle connections in the pool."),
+        ("checked_out", "gauge", "Connections in use."),
+        ("overflow", "gauge", "Connections open beyond the pool size."),
+        ("wait_count", "counter", "Connection checkouts."),
+        ("wait_seconds_total", "counter", "Time spent waiting for connections."),
+        ("wait_seconds_max", "gauge", "Longest wait for a connection."),
+    ):
+        _family(
+            lines,
+            f"db_pool_{stat}",
+            kind,
+            description,
+            [({"engine": name}, stats[stat]) for name, stats in pools.items()],
+        )
+
+    cache = oauth2.user_cache.stats()
+    _family(
+        lines,
+        "auth_user_cache_hits_total",
+        "counter",
+        "Authenticated user lookups served from the cache.",
+        [({}, cache["hits"])],
+    )
+    _family(
+        lines,
+        "auth_user_cache_misses_total",
+        "counter",
+        "Authenticated user lookups that went to the database.",
+        [({}, cache["misses"])],
+    )
+    _family(
+        lines,
+        "auth_user_cache_size",
+        "gauge",
+        "Users held in the cache.",
+        [({}, cache["size"])],
+    )
+
+    tokens = oauth2.token_cache.stats()
+    _family(
+        lines,
+        "auth_token_cache_hits_total",
+        "counter",
+        "Access tokens whose signature was already verified.",
+        [({}, tokens["hits"])],
+    )
+    _family(
+        lines,
+        "auth_token_cache_misses_total",
+        "counter",
+        "Access tokens verified with a full signature check.",
+        [({}, tokens["misses"])],
+    )
+
+    _family(
+        lines,
+        "auth_revoked_tokens",
+        "gauge",
+        "Revoked access tokens, not yet expired, known to this process.",
+        [({}, len(revoked_tokens))],
+    )
+
+    pages = posts_cache.stats()
+    _family(
+        lines,
+        "posts_cache_hits_total",
+        "counter",
+        "GET /posts/ pages served from the response cache.",
+        [({}, pages["hits"])],
+    )
+    _family(
+        lines,
+        "posts_cache_misses_total",
+        "counter",
+        "GET /posts/ pages queried from the database.",
+        [({}, pages["misses"])],
+    )
+    _family(
+        lines,
+        "posts_cache_errors_total",
+        "counter",
+        "Response cache backend failures.",
+        [({}, pages["errors"])],
+    )
+    # left out when the cache is off, or its Redis server did not answer
+    if "bytes" in pages:
+        _family(
+            lines,
+            "posts_cache_bytes",
+            "gauge",
+            "Bytes held by the response cache (of this process, or its Redis server).",
+            [({}, pages["bytes"])],
+        )
+
+    replica_stats = replicas.stats()
+    _family(
+        lines,
+        "database_replica_healthy",
+        "gauge",
+        "Whether the read replica is serving reads (1) or left out (0).",
+        [
+            ({"replica": replica["name"]}, int(replica["healthy"]))
+            for replica in replica_stats
+        ],
+    )
+    _family(
+        lines,
+        "database_replica_lag_seconds",
+        "gauge",
+        "Replication lag of the read replica at its last health check.",
+        [
+            ({"replica": replica["name"]}, replica["lag_seconds"])
+            for replica in replica_stats
+            if replica["lag_seconds"] is not None
+        ],
+    )
+
+    limits = rate_limiter.stats()
+    _family(
+        lines,
+        "rate_limit_rejected_total",
+        "counter",
+        "Requests turned away with a 429, per rate limited route.",
+        [
+            ({"route": route}, rejected)
+            for route, rejected in sorted(limits["rejected"].items())
+        ],
+    )
+    _family(
+        lines,
+        "rate_limit_errors_total",
+        "counter",
+        "Rate limit backend failures, the requests were let through.",
+        [({}, limits["errors"])],
+    )
+
+    hasher = utils.password_hasher.stats()
+    _family(
+        lines,
+        "password_hasher_workers",
+        "gauge",
+        "Threads dedicated to bcrypt.",
+        [({}, hasher["workers"])],
+    )
+    _family(
+        lines,
+        "password_hasher_pending",
+        "gauge",
+        "Hashing jobs running or queued.",
+        [({}, hasher["pending"])],
+    )
+    _family(
+        lines,
+        "password_hasher_rejected_total",
+        "counter",
+        "Hashing jobs turned away with a 503.",
+        [({}, hasher["rejected"])],
+    )
+
+    return "\n".join(lines) + "\n"
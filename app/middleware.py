@@ -0,0 +1,93 @@
+# ASGI middleware wrapped around the whole API, see main.py
+import logging
+import time
+
+from starlette.datastructures import MutableHeaders
+
+from .config import config_settings
+from .database import SQLTimings, sql_timings
+from .metrics import request_metrics
+
+logger = logging.getLogger("app.timing")
+
+
+class ServerTimingMiddleware:
+    """Measures the SQL each request runs (see instrument_engine in database.py) and
+    reports it in a Server-Timing header, e.g. 'db;dur=4.21, db-count;desc=3',
+    and in one log line per request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # checked per request, so the setting can be flipped without rebuilding the app
+        if scope["type"] != "http" or not config_settings.fastapi_sql_timing:
+            return await self.app(scope, receive, send)
+
+        timings = SQLTimings()
+        token = sql_timings.set(timings)
+        start = time.perf_counter()
+        status_code = None
+
+        async def send_with_timings(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # headers go out before a streamed body, whose queries are then only
+                # in the log line below
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Server-Timing",
+                    f"db;dur={timings.seconds * 1000:.2f}, db-count;desc={timings.count}",
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            sql_timings.reset(token)
+            # key=value pairs -> easy to grep and to parse by log shippers
+            logger.info(
+                "method=%s path=%s status=%s duration_ms=%.2f db_ms=%.2f db_count=%d",
+                scope["method"],
+                scope["path"],
+                status_code,
+                (time.perf_counter() - start) * 1000,
+                timings.seconds * 1000,
+                timings.count,
+            )
+
+
+class MetricsMiddleware:
+    """Records every request in the Prometheus metrics served at /metrics"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        # an unhandled exception becomes a 500 further out, in ServerErrorMiddleware
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        request_metrics.started()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router leaves the matched route in the scope -> label by its template
+            # (/posts/{post_id}) rather than the raw path, which would be one series per id
+            route = scope.get("route")
+            request_metrics.finished(
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                status_code,
+                time.perf_counter() - start,
+            )
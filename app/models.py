@@ -2,18 +2,23 @@
 # THESE DEFINE STRICT SCHEMAS i.e. how the data is defined/modeled during communication between client, API and DB
 
 from datetime import datetime
+from enum import Enum
 from typing import List, Optional
 
 from pydantic import EmailStr
+from sqlalchemy import Computed, Index
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlmodel import (
     Boolean,
     Column,
     DateTime,
     Field,
+    Float,
     ForeignKey,
     Integer,
     Relationship,
     SQLModel,
+    String,
     text,
 )
 
@@ -32,6 +37,13 @@ from sqlmodel import (
 # SOLUTION: use multiple models and inheritance to have a base class with the common
 # columns/attributes for the subclasses to inherit
 
+# characters of a post's content kept in its excerpt
+EXCERPT_LENGTH = 200
+
+# what a post listing can be narrowed down to with ?fields=, in response order
+POST_FIELDS = ("title", "content", "excerpt", "published", "id", "rating", "owner")
+
+
 # each schema has title, content and published
 class PostBase(SQLModel):
     title: str = Field(index=True)
@@ -55,6 +67,21 @@ class PostUpdate(SQLModel):
     rating: Optional[int] = None
 
 
+# how the 'search' query parameter of GET /posts is matched against posts
+class SearchMode(str, Enum):
+    # relevance-ranked full-text search over title and content (GIN index on search_vector)
+    fulltext = "fulltext"
+    # plain substring match on the title (trigram GIN index on title)
+    substring = "substring"
+
+
+# file formats GET /posts/export can stream
+class ExportFormat(str, Enum):
+    # newline-delimited JSON, one post per line
+    ndjson = "ndjson"
+    csv = "csv"
+
+
 class UserBase(SQLModel):
     email: EmailStr = Field(nullable=False, unique=True, index=True)
     name: str
@@ -77,11 +104,19 @@ class UserLogin(SQLModel):
 class Token(SQLModel):
     access_token: str
     token_type: str
+    # exchanged at /token/refresh for a new pair once the access token expires
+    refresh_token: Optional[str] = None
+
+
+class TokenRefresh(SQLModel):
+    refresh_token: str
 
 
 class TokenPayload(SQLModel):
     id: Optional[str] = None
     name: Optional[str] = None
+    # unique id of the token, what revoking it goes by
+    jti: Optional[str] = None
 
 
 class VoteReadUsers(SQLModel):
@@ -102,6 +137,11 @@ class PostOut(SQLModel):
     likes: int
 
 
+class TrendingPostOut(PostOut):
+    # likes, each one decayed by its age, see app/trending.py
+    score: float
+
+
 class VoteReadPosts(SQLModel):
     likeable_post: PostReadAll
 
@@ -118,11 +158,23 @@ class UserReadWithPosts(UserRead):
     # liked_posts: List[VoteReadPosts] = []
 
 
+class UserFollow(SQLModel):
+    user_id: int
+
+
 class UserVote(SQLModel):
     post_id: int
     vote_dir: int = Field(ge=0, le=1)
 
 
+# the result of one vote out of a batch, same status codes and messages as POST /votes/
+class VoteOutcome(SQLModel):
+    post_id: int
+    vote_dir: int
+    status_code: int
+    detail: str
+
+
 ############### ACTUAL DATABASE TABLES ################
 
 
@@ -138,6 +190,19 @@ class User(UserBase, table=True):
         )
     )
 
+    # denormalised follower counter, kept in step with the follows table by the follow
+    # router. indexed -> the few accounts too big to fan out to are found with a range
+    # scan (see app/timeline.py)
+    followers: Optional[int] = Field(
+        sa_column=Column(Integer, nullable=False, server_default="0", index=True)
+    )
+    # set when the account shrinks back to fanning out: its posts below this id, from
+    # while it had too many followers, were never copied into timelines -> feeds keep
+    # pulling those in at read time (see app/timeline.py). NULL -> all were copied
+    fanned_out_from: Optional[int] = Field(
+        sa_column=Column(Integer, nullable=True, index=True)
+    )
+
     posts: List["Post"] = Relationship(back_populates="owner")
     liked_posts: List["Vote"] = Relationship(back_populates="user")
 
@@ -145,9 +210,22 @@ class User(UserBase, table=True):
 # NOTE: the parameter 'table=True' tells SQLModel that this is a DATABASE TABLE and should be created/loaded onto the DB
 class Post(PostBase, table=True):
     __tablename__ = "posts"
+    # GIN index over the full-text search column, used by the 'search' query parameter
+    # NOTE: the trigram index used for substring searches (ix_posts_title_trgm) needs the
+    # pg_trgm extension, so it only lives in the alembic migration
+    __table_args__ = (
+        Index("ix_posts_search_vector", "search_vector", postgresql_using="gin"),
+        # an owner's posts, newest first -> feeds pulling posts at read time
+        Index("ix_posts_owner_id_id", "owner_id", "id"),
+    )
     id: Optional[int] = Field(primary_key=True, nullable=False)
     # headache needed to set server-side default values
     rating: Optional[int] = Field(sa_column=Column(Integer, server_default="0"))
+    # denormalised like counter, kept in step with the votes table by the vote router
+    # so reads never have to count votes. any drift is repaired by app/reconcile.py
+    likes: Optional[int] = Field(
+        sa_column=Column(Integer, nullable=False, server_default="0")
+    )
     updated_at: Optional[datetime] = Field(
         sa_column=Column(
             DateTime(timezone=True),
@@ -156,6 +234,34 @@ class Post(PostBase, table=True):
         )
     )
 
+    # full-text search document, generated by Postgres itself from the title and content
+    # so it can never go stale. title matches are weighted higher ('A') than content ('B')
+    search_vector: Optional[str] = Field(
+        sa_column=Column(
+            TSVECTOR,
+            Computed(
+                "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                "setweight(to_tsvector('english', coalesce(content, '')), 'B')",
+                persisted=True,
+            ),
+        )
+    )
+
+    # start of the content, what list views show (?fields=...,excerpt), generated by
+    # Postgres like search_vector -> filled in by every insert and update of the
+    # content, seeds and bulk loads included
+    excerpt: Optional[str] = Field(
+        sa_column=Column(
+            String,
+            Computed(
+                f"CASE WHEN char_length(content) > {EXCERPT_LENGTH} "
+                f"THEN rtrim(left(content, {EXCERPT_LENGTH})) || '...' "
+                "ELSE content END",
+                persisted=True,
+            ),
+        )
+    )
+
     # to create a relationship with the users table, declare user id as the foreign key
     # onupdate & ondelete - if any changes to users, they will reflect on posts
     # e.g. if a user is deleted, all their posts are deleted as well
@@ -192,5 +298,124 @@ class Vote(SQLModel, table=True):
         ),
     )
 
+    # when the like was cast, recent likes count the most towards trending posts
+    # indexed -> refreshing the trending scores only reads the latest votes
+    created_at: Optional[datetime] = Field(
+        sa_column=Column(
+            DateTime(timezone=True),
+            nullable=False,
+            server_default=text("now()"),
+            index=True,
+        )
+    )
+
     user: User = Relationship(back_populates="liked_posts")
     likeable_post: Post = Relationship(back_populates="liked_by")
+
+
+# precomputed trending score of each recently liked post, see app/trending.py
+class PostScore(SQLModel, table=True):
+    __tablename__ = "post_scores"
+    # the trending feed is the top of this index, read backwards (highest score first)
+    __table_args__ = (Index("ix_post_scores_score", "score", "post_id"),)
+    post_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey(column="posts.id", ondelete="cascade", onupdate="cascade"),
+            nullable=False,
+            primary_key=True,
+        ),
+    )
+    score: float = Field(sa_column=Column(Float, nullable=False))
+
+
+class Follow(SQLModel, table=True):
+    __tablename__ = "follows"
+    follower_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey(column="users.id", ondelete="cascade", onupdate="cascade"),
+            nullable=False,
+            primary_key=True,
+        ),
+    )
+    # indexed -> the followers of a new post's owner are found for the fan-out
+    followee_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey(column="users.id", ondelete="cascade", onupdate="cascade"),
+            nullable=False,
+            primary_key=True,
+            index=True,
+        ),
+    )
+    created_at: Optional[datetime] = Field(
+        sa_column=Column(
+            DateTime(timezone=True),
+            nullable=False,
+            server_default=text("now()"),
+        )
+    )
+
+
+# materialised home timelines: one row per post in a user's feed, see app/timeline.py
+class TimelineEntry(SQLModel, table=True):
+    __tablename__ = "timeline_entries"
+    # the primary key doubles as the feed index: one user's entries, by post id
+    user_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey(column="users.id", ondelete="cascade", onupdate="cascade"),
+            nullable=False,
+            primary_key=True,
+        ),
+    )
+    # indexed -> deleting a post does not scan every timeline for it
+    post_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey(column="posts.id", ondelete="cascade", onupdate="cascade"),
+            nullable=False,
+            primary_key=True,
+            index=True,
+        ),
+    )
+
+
+# refresh tokens, see app/oauth2.py. each one can be exchanged once: the exchange
+# hands out its successor, in the same family
+class RefreshToken(SQLModel, table=True):
+    __tablename__ = "refresh_tokens"
+    id: Optional[int] = Field(primary_key=True, nullable=False)
+    # SHA-256 (hex) of the token, the token itself is never stored
+    token_hash: str = Field(sa_column=Column(String, nullable=False, unique=True))
+    user_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey(column="users.id", ondelete="cascade", onupdate="cascade"),
+            nullable=False,
+            index=True,
+        ),
+    )
+    # shared by every token rotated out of the same login
+    family_id: str = Field(sa_column=Column(String, nullable=False, index=True))
+    # jti of the access token issued together with this one
+    access_jti: str = Field(sa_column=Column(String, nullable=False, index=True))
+    # set by the exchange. a used token coming back means it was stolen
+    used: Optional[bool] = Field(
+        sa_column=Column(Boolean, nullable=False, server_default="FALSE")
+    )
+    expires_at: datetime = Field(
+        sa_column=Column(DateTime(timezone=True), nullable=False)
+    )
+
+
+# revoked access tokens, mirrored in memory by every API process (see app/revocation.py)
+class RevokedToken(SQLModel, table=True):
+    __tablename__ = "revoked_tokens"
+    jti: str = Field(sa_column=Column(String, primary_key=True, nullable=False))
+    # the token is refused on its own from then on, so the row can go.
+    # indexed -> expired rows are pruned without a full scan
+    expires_at: datetime = Field(
+        sa_column=Column(DateTime(timezone=True), nullable=False, index=True)
+    )
@@ -1,16 +1,28 @@
 # handles authentication - JWT tokens
 
+import hashlib
+import secrets
+import time
+import uuid
+from contextvars import ContextVar
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
+import jwt as pyjwt
+from cryptography.hazmat.primitives import serialization
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from sqlmodel import Session
+from jose import JWTError, jwk, jwt
+from sqlalchemy import delete, event, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 
 from . import models
+from .cache import TTLCache
 from .config import config_settings
 from .database import start_session
+from .revocation import revoked_tokens
 
 ### USING ENV VARIABLES INSTEAD OF HARD CODING VALUES FOR SAFETY REASONS ###
 # obtain secret key
@@ -19,16 +31,140 @@ SECRET_KEY = config_settings.fastapi_jwt_secret_key
 ALGORITHM = config_settings.fastapi_jwt_algorithm
 # token expiration time
 ACCESS_TOKEN_EXPIRE_MINUTES = config_settings.fastapi_jwt_access_token_expire_minutes
+# refresh token expiration time
+REFRESH_TOKEN_EXPIRE_DAYS = config_settings.fastapi_jwt_refresh_token_expire_days
+
+# JWT library the tokens are signed and verified with (see TokenCodec)
+JWT_BACKEND = config_settings.fastapi_jwt_backend
 
 # this makes FastAPI know that it is a security scheme, so it is added that way to OpenAPI
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# the same user is looked up on every single authenticated request
+# user id -> the user's column values
+user_cache = TTLCache(
+    maxsize=config_settings.fastapi_auth_user_cache_size,
+    ttl=config_settings.fastapi_auth_user_cache_ttl,
+)
+
+
+# clients send the same token with every request for its whole lifetime, so its
+# signature only has to be checked once
+# SHA-256 of the token -> its verified claims, dropped when the token expires
+token_cache = TTLCache(
+    maxsize=config_settings.fastapi_jwt_verified_cache_size,
+    ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+)
+
+
+# id of the user the current request is authenticated as, set by get_current_user.
+# context variables follow the request into threadpool workers and asyncpg's greenlets
+# -> seen by the session hooks of replicas.py when the request commits
+current_user_id: ContextVar = ContextVar("current_user_id", default=None)
+
+
+class InvalidToken(Exception):
+    """Raised by verify_access_token for bearer_user_id, instead of a 401"""
+
+
+def load_key(value: str):
+    """Returns a PEM key given either inline or as the path of a PEM file"""
+    if not value or value.lstrip().startswith("-----BEGIN"):
+        return value
+    return Path(value).read_text()
+
+
+class TokenCodec:
+    """Signs and verifies JWTs with python-jose or PyJWT (faster, and the only one of
+    the two supporting EdDSA).
+    HS* algorithms sign and verify with the shared secret key, the others (ES256,
+    EdDSA, RS256, ...) with a private/public key pair.
+    Keys are parsed once here: given a string, both libraries would parse it all over
+    again on every call"""
+
+    def __init__(
+        self,
+        backend: str,
+        algorithm: str,
+        secret_key: str = "",
+        private_key: str = "",
+        public_key: str = "",
+    ):
+        if backend not in ("jose", "pyjwt"):
+            raise ValueError(f"Unknown JWT backend: {backend}")
+        if backend == "jose" and algorithm == "EdDSA":
+            raise ValueError("EdDSA tokens need the pyjwt backend")
+        self.backend = backend
+        self.algorithm = algorithm
+
+        if algorithm.startswith("HS"):
+            signing_key = verification_key = secret_key
+        else:
+            signing_key, verification_key = load_key(private_key), load_key(public_key)
+            if not verification_key:
+                raise ValueError(f"{algorithm} tokens need a public key")
+
+        if backend == "jose":
+            self.signing_key = signing_key and jwk.construct(signing_key, algorithm)
+            self.verification_key = jwk.construct(verification_key, algorithm)
+        elif algorithm.startswith("HS"):
+            self.signing_key = self.verification_key = secret_key
+        else:
+            self.signing_key = signing_key and serialization.load_pem_private_key(
+                signing_key.encode(), password=None
+            )
+            self.verification_key = serialization.load_pem_public_key(
+                verification_key.encode()
+            )
+
+    def encode(self, claims: dict):
+        if not self.signing_key:
+            raise ValueError(f"{self.algorithm} tokens need a private key to be signed")
+        if self.backend == "pyjwt":
+            return pyjwt.encode(claims, self.signing_key, algorithm=self.algorithm)
+        return jwt.encode(claims, self.signing_key, self.algorithm)
 
-def create_access_token(data: dict):
+    def decode(self, token: str):
+        """Checks the token's signature and expiry, returns its claims.
+        Raises JWTError, whichever the backend"""
+        if self.backend == "pyjwt":
+            try:
+                return pyjwt.decode(
+                    token, self.verification_key, algorithms=[self.algorithm]
+                )
+            except pyjwt.PyJWTError as error:
+                raise JWTError(str(error)) from error
+        return jwt.decode(token, self.verification_key, self.algorithm)
+
+
+token_codec = TokenCodec(
+    JWT_BACKEND,
+    ALGORITHM,
+    secret_key=SECRET_KEY,
+    private_key=config_settings.fastapi_jwt_private_key,
+    public_key=config_settings.fastapi_jwt_public_key,
+)
+
+
+def forget_user(user_id: int):
+    """Invalidation hook, drops a user from the authenticated user cache"""
+    user_cache.invalidate(user_id)
+
+
+# any change to a user made through the ORM invalidates its cached copy
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def forget_changed_user(mapper, connection, changed_user):
+    forget_user(changed_user.id)
+
+
+def create_access_token(data: dict, jti: str = None):
     # sourcery skip: inline-immediately-returned-variable
     """Generates a JWT token for a logged-in user"""
     # initialising the payload to populate the JWT token
     jwt_payload = data.copy()
+    # unique id, the token can be revoked by it
+    jwt_payload["jti"] = jti or uuid.uuid4().hex
 
     # setting the token's lifetime (30 minutes)
     jwt_lifetime = datetime.now(timezone.utc) + timedelta(
@@ -42,43 +178,178 @@ def create_access_token(data: dict):
     # 1. payload
     # 2. secret key
     # 3. algorithm
-    jwt_token = jwt.encode(jwt_payload, SECRET_KEY, ALGORITHM)
+    jwt_token = token_codec.encode(jwt_payload)
 
     return jwt_token
 
 
 def verify_access_token(token: str, credentials_exception):
     """Validates a provided JWT token"""
+    # warm path: a token already verified, and not expired since
+    token_hash = hashlib.sha256(token.encode()).digest()
+    if token_data := token_cache.get(token_hash):
+        # revoked tokens may still be cached, the check is a few bit probes on the
+        # cached jti (see revocation.py)
+        if token_data.jti in revoked_tokens:
+            raise credentials_exception
+        return token_data
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, ALGORITHM)
+        payload = token_codec.decode(token)
 
         _id = payload.get("user_id")
         name = payload.get("username")
+        jti = payload.get("jti")
 
-        if not _id:
+        # tokens issued before revocation existed carry no jti: they could never be
+        # revoked, nor logged out of
+        if not _id or not jti:
             raise credentials_exception
 
-        token_data = models.TokenPayload(id=_id, name=name)
+        token_data = models.TokenPayload(id=_id, name=name, jti=jti)
     except JWTError as error:
         raise credentials_exception from error
+    if token_data.jti in revoked_tokens:
+        raise credentials_exception
+
+    # only ever trusted until the token expires (a token without 'exp' never expires,
+    # it is then kept for the cache-wide time to live)
+    lifetime = payload["exp"] - time.time() if "exp" in payload else None
+    if lifetime is None or lifetime > 0:
+        token_cache.set(token_hash, token_data, ttl=lifetime)
 
     return token_data
 
 
-# passed as a dependency in any endpoint to extract user's id
-# "get" - actually fetches the current user from the database
-def get_current_user(
-    token: str = Depends(oauth2_scheme), session: Session = Depends(start_session)
-):
+def bearer_user_id(authorization: str):
+    """User id in the bearer token of an Authorization header, None without a valid
+    token. Verified like get_current_user would, from the verified token cache most of
+    the time"""
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return int(verify_access_token(token, InvalidToken()).id)
+    except (InvalidToken, ValueError):
+        return None
+
+
+def verify_internal_token(authorization: str = Header(default=None)):
+    """Guards the operational endpoints, as a router dependency: 404 while no
+    FASTAPI_INTERNAL_TOKEN is set, 401 without it as the bearer token"""
+    internal_token = config_settings.fastapi_internal_token
+    if not internal_token:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    # constant time comparison, the time taken tells nothing about the token
+    if scheme.lower() != "bearer" or not secrets.compare_digest(
+        token.encode(), internal_token.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+def hash_refresh_token(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_refresh_token(session, user_id: int, access_jti: str, family_id: str = None):
+    """Generates a refresh token, issued together with the access token 'access_jti',
+    and stores its hash. A new login starts a new family, a refresh continues the
+    family of the token it used up. Part of the caller's transaction"""
+    # opaque, not a JWT: it is only ever checked against its row
+    refresh_token = secrets.token_urlsafe(32)
+    session.add(
+        models.RefreshToken(
+            token_hash=hash_refresh_token(refresh_token),
+            user_id=user_id,
+            family_id=family_id or uuid.uuid4().hex,
+            access_jti=access_jti,
+            expires_at=datetime.now(timezone.utc)
+            + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        )
+    )
+    return refresh_token
+
+
+async def revoke_access_tokens(session, access_jtis):
+    """Revokes access tokens in the table. Part of the caller's transaction: once it is
+    committed, revoked_tokens.add() them so this process refuses them straight away
+    (the others do on their next reload). Returns the jtis"""
+    if not access_jtis:
+        return access_jtis
+    # a token is refused on its own once it expires, its revocation can go then
+    expires_at = func.now() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    await session.execute(
+        insert(models.RevokedToken)
+        .values([{"jti": jti, "expires_at": expires_at} for jti in access_jtis])
+        .on_conflict_do_nothing()
+    )
+    return access_jtis
+
+
+async def revoke_token_family(session, family_id: str):
+    """Logs a login session out everywhere: deletes all of its refresh tokens and
+    revokes the access tokens issued with them. Part of the caller's transaction, see
+    revoke_access_tokens(). Returns the revoked jtis"""
+    access_jtis = (
+        (
+            await session.execute(
+                delete(models.RefreshToken)
+                .where(models.RefreshToken.family_id == family_id)
+                .returning(models.RefreshToken.access_jti)
+                .execution_options(synchronize_session=False)
+            )
+        )
+        .scalars()
+        .all()
+    )
+    return await revoke_access_tokens(session, access_jtis)
+
+
+async def find_token_family(session, access_jti: str):
+    """Returns the family of the refresh token issued with an access token, if any"""
+    return (
+        await session.execute(
+            select(models.RefreshToken.family_id).where(
+                models.RefreshToken.access_jti == access_jti
+            )
+        )
+    ).scalar()
+
+
+# the claims of the request's access token, verified once per request: FastAPI hands
+# the same result to every dependency and endpoint asking for it
+async def get_current_token(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    user_token = verify_access_token(token, credentials_exception)
+    return verify_access_token(token, credentials_exception)
+
+
+# passed as a dependency in any endpoint to extract user's id
+# "get" - actually fetches the current user from the database
+async def get_current_user(
+    user_token: models.TokenPayload = Depends(get_current_token),
+    session: AsyncSession = Depends(start_session),
+):
+    user_id = int(user_token.id)
+    current_user_id.set(user_id)
+
+    # warm path, no database round trip at all
+    # NOTE: a fresh, session-less User is built for every request, the cached values
+    # themselves are never handed out (and so can never end up attached to a session)
+    if cached_user := user_cache.get(user_id):
+        return models.User(**cached_user)
 
-    if logged_in_user := session.get(models.User, int(user_token.id)):
+    if logged_in_user := await session.get(models.User, user_id):
+        user_cache.set(user_id, logged_in_user.dict())
         return logged_in_user
     else:
         raise HTTPException(
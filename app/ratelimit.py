@@ -0,0 +1,258 @@
+# rate limits, checked before a request costs anything: every /login attempt runs a
+# bcrypt verify (~250 ms of CPU, see calibrate.py) whoever sends it, a few clients
+# hammering it would keep the hashing threads busy for everyone and could guess
+# passwords at leisure
+#
+# each limited route names its rules in FASTAPI_RATE_LIMITS, e.g.
+#   {"login": ["ip:20/60", "email:5/60"]}
+# -> at most 20 attempts a minute from one client IP, and 5 a minute on one account
+# from whichever IPs they come. what a rule counts by:
+# ip -> the client's address (behind a proxy, run uvicorn with --proxy-headers)
+# email -> the login form's username
+# user -> the user id in the bearer token
+# a request over any of its route's limits is turned away with a 429 and a Retry-After
+# header, before the database or the password hasher are touched
+#
+# two backends:
+# "memory" -> token buckets in each API process: N processes let N times the limits
+#   through, and a restart forgets them
+# "redis" -> sliding window counters on a server speaking the Redis protocol, shared
+#   by every API process
+import hashlib
+import logging
+import math
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import NamedTuple
+
+from starlette.concurrency import run_in_threadpool
+
+from fastapi import HTTPException, Request, status
+
+from . import oauth2
+from .config import config_settings
+from .resp import RESPClient, RESPError
+
+logger = logging.getLogger("app.ratelimit")
+
+# what a rule can count requests by
+RULE_KEYS = ("ip", "email", "user")
+
+FORM_CONTENT_TYPES = ("application/x-www-form-urlencoded", "multipart/form-data")
+
+
+class Rule(NamedTuple):
+    """At most 'limit' requests every 'period' seconds per value of 'key'"""
+
+    key: str
+    limit: int
+    period: float
+
+
+def parse_rule(rule: str):
+    """'ip:20/60' -> Rule(key="ip", limit=20, period=60)"""
+    key, _, rate = rule.partition(":")
+    limit, _, period = rate.partition("/")
+    try:
+        parsed = Rule(key, int(limit), float(period))
+    except ValueError:
+        parsed = None
+    if parsed is None or key not in RULE_KEYS or parsed.limit < 1 or parsed.period <= 0:
+        raise ValueError(f"Invalid rate limit rule: {rule!r}")
+    return parsed
+
+
+class MemoryLimiter:
+    """Token buckets in this process: each key's bucket holds up to 'limit' tokens and
+    refills at limit/period tokens a second, a request takes one. Bursts up to the
+    limit pass, then requests are spread out at the refill rate.
+    Safe to share between the event loop and threadpool workers"""
+
+    name = "memory"
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        # key -> (tokens left, time of the last request), least recently hit first
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    async def hit(self, key: str, limit: int, period: float):
+        """Counts a request against 'key'. Returns 0 if it is allowed, else the
+        seconds until one would be"""
+        rate = limit / period
+        now = time.monotonic()
+        with self._lock:
+            tokens, last_hit = self._buckets.pop(key, (limit, now))
+            tokens = min(limit, tokens + (now - last_hit) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            # the least recently hit buckets go first, most likely long since refilled
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        return {"keys": len(self._buckets), "max_keys": self.max_keys}
+
+
+class RedisLimiter(RESPClient):
+    """Sliding window counters on a server speaking the Redis protocol (see resp.py),
+    shared by every API process. Each key counts its requests per fixed window of
+    'period' seconds, the previous window's count weighing in for the part of it still
+    within the last 'period' seconds (assuming its requests were evenly spread).
+    One round trip a rule, atomic without server-side scripts: INCR of the current
+    window, its expiry, GET of the previous one. Rejected requests count too -> a
+    client retrying without waiting stays limited"""
+
+    name = "redis"
+
+    async def hit(self, key: str, limit: int, period: float):
+        return await run_in_threadpool(self._hit, key, limit, period)
+
+    def _hit(self, key: str, limit: int, period: float):
+        # the windows are shared between hosts -> wall clock time
+        window, elapsed = divmod(time.time(), period)
+        window = int(window)
+        current_key = f"{key}:{window}"
+        count, _, previous = self.pipeline(
+            ("INCR", current_key),
+            # kept while it is the current or the previous window
+            ("PEXPIRE", current_key, math.ceil(period * 2000)),
+            ("GET", f"{key}:{window - 1}"),
+        )
+        previous = int(previous or 0)
+
+        if previous * (1 - elapsed / period) + count <= limit:
+            return 0
+        # until one more request would fit: within this window once enough of the
+        # previous one has slid out, or else in the next one, this window's count
+        # then sliding out in turn
+        if count < limit:
+            fits_at = period * (1 - (limit - count - 1) / previous)
+        else:
+            fits_at = period + period * (1 - (limit - 1) / count)
+        return max(fits_at - elapsed, 0.001)
+
+    def clear(self):
+        self.close()
+
+    def stats(self):
+        # the counters expire on the server by themselves
+        return {}
+
+
+class RateLimiter:
+    """The limits of every route, counted on one backend.
+    Backend failures are logged and counted, the request is then let through -> the
+    limiter being down never takes the API down"""
+
+    def __init__(self, backend, rules: dict):
+        self.backend = backend
+        # route -> its rules
+        self.rules = {
+            route: [parse_rule(rule) for rule in route_rules]
+            for route, route_rules in rules.items()
+        }
+        # route -> requests turned away
+        self.rejected = {}
+        self.errors = 0
+
+    async def _key_value(self, key: str, request: Request):
+        """What 'request' is counted by for a rule on 'key' (None -> not counted)"""
+        if key == "ip":
+            return request.client.host if request.client else None
+        if key == "email":
+            # already parsed for the handler's OAuth2PasswordRequestForm, Starlette
+            # keeps the parsed form on the request
+            if not request.headers.get("content-type", "").startswith(
+                FORM_CONTENT_TYPES
+            ):
+                return None
+            return str((await request.form()).get("username", "")).lower() or None
+        # user: an invalid token is not counted, the route's own authentication
+        # refuses it
+        user_id = oauth2.bearer_user_id(request.headers.get("Authorization"))
+        return None if user_id is None else str(user_id)
+
+    async def check(self, route: str, request: Request):
+        """Counts 'request' against the limits of 'route'. Returns 0 if it is allowed,
+        else the seconds the client has to wait"""
+        retry_after = 0
+        if self.backend is None:
+            return retry_after
+        for rule in self.rules.get(route, ()):
+            value = await self._key_value(rule.key, request)
+            if value is None:
+                continue
+            # hashed: the values (an email typed into the login form...) are chosen by
+            # the client, the keys stay short whatever they send
+            digest = hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+            try:
+                wait = await self.backend.hit(
+                    f"ratelimit:{route}:{rule.key}:{digest}", rule.limit, rule.period
+                )
+            except (OSError, RESPError):
+                logger.warning("Rate limit check failed", exc_info=True)
+                self.errors += 1
+                continue
+            retry_after = max(retry_after, wait)
+        if retry_after:
+            self.rejected[route] = self.rejected.get(route, 0) + 1
+        return retry_after
+
+    def limit(self, route: str):
+        """Dependency enforcing the limits of 'route', to be listed in the route
+        decorator's dependencies -> run before the handler's own dependencies (the
+        session, the current user)"""
+
+        async def enforce_rate_limit(request: Request):
+            retry_after = await self.check(route, request)
+            if retry_after:
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Too many requests, try again later.",
+                    # whole seconds, rounded up
+                    headers={"Retry-After": str(math.ceil(retry_after))},
+                )
+
+        return enforce_rate_limit
+
+    def clear(self):
+        self.rejected = {}
+        self.errors = 0
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        return {
+            "backend": self.backend.name if self.backend is not None else None,
+            "rejected": dict(self.rejected),
+            "errors": self.errors,
+            **(self.backend.stats() if self.backend is not None else {}),
+        }
+
+
+def make_backend(name: str):
+    """Builds the backend configured by FASTAPI_RATE_LIMIT_BACKEND (off -> None)"""
+    if name == "memory":
+        return MemoryLimiter(config_settings.fastapi_rate_limit_max_keys)
+    if name == "redis":
+        return RedisLimiter(config_settings.fastapi_rate_limit_redis_url)
+    if name == "off":
+        return None
+    raise ValueError(f"Unknown rate limit backend: {name}")
+
+
+rate_limiter = RateLimiter(
+    make_backend(config_settings.fastapi_rate_limit_backend),
+    config_settings.fastapi_rate_limits,
+)
@@ -0,0 +1,77 @@
+# repairs drift in the denormalised posts.likes and users.followers counters
+# the vote and follow routers keep them in step with the votes and follows tables, but
+# rows can also disappear behind their back (e.g. ON DELETE CASCADE when a user is
+# deleted, manual fixes)
+#
+# usage: python -m app.reconcile
+from sqlalchemy import case, func, select, update
+from sqlmodel import Session
+
+from . import models
+from .config import config_settings
+from .database import engine
+
+
+def reconcile_likes(session: Session):
+    """Recounts the likes of every post from the votes table, fixing any that drifted.
+    Returns the number of posts that were repaired"""
+    # correlated subquery -> the true number of votes for the post being updated
+    true_likes = (
+        select(func.count(models.Vote.post_id))
+        .where(models.Vote.post_id == models.Post.id)
+        .scalar_subquery()
+    )
+
+    # only rows that are actually wrong get rewritten, so a clean table costs no writes
+    repaired = session.execute(
+        update(models.Post)
+        .where(models.Post.likes != true_likes)
+        .values(likes=true_likes)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+
+    return repaired.rowcount
+
+
+def reconcile_followers(session: Session):
+    """Recounts the followers of every user from the follows table, fixing any that
+    drifted. Returns the number of users that were repaired"""
+    true_followers = (
+        select(func.count(models.Follow.follower_id))
+        .where(models.Follow.followee_id == models.User.id)
+        .scalar_subquery()
+    )
+    max_followers = config_settings.fastapi_feed_fanout_max_followers
+
+    # an account the recount brings back under the fan-out threshold resumes fanning
+    # out, as on an unfollow (see timeline.resume_fan_out): its posts from while it was
+    # too big are still pulled at read time. the UPDATE locks the rows it rewrites, the
+    # fan-outs in progress are waited for
+    repaired = session.execute(
+        update(models.User)
+        .where(models.User.followers != true_followers)
+        .values(
+            followers=true_followers,
+            fanned_out_from=case(
+                (
+                    (models.User.followers > max_followers)
+                    & (true_followers <= max_followers),
+                    func.nextval(func.pg_get_serial_sequence("posts", "id")),
+                ),
+                else_=models.User.fanned_out_from,
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+
+    return repaired.rowcount
+
+
+if __name__ == "__main__":
+    with Session(engine) as session:
+        print(f"Repaired the like counts of {reconcile_likes(session)} post(s).")
+        print(
+            f"Repaired the follower counts of {reconcile_followers(session)} user(s)."
+        )
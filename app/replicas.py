@@ -0,0 +1,223 @@
+# read replicas: the GET routes of posts, users and the feed take their session from
+# start_read_session, on one of the replicas (FASTAPI_DATABASE_REPLICA_URLS) instead of
+# the primary -> read-heavy traffic no longer competes with the writes, which all still
+# go to the primary (start_session)
+#
+# a replica only serves reads while healthy: check_replicas runs every
+# FASTAPI_DATABASE_REPLICA_CHECK_INTERVAL seconds (see main.py) and leaves out those that
+# cannot be reached or lag more than FASTAPI_DATABASE_REPLICA_MAX_LAG seconds behind.
+# none healthy (or none configured) -> reads go to the primary
+#
+# replicas lag behind: a user who just wrote something could read an older state back.
+# their reads stay on the primary for FASTAPI_DATABASE_READ_YOUR_WRITES_WINDOW seconds
+# after each commit made on their behalf. NOTE: remembered per API process (like the
+# user cache) -> a read served by another process than the write may still go to a
+# replica, which the max lag keeps at most that far behind. the cached GET /posts/
+# pages follow suit: those users read past them, and pages read off a replica that
+# was behind the primary are not cached (see get_posts)
+import asyncio
+import itertools
+import logging
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.orm import Session
+
+from fastapi import Depends, Request
+
+from . import oauth2
+from .cache import TTLCache
+from .config import config_settings
+from .database import create_engines, open_session, pool_stats, start_session
+
+logger = logging.getLogger("app.replicas")
+
+# users remembered as having written recently, at most (the oldest writers go first)
+RECENT_WRITERS_MAX_USERS = 100_000
+
+# what the replica knows of its replication, see replication_lag. the WAL receiver's
+# status is only shown to roles with pg_read_all_stats, to others a running receiver
+# is all there is to go by
+REPLICATION_STATUS_QUERY = text(
+    "SELECT pg_is_in_recovery(), "
+    "EXISTS (SELECT FROM pg_stat_wal_receiver "
+    "WHERE coalesce(status, 'streaming') = 'streaming'), "
+    "pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn(), "
+    "extract(epoch FROM now() - pg_last_xact_replay_timestamp())"
+)
+
+
+def replication_lag(in_recovery, streaming, replayed_all, last_replay_age):
+    """Seconds the replica is behind the primary, None if that cannot be told"""
+    if not in_recovery:
+        # not replicating anything, e.g. a promoted replica
+        return 0.0
+    if streaming:
+        # an idle primary sends nothing, the last replayed transaction then ages
+        # without any lag -> 0 once all that was received is replayed
+        if replayed_all or last_replay_age is None:
+            return 0.0
+        return float(last_replay_age)
+    # cut off from the primary: having replayed all it received says nothing, it falls
+    # further behind with every write made since -> judged by the age of the last
+    # transaction replayed, which soon goes past the max lag
+    return None if last_replay_age is None else float(last_replay_age)
+
+
+class Replica:
+    """One read replica: its engines, and its health as of the last check"""
+
+    def __init__(self, url: str):
+        url = make_url(url)
+        # shown in /internal/replicas and the metrics, without the credentials
+        self.name = f"{url.host}:{url.port or 5432}/{url.database}"
+        # same pool settings as the primary's engines
+        self.engines = create_engines(
+            url.set(drivername="postgresql").render_as_string(hide_password=False),
+            url.set(drivername="postgresql+asyncpg").render_as_string(
+                hide_password=False
+            ),
+        )
+        # no reads until a first check found it fit
+        self.healthy = False
+        self.lag = None
+        self.error = None
+
+    async def _replication_lag(self):
+        async with open_session(self.engines) as session:
+            status = (await session.execute(REPLICATION_STATUS_QUERY)).one()
+        return replication_lag(*status)
+
+    async def check(self):
+        """Probes the replica, returns whether it is fit to serve reads"""
+        try:
+            self.lag = await asyncio.wait_for(
+                self._replication_lag(),
+                config_settings.fastapi_database_replica_check_timeout,
+            )
+            self.error = None if self.lag is not None else "not streaming"
+        except Exception as error:
+            # unreachable, timed out, refusing connections... out of the rotation
+            self.lag = None
+            self.error = repr(error)
+
+        healthy = (
+            self.lag is not None
+            and self.lag <= config_settings.fastapi_database_replica_max_lag
+        )
+        if healthy != self.healthy:
+            logger.warning(
+                "Replica %s %s (lag: %s, error: %s)",
+                self.name,
+                "back in the rotation" if healthy else "left out of the rotation",
+                self.lag,
+                self.error,
+            )
+        self.healthy = healthy
+        return healthy
+
+    def mark_down(self, error: Exception):
+        """Leaves the replica out until the next check finds it back"""
+        self.healthy = False
+        self.error = repr(error)
+
+    def stats(self):
+        sync_engine, asyncpg_engine = self.engines
+        serving = (
+            asyncpg_engine if config_settings.fastapi_database_async else sync_engine
+        )
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "lag_seconds": self.lag,
+            "error": self.error,
+            "pool": pool_stats(serving.pool),
+        }
+
+
+class ReplicaSet:
+    """The configured replicas, taking turns to serve reads while healthy"""
+
+    def __init__(self, urls):
+        self.replicas = [Replica(url) for url in urls]
+        self._turns = itertools.count()
+
+    def pick(self):
+        """A healthy replica, in turns, None if there is none"""
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._turns) % len(healthy)]
+
+    async def check(self):
+        """Checks every replica at once, a hanging one holds up no other.
+        Returns the number of healthy replicas"""
+        return sum(
+            await asyncio.gather(*(replica.check() for replica in self.replicas))
+        )
+
+    def stats(self):
+        return [replica.stats() for replica in self.replicas]
+
+
+replicas = ReplicaSet(config_settings.fastapi_database_replica_urls)
+
+# user id -> True, for as long as their reads stay on the primary
+recent_writers = TTLCache(
+    maxsize=RECENT_WRITERS_MAX_USERS,
+    ttl=config_settings.fastapi_database_read_your_writes_window,
+)
+
+
+@event.listens_for(Session, "after_commit")
+def remember_writer(session):
+    """A request authenticated as a user committed something -> their reads stay on
+    the primary for the read-your-writes window"""
+    if (user_id := oauth2.current_user_id.get()) is not None:
+        recent_writers.set(user_id, True)
+
+
+async def check_replicas(session):
+    """Periodic job (see main.py), the session it is handed on the primary goes unused"""
+    return await replicas.check()
+
+
+def needs_primary(request: Request):
+    """Whether the request's reads have to see the primary's latest state: replicas
+    are in use, and the requesting user committed something within the
+    read-your-writes window"""
+    if not replicas.replicas:
+        return False
+    user_id = oauth2.bearer_user_id(request.headers.get("Authorization"))
+    return user_id is not None and recent_writers.get(user_id) is not None
+
+
+def read_behind_primary(request: Request):
+    """Whether the request's reads were served by a replica that was behind the
+    primary at its last check -> what was read may miss the latest writes"""
+    replica = getattr(request.state, "read_replica", None)
+    return replica is not None and replica.lag != 0
+
+
+# getting DB sessions for the read-only routes, as a dependency like start_session
+async def start_read_session(request: Request, primary_session=Depends(start_session)):
+    """A session on a healthy replica, unless the requesting user wrote something
+    within the read-your-writes window. Otherwise, the request's session on the
+    primary (shared with get_current_user, opening it costs no connection)"""
+    replica = None if needs_primary(request) else replicas.pick()
+    # the replica read from, for the response cache (see read_behind_primary)
+    request.state.read_replica = replica
+
+    if replica is None:
+        yield primary_session
+        return
+
+    try:
+        async with open_session(replica.engines) as session:
+            yield session
+    except (OperationalError, InterfaceError, OSError) as error:
+        # connection refused or lost -> no more reads sent its way until the next
+        # check finds it back
+        replica.mark_down(error)
+        raise
@@ -0,0 +1,115 @@
+# minimal client of the Redis protocol (RESP), for the stores shared by every API
+# process: any server speaking it will do (Redis, KeyDB, Valkey, ...)
+# blocking sockets kept in a small pool and used from the threadpool (like
+# ThreadedSession), as the stores are used from both stacks' requests
+import socket
+from threading import Lock
+from urllib.parse import unquote, urlsplit
+
+
+class RESPError(Exception):
+    """The server answered with an error"""
+
+
+class RESPClient:
+    """Connection pool to one server, url: redis://[:password@]host[:port][/db]"""
+
+    def __init__(self, url: str, timeout: float = 0.5):
+        parsed = urlsplit(url)
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        # idle connections, (socket, its buffered reader) pairs
+        self._idle = []
+        self._lock = Lock()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile("rb"))
+        if self.password:
+            self._send(connection, ("AUTH", self.password))
+        if self.db:
+            self._send(connection, ("SELECT", self.db))
+        return connection
+
+    @staticmethod
+    def _encode(*args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            # returned, not raised: the replies after it must still be read
+            return RESPError(payload.decode(errors="replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            # -1 -> nil (e.g. GET of a missing key)
+            return None if length < 0 else reader.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(payload)
+            return (
+                None
+                if length < 0
+                else [self._read_reply(reader) for _ in range(length)]
+            )
+        raise RESPError(f"Unexpected reply from the server: {line!r}")
+
+    def _send(self, connection, *commands):
+        # all the commands in one write, then all the replies -> one round trip
+        connection[0].sendall(b"".join(self._encode(*args) for args in commands))
+        replies = [self._read_reply(connection[1]) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RESPError):
+                raise reply
+        return replies
+
+    def pipeline(self, *commands):
+        """Sends the commands (tuples of arguments) in one round trip, returns their
+        replies. Blocking, run it on the threadpool"""
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = self._connect()
+        try:
+            replies = self._send(connection, *commands)
+        except RESPError:
+            # an error reply leaves the connection usable
+            self._release(connection)
+            raise
+        except BaseException:
+            # half-sent command or half-read reply -> the connection is unusable
+            connection[1].close()
+            connection[0].close()
+            raise
+        self._release(connection)
+        return replies
+
+    def command(self, *args):
+        """Sends one command, returns its reply. Blocking, run it on the threadpool"""
+        return self.pipeline(args)[0]
+
+    def _release(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def close(self):
+        """Closes the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock, reader in idle:
+            reader.close()
+            sock.close()
@@ -0,0 +1,223 @@
+# cache of whole responses of read-heavy endpoints (GET /posts/ pages), so identical
+# requests during a traffic spike run the query and serialise the page only once.
+# entries are keyed by the request's normalised query parameters plus a generation
+# number: every write that can change a page bumps the generation, which orphans all
+# the cached pages at once (they age out through their TTL, or the LRU) -> invalidating
+# is one cheap write instead of working out which pages a post appears on
+#
+# two backends:
+# "memory" -> per API process, an LRU bounded by the bytes it holds. a write only
+#   invalidates the pages of the process serving it, the other processes' copies live
+#   on until their TTL runs out (like the authenticated user cache)
+# "redis" -> any server speaking the Redis protocol (Redis, KeyDB, Valkey, ...), shared
+#   by every API process, so invalidation reaches all of them
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urlencode
+
+from starlette.concurrency import run_in_threadpool
+
+from .config import config_settings
+from .resp import RESPClient, RESPError
+
+logger = logging.getLogger("app.response_cache")
+
+
+class MemoryBackend:
+    """In-process LRU store, bounded by the total size of the values it holds.
+    Safe to share between the event loop and threadpool workers"""
+
+    name = "memory"
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # key -> (expiry time, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._bytes = 0
+        self._lock = Lock()
+
+    async def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        # a single value larger than the whole cache is not worth evicting everything
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    async def counter(self, key: str):
+        return self._counters.get(key, 0)
+
+    async def incr(self, key: str):
+        with self._lock:
+            value = self._counters[key] = self._counters.get(key, 0) + 1
+        return value
+
+    def _drop(self, key):
+        # the lock is already held
+        self._bytes -= len(self._entries.pop(key)[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class RedisBackend(RESPClient):
+    """Store on a server speaking the Redis protocol (see resp.py), shared by every
+    API process"""
+
+    name = "redis"
+
+    async def get(self, key: str):
+        return await run_in_threadpool(self.command, "GET", key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await run_in_threadpool(self.command, "SET", key, value, "PX", int(ttl * 1000))
+
+    async def counter(self, key: str):
+        return int(await run_in_threadpool(self.command, "GET", key) or 0)
+
+    async def incr(self, key: str):
+        return await run_in_threadpool(self.command, "INCR", key)
+
+    def clear(self):
+        self.close()
+
+    def stats(self):
+        """Keys (DBSIZE) and memory (INFO memory) of the server, in one round trip:
+        the whole database, the cached pages share it with anything else stored
+        there. Blocking, called from the sync internal and metrics endpoints"""
+        try:
+            keys, info = self.pipeline(("DBSIZE",), ("INFO", "memory"))
+        except (OSError, RESPError):
+            logger.warning("Cache stats failed", exc_info=True)
+            return {}
+        # INFO -> "field:value" lines, under "# Section" headers
+        fields = dict(
+            line.split(":", 1)
+            for line in info.decode().splitlines()
+            if ":" in line and not line.startswith("#")
+        )
+        return {"entries": keys, "bytes": int(fields["used_memory"])}
+
+
+class ResponseCache:
+    """Responses of one endpoint, keyed by normalised query parameters.
+    Backend failures are logged and counted, the request then goes to the database as
+    if the page was not cached -> the cache being down never takes the API down"""
+
+    def __init__(self, backend, namespace: str, ttl: float):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.generation_key = f"{namespace}:generation"
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None and self.ttl > 0
+
+    async def lookup(self, params: dict):
+        """Returns (key, cached value or None). The key is only valid for the
+        generation it was built in -> store the page under that key, never a new one"""
+        # parameter order, and parameters left at their defaults, make no difference
+        normalised = urlencode(sorted(params.items()))
+        digest = hashlib.blake2b(normalised.encode(), digest_size=16).hexdigest()
+        try:
+            generation = await self.backend.counter(self.generation_key)
+            key = f"{self.namespace}:{generation}:{digest}"
+            value = await self.backend.get(key)
+        except (OSError, RESPError):
+            logger.warning("Cache lookup failed", exc_info=True)
+            self.errors += 1
+            return None, None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key, value
+
+    async def store(self, key: str, value: bytes):
+        if key is None:
+            return
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except (OSError, RESPError):
+            logger.warning("Cache store failed", exc_info=True)
+            self.errors += 1
+
+    async def invalidate(self):
+        """Orphans every cached response, to be called once a write is committed"""
+        if not self.enabled:
+            return
+        try:
+            await self.backend.incr(self.generation_key)
+        except (OSError, RESPError):
+            # the stale pages still expire after the TTL
+            logger.warning("Cache invalidation failed", exc_info=True)
+            self.errors += 1
+
+    def clear(self):
+        self.hits = self.misses = self.errors = 0
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        """Returns the backend's hit/miss/error counters and what it reports of its size"""
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend.name if self.enabled else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            **(self.backend.stats() if self.enabled else {}),
+        }
+
+
+def make_backend(name: str):
+    """Builds the backend configured by FASTAPI_POSTS_CACHE_BACKEND (off -> None)"""
+    if name == "memory":
+        return MemoryBackend(config_settings.fastapi_posts_cache_max_bytes)
+    if name == "redis":
+        return RedisBackend(config_settings.fastapi_posts_cache_redis_url)
+    if name == "off":
+        return None
+    raise ValueError(f"Unknown cache backend: {name}")
+
+
+# pages of GET /posts/, the same for every user
+posts_cache = ResponseCache(
+    make_backend(config_settings.fastapi_posts_cache_backend),
+    namespace="posts",
+    ttl=config_settings.fastapi_posts_cache_ttl,
+)
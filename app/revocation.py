@@ -0,0 +1,140 @@
+# revoked access tokens, checked on every authenticated request
+# the revoked_tokens table (models.RevokedToken) is the authority. each API process
+# mirrors it in memory and reloads it on a timer (see main.py), so a check never costs
+# a database round trip. a token revoked by this process is refused by it straight
+# away, by the others once they reload (FASTAPI_JWT_REVOCATION_SYNC_INTERVAL)
+#
+# revocations only matter until the token expires on its own, and the table is pruned
+# as they do -> with short-lived access tokens the list stays small. so are those of
+# this process not yet seen in a reload, even with the reloads off
+import math
+import time
+
+from sqlalchemy import delete, func, select
+
+from . import models
+from .config import config_settings
+
+# false positive rate the Bloom filter is sized for
+FALSE_POSITIVE_RATE = 0.01
+# revocations the filter is sized for at the very least, avoids resizing for the first few
+MIN_CAPACITY = 1024
+
+
+class RevocationList:
+    """Set of revoked token ids (jti): a Bloom filter in front of the exact set.
+    A check costs a handful of bit probes, all derived from the jti's hash, which
+    Python caches on the string -> nothing is allocated for it, and a token whose
+    claims come from the verified-token cache is checked with the very same string
+    every time. Only the filter's positives (revoked tokens, and about
+    FALSE_POSITIVE_RATE of the others) go on to the exact set"""
+
+    def __init__(self, ttl: float):
+        # how long a revocation matters: the lifetime of an access token, counted from
+        # its revocation, as in the table (see oauth2.revoke_access_tokens)
+        self.ttl = ttl
+        # jti -> expiry (time.monotonic()), of the tokens revoked by this process and
+        # not yet seen in a reload of the table. in revocation order -> by expiry
+        self._unsynced = {}
+        self._build(())
+
+    def _build(self, jtis):
+        exact = set(jtis)
+        # sized for twice the current revocations, room for those made until the next
+        # reload. bits = -n ln(p) / ln(2)^2, probes = bits / n ln(2)
+        capacity = self._capacity = max(2 * len(exact), MIN_CAPACITY)
+        size = math.ceil(-capacity * math.log(FALSE_POSITIVE_RATE) / math.log(2) ** 2)
+        probes = max(1, round(size / capacity * math.log(2)))
+        bits = bytearray((size + 7) // 8)
+        # one tuple, swapped in with a single assignment -> readers on other threads
+        # always see a consistent filter and set
+        state = (bits, size, range(probes), exact)
+        for jti in exact:
+            self._set_bits(state, jti)
+        self._state = state
+
+    @staticmethod
+    def _set_bits(state, jti):
+        bits, size, probes, _ = state
+        # double hashing: probe i is h1 + i * h2, both halves of the one 64-bit hash
+        # (h2 made odd, so never 0)
+        digest = hash(jti)
+        h1, h2 = digest & 0xFFFFFFFF, (digest >> 32) | 1
+        for i in probes:
+            position = (h1 + i * h2) % size
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, jti: str):
+        bits, size, probes, exact = self._state
+        if not exact:
+            # nothing revoked, the usual case
+            return False
+        digest = hash(jti)
+        h1, h2 = digest & 0xFFFFFFFF, (digest >> 32) | 1
+        for i in probes:
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return jti in exact
+
+    def __len__(self):
+        return len(self._state[3])
+
+    def _drop_expired(self):
+        """Forgets the revocations of this process that expired, returns their jtis"""
+        now = time.monotonic()
+        expired = set()
+        for jti, expiry in self._unsynced.items():
+            if expiry > now:
+                break
+            expired.add(jti)
+        for jti in expired:
+            del self._unsynced[jti]
+        return expired
+
+    def add(self, jti: str):
+        """Revokes a token in this process right away, the table being written by the
+        caller. Rebuilds the filter once it outgrows its capacity, without the
+        revocations expired since -> bounded even when the table is never reloaded"""
+        self._unsynced.pop(jti, None)
+        self._unsynced[jti] = time.monotonic() + self.ttl
+        exact = self._state[3]
+        if len(exact) >= self._capacity:
+            self._build((exact - self._drop_expired()) | {jti})
+        else:
+            # bits first: the filter must never say no for a jti already in the set
+            self._set_bits(self._state, jti)
+            exact.add(jti)
+
+    def replace(self, jtis):
+        """Swaps in the revocations reloaded from the table. Tokens this process
+        revoked since are kept until a reload includes them"""
+        jtis = set(jtis)
+        self._drop_expired()
+        for jti in jtis & self._unsynced.keys():
+            del self._unsynced[jti]
+        self._build(jtis | self._unsynced.keys())
+
+    def clear(self):
+        self._unsynced.clear()
+        self._build(())
+
+
+revoked_tokens = RevocationList(
+    ttl=config_settings.fastapi_jwt_access_token_expire_minutes * 60
+)
+
+
+async def sync_revoked_tokens(session):
+    """Prunes the expired revocations, then reloads the rest into this process's list.
+    Returns the number of revoked tokens"""
+    await session.execute(
+        delete(models.RevokedToken)
+        .where(models.RevokedToken.expires_at <= func.now())
+        .execution_options(synchronize_session=False)
+    )
+    jtis = (await session.execute(select(models.RevokedToken.jti))).scalars().all()
+    await session.commit()
+
+    revoked_tokens.replace(jtis)
+    return len(jtis)
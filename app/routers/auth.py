@@ -1,24 +1,36 @@
 # handles user authentication
 
+import uuid
+
 # for authentication purposes
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
+from sqlalchemy import func, update
 from sqlalchemy.exc import NoResultFound
-from sqlmodel import Session, select
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 
 from .. import models, oauth2, utils
 from ..database import start_session
+from ..ratelimit import rate_limiter
+from ..revocation import revoked_tokens
 
 router = APIRouter(tags=["Authentication"])
 
 
-@router.post("/login", response_model=models.Token)
+# rate limited per client IP and per account, before the user lookup and the bcrypt
+# verify (see ratelimit.py)
+@router.post(
+    "/login",
+    response_model=models.Token,
+    dependencies=[Depends(rate_limiter.limit("login"))],
+)
 # using OAuth2PasswordRequestForm instead of models.UserLogin, as a dependency
 # note: it is sent as form data, not as json body
-def login_user(
+async def login_user(
     user_form_data: OAuth2PasswordRequestForm = Depends(),
-    session: Session = Depends(start_session),
+    session: AsyncSession = Depends(start_session),
 ):
     """Authenticates an existing user"""
     # obtain user by email (note use of exec(), select() and one())
@@ -26,8 +38,10 @@ def login_user(
     # oauth2 password request form returns 2 fields: username and password
     # therefore, email will be under the key 'username'
     try:
-        authenticated_user = session.exec(
-            select(models.User).where(models.User.email == user_form_data.username)
+        authenticated_user = (
+            await session.exec(
+                select(models.User).where(models.User.email == user_form_data.username)
+            )
         ).one()
     except NoResultFound as e:
         raise HTTPException(
@@ -37,16 +51,123 @@ def login_user(
     # check if the user exists based on email
 
     # if found, verify if input password is correct
-    if not utils.verify(user_form_data.password, authenticated_user.password):
+    # bcrypt is deliberately slow CPU work, it runs on its own threads
+    is_valid, new_hash = await utils.verify_password(
+        user_form_data.password, authenticated_user.password
+    )
+    if not is_valid:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Invalid credentials."
         )
 
+    # the password hash was made with an outdated bcrypt cost -> upgrade it now,
+    # the only moment the plain password is available
+    # (committed together with the refresh token below)
+    if new_hash:
+        authenticated_user.password = new_hash
+        session.add(authenticated_user)
+
+    return await issue_tokens(session, authenticated_user)
+
+
+async def issue_tokens(session, user: models.User, family_id: str = None):
+    """Issues an access token and the refresh token to renew it with, and commits"""
     # create a JWT token for security
     # where payload = id, email
+    access_jti = uuid.uuid4().hex
     user_jwt_token = oauth2.create_access_token(
-        data={"user_id": authenticated_user.id, "username": authenticated_user.name}
+        data={"user_id": user.id, "username": user.name}, jti=access_jti
+    )
+    refresh_token = oauth2.create_refresh_token(
+        session, user.id, access_jti, family_id=family_id
+    )
+    await session.commit()
+
+    # return the tokens
+    return {
+        "access_token": user_jwt_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+    }
+
+
+@router.post(
+    "/token/refresh",
+    response_model=models.Token,
+    dependencies=[Depends(rate_limiter.limit("refresh_tokens"))],
+)
+async def refresh_tokens(
+    refresh: models.TokenRefresh, session: AsyncSession = Depends(start_session)
+):
+    """Exchanges a refresh token for a new access token and a new refresh token.
+    Each refresh token only works once"""
+    invalid_token = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token.",
+        headers={"WWW-Authenticate": "Bearer"},
     )
+    token_hash = oauth2.hash_refresh_token(refresh.refresh_token)
+
+    # the token is used up in the same statement that checks it -> two requests racing
+    # with the same token cannot both get a new pair
+    claimed = (
+        await session.execute(
+            update(models.RefreshToken)
+            .where(
+                models.RefreshToken.token_hash == token_hash,
+                col(models.RefreshToken.used).is_(False),
+                models.RefreshToken.expires_at > func.now(),
+            )
+            .values(used=True)
+            .returning(models.RefreshToken.user_id, models.RefreshToken.family_id)
+            .execution_options(synchronize_session=False)
+        )
+    ).first()
+
+    if not claimed:
+        # a token that was already used coming back: it leaked, and either the thief or
+        # the user already holds its successor -> the whole family is logged out
+        family_id = (
+            await session.execute(
+                select(models.RefreshToken.family_id).where(
+                    models.RefreshToken.token_hash == token_hash,
+                    col(models.RefreshToken.used).is_(True),
+                )
+            )
+        ).scalar()
+        if family_id:
+            revoked = await oauth2.revoke_token_family(session, family_id)
+            await session.commit()
+            for jti in revoked:
+                revoked_tokens.add(jti)
+        else:
+            await session.rollback()
+        raise invalid_token
+
+    # the user may have been deleted since the token was claimed
+    user = await session.get(models.User, claimed.user_id)
+    if user is None:
+        await session.rollback()
+        raise invalid_token
+    return await issue_tokens(session, user, family_id=claimed.family_id)
+
+
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout_user(
+    user_token: models.TokenPayload = Depends(oauth2.get_current_token),
+    session: AsyncSession = Depends(start_session),
+    current_user: models.User = Depends(oauth2.get_current_user),
+):
+    """Revokes the access token, and the refresh tokens of its login"""
+    # the claims get_current_user was authenticated with, not verified again: the
+    # token may be revoked (e.g. a double-submitted logout) or expire in between
+    access_jti = user_token.jti
+    if family_id := await oauth2.find_token_family(session, access_jti):
+        revoked = await oauth2.revoke_token_family(session, family_id)
+    else:
+        revoked = await oauth2.revoke_access_tokens(session, [access_jti])
+    await session.commit()
+    for jti in revoked:
+        revoked_tokens.add(jti)
 
-    # return the token
-    return {"access_token": user_jwt_token, "token_type": "bearer"}
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
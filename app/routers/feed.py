@@ -0,0 +1,106 @@
+from typing import List, Optional
+
+from sqlalchemy import or_, union
+from sqlalchemy.orm import defer, joinedload
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastapi import APIRouter, Depends, Query, Response
+
+from .. import models, oauth2, utils
+from ..config import config_settings
+from ..replicas import start_read_session
+
+router = APIRouter(prefix="/feed", tags=["Feed"])
+
+
+@router.get("/", response_model=List[models.PostOut])
+async def get_feed(
+    response: Response,
+    session: AsyncSession = Depends(start_read_session),
+    current_user: models.User = Depends(oauth2.get_current_user),
+    limit: int = Query(default=10, ge=1, le=100),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = Query(
+        default=None,
+        description="Comma-separated post fields to return, e.g. id,title,excerpt",
+    ),
+):
+    """The current user's home feed: their own posts and those of the users they
+    follow, newest first. Paged with the X-Next-Cursor header, and narrowed down with
+    ?fields=, like GET /posts/"""
+    selected_fields = utils.parse_post_fields(fields)
+
+    # 1. the materialised timeline (see timeline.py) -> a range scan of its primary key
+    fanned_out = select(models.TimelineEntry.post_id.label("post_id")).where(
+        models.TimelineEntry.user_id == current_user.id
+    )
+    # 2. posts of followed accounts too big to fan out, pulled in at read time, and
+    # those of accounts that were too big once, from back then (see timeline.py).
+    # both kinds are few and found through the users.followers and
+    # users.fanned_out_from indexes, so this stays a handful of index lookups whatever
+    # the number of users followed
+    too_big = models.User.followers > config_settings.fastapi_feed_fanout_max_followers
+    pulled_accounts = select(models.User.id).where(
+        or_(too_big, col(models.User.fanned_out_from).is_not(None))
+    )
+    followed_pulled_accounts = select(models.Follow.followee_id).where(
+        models.Follow.follower_id == current_user.id,
+        col(models.Follow.followee_id).in_(pulled_accounts),
+    )
+    pulled = (
+        select(models.Post.id.label("post_id"))
+        .join(models.User, models.User.id == models.Post.owner_id)
+        .where(
+            col(models.Post.owner_id).in_(followed_pulled_accounts),
+            or_(too_big, models.Post.id < models.User.fanned_out_from),
+        )
+    )
+
+    if cursor:
+        # newest first -> the next page starts below the last post id seen
+        before = utils.decode_cursor(cursor)
+        fanned_out = fanned_out.where(models.TimelineEntry.post_id < before)
+        pulled = pulled.where(models.Post.id < before)
+
+    # each source only ever contributes its newest 'limit' posts to the page.
+    # UNION -> a post fanned out before its owner grew too big is only listed once
+    feed_ids = union(
+        fanned_out.order_by(models.TimelineEntry.post_id.desc()).limit(limit),
+        pulled.order_by(models.Post.id.desc()).limit(limit),
+    ).subquery("feed_ids")
+
+    if selected_fields is None:
+        feed_query = select(models.Post, col(models.Post.likes).label("likes")).options(
+            joinedload(models.Post.owner),
+            defer(models.Post.search_vector),
+            defer(models.Post.excerpt),
+        )
+    else:
+        # only the columns asked for, see GET /posts/
+        feed_query = utils.sparse_posts_query(selected_fields)
+    feed_query = (
+        feed_query.join(feed_ids, feed_ids.c.post_id == models.Post.id)
+        .order_by(models.Post.id.desc())
+        .limit(limit)
+    )
+    feed = (await session.exec(feed_query)).all()
+
+    next_cursor = None
+    if feed and len(feed) == limit:
+        last_post = feed[-1]
+        next_cursor = utils.encode_cursor(
+            last_post.Post.id if selected_fields is None else last_post.id
+        )
+
+    if selected_fields is not None:
+        # partial posts, no response model to validate them against
+        return Response(
+            content=utils.encode_sparse_posts(feed, selected_fields),
+            media_type="application/json",
+            headers={"X-Next-Cursor": next_cursor} if next_cursor else {},
+        )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    return feed
@@ -0,0 +1,117 @@
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+
+from .. import models, oauth2, timeline, utils
+from ..config import config_settings
+from ..database import start_session
+from .vote import FOREIGN_KEY_VIOLATION
+
+router = APIRouter(prefix="/follows", tags=["Follows"])
+
+
+@router.post("/", status_code=status.HTTP_201_CREATED)
+async def follow_user(
+    follow: models.UserFollow,
+    session: AsyncSession = Depends(start_session),
+    current_user: models.User = Depends(oauth2.get_current_user),
+):
+    """Follows a user, their posts then show up in the current user's feed"""
+    user_not_found = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"User (id: {follow.user_id}) Not Found.",
+    )
+    if not utils.in_id_range(follow.user_id):
+        raise user_not_found
+    if follow.user_id == current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You cannot follow yourself.",
+        )
+
+    # same single statement as a like (see vote.py): the follow is written, and the
+    # followee's follower counter bumped off its RETURNING row
+    new_follow = (
+        insert(models.Follow)
+        .values(follower_id=current_user.id, followee_id=follow.user_id)
+        .on_conflict_do_nothing()
+        .returning(models.Follow.followee_id)
+        .cte("new_follow")
+    )
+    try:
+        followed = (
+            await session.execute(
+                update(models.User)
+                .where(models.User.id == new_follow.c.followee_id)
+                .values(followers=models.User.followers + 1)
+                .returning(models.User.id)
+                .execution_options(synchronize_session=False)
+            )
+        ).first()
+    except IntegrityError as error:
+        # the follow's foreign key points at a user that does not exist
+        if getattr(error.orig, "pgcode", None) == FOREIGN_KEY_VIOLATION:
+            await session.rollback()
+            raise user_not_found from error
+        raise
+
+    if not followed:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"You ({current_user.name}) already follow user {follow.user_id}",
+        )
+
+    await timeline.backfill_timeline(session, current_user.id, follow.user_id)
+    await session.commit()
+
+    return {"message": "user followed successfully."}
+
+
+@router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def unfollow_user(
+    user_id: int,
+    session: AsyncSession = Depends(start_session),
+    current_user: models.User = Depends(oauth2.get_current_user),
+):
+    """Unfollows a user, their posts leave the current user's feed"""
+    follow_not_found = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"You do not follow user {user_id}.",
+    )
+    if not utils.in_id_range(user_id):
+        raise follow_not_found
+
+    old_follow = (
+        delete(models.Follow)
+        .where(
+            models.Follow.follower_id == current_user.id,
+            models.Follow.followee_id == user_id,
+        )
+        .returning(models.Follow.followee_id)
+        .cte("old_follow")
+    )
+    unfollowed = (
+        await session.execute(
+            update(models.User)
+            .where(models.User.id == old_follow.c.followee_id)
+            .values(followers=models.User.followers - 1)
+            .returning(models.User.followers)
+            .execution_options(synchronize_session=False)
+        )
+    ).first()
+
+    if not unfollowed:
+        await session.rollback()
+        raise follow_not_found
+
+    # one follower fewer was the one too many: their posts are fanned out again
+    if unfollowed.followers == config_settings.fastapi_feed_fanout_max_followers:
+        await timeline.resume_fan_out(session, user_id)
+    await timeline.clear_timeline(session, current_user.id, user_id)
+    await session.commit()
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,56 @@
+# internal, operational endpoints - not part of the public API docs, and only served
+# to holders of the internal token (see oauth2.verify_internal_token)
+from fastapi import APIRouter, Depends
+
+from .. import oauth2, utils
+from ..config import config_settings
+from ..database import async_engine, engine, pool_stats
+from ..ratelimit import rate_limiter
+from ..replicas import replicas
+from ..response_cache import posts_cache
+
+router = APIRouter(
+    prefix="/internal",
+    tags=["Internal"],
+    include_in_schema=False,
+    dependencies=[Depends(oauth2.verify_internal_token)],
+)
+
+
+@router.get("/pool")
+def get_pool_stats():
+    """Live connection pool statistics, for sizing pools against max_connections"""
+    return {
+        # which of the two engines is serving the API requests
+        "serving": "async" if config_settings.fastapi_database_async else "sync",
+        "async": pool_stats(async_engine.pool),
+        "sync": pool_stats(engine.pool),
+    }
+
+
+@router.get("/replicas")
+def get_replica_stats():
+    """Health, replication lag and pool of each read replica"""
+    return replicas.stats()
+
+
+@router.get("/cache")
+def get_cache_stats():
+    """Hit/miss counters of the caches"""
+    return {
+        "users": oauth2.user_cache.stats(),
+        "tokens": oauth2.token_cache.stats(),
+        "posts": posts_cache.stats(),
+    }
+
+
+@router.get("/hasher")
+def get_hasher_stats():
+    """Load on the dedicated bcrypt threads"""
+    return utils.password_hasher.stats()
+
+
+@router.get("/ratelimit")
+def get_rate_limit_stats():
+    """Requests turned away by the rate limits, per route"""
+    return rate_limiter.stats()
@@ -0,0 +1,23 @@
+# Prometheus scrape target, see metrics.py for what is collected. only served to
+# holders of the internal token (see oauth2.verify_internal_token)
+from fastapi.responses import PlainTextResponse
+
+from fastapi import APIRouter, Depends
+
+from .. import oauth2
+from ..metrics import render_metrics
+
+router = APIRouter(
+    tags=["Metrics"],
+    include_in_schema=False,
+    dependencies=[Depends(oauth2.verify_internal_token)],
+)
+
+# content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("/metrics")
+def get_metrics():
+    """Request, connection pool, cache and password hasher metrics"""
+    return PlainTextResponse(render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
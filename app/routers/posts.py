@@ -1,19 +1,58 @@
+import csv
+import io
 from datetime import datetime
 from typing import List, Optional
 
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import parse_obj_as
 from sqlalchemy.exc import NoResultFound
-from sqlmodel import Session, col, func, select  # or_
+from sqlalchemy.orm import defer, joinedload
+from sqlmodel import col, func, literal_column, select  # or_
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 # to 'access the app object' from main, FastAPI uses routers
-from fastapi import APIRouter, Depends, HTTPException, Response, status
-
-from .. import models, oauth2
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+
+from .. import models, oauth2, replicas, timeline, utils
 from ..database import start_session
+from ..ratelimit import rate_limiter
+from ..replicas import start_read_session
+from ..response_cache import posts_cache
 
 # router is not imported from main, use APIRouter
 # refactoring, to avoid repeated "/posts"
 router = APIRouter(prefix="/posts", tags=["Posts"])
 
+# posts are only served to authenticated users -> shared caches must not store them,
+# and clients have to revalidate (If-None-Match) before reusing their copy
+POST_CACHE_CONTROL = "private, no-cache"
+
+# rows fetched from the server-side cursor, and encoded, at a time by GET /posts/export
+EXPORT_BATCH_SIZE = 1000
+
+# columns written out by GET /posts/export
+EXPORT_COLUMNS = [
+    models.Post.id,
+    models.Post.title,
+    models.Post.content,
+    models.Post.published,
+    models.Post.rating,
+    models.Post.likes,
+    models.Post.updated_at,
+    models.Post.owner_id,
+]
+
 # REMEMBER: FastAPI will execute the first matched path operation (i.e. request + endpoint)
 
 # dummy path operation for retrieving posts (get request)
@@ -24,12 +63,20 @@ router = APIRouter(prefix="/posts", tags=["Posts"])
 # we can set this by passing in an additional parameter to the path operation, which
 # will serve as a query parameter indicated by a preceding '?' in the URL
 # to chain query parameters, use '&'
-def get_posts(
-    session: Session = Depends(start_session),
+async def get_posts(
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(start_read_session),
     current_user: models.User = Depends(oauth2.get_current_user),
     limit: int = 10,
     skip: int = 0,
     search: Optional[str] = "",
+    search_mode: models.SearchMode = models.SearchMode.fulltext,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = Query(
+        default=None,
+        description="Comma-separated post fields to return, e.g. id,title,excerpt",
+    ),
 ):  # sourcery skip: inline-immediately-returned-variable
     # USING RAW SQL AND PSYCOPG2 DIRECTLY
 
@@ -66,17 +113,170 @@ def get_posts(
     #     .where(col(models.Post.title).contains(search))
     # ).all()
 
-    post_with_likes = session.exec(
-        select(models.Post, func.count(models.Vote.post_id).label("likes"))
-        .limit(limit=limit)
-        .offset(offset=skip)
+    # ranked results are not ordered by id, so an id cursor means nothing for them
+    ranked = bool(search) and search_mode == models.SearchMode.fulltext
+    if cursor and ranked:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cursor pagination is not supported for full-text search, use skip.",
+        )
+    last_post_id = utils.decode_cursor(cursor) if cursor else None
+    selected_fields = utils.parse_post_fields(fields)
+
+    # RESPONSE CACHE
+    # a page does not depend on who asks for it, so one cached copy serves every user.
+    # the key is built from the parameters as the query below understands them: their
+    # order, defaults left out or spelt out, and parameters the query ignores make no
+    # difference
+    # READ-YOUR-WRITES: with replicas, a user who just wrote something reads from the
+    # primary (see replicas.py), while cached pages may have been read off a replica
+    # from before their write -> they neither get nor store cached pages for as long
+    use_cache = posts_cache.enabled and not replicas.needs_primary(request)
+    if use_cache:
+        cache_key, cached_page = await posts_cache.lookup(
+            {
+                "limit": limit,
+                "skip": skip if last_post_id is None else 0,
+                "search": search or "",
+                "search_mode": search_mode.value if search else "",
+                "after": last_post_id or "",
+                "fields": ",".join(selected_fields or ()),
+            }
+        )
+        if cached_page is not None:
+            return page_response(cached_page, "HIT")
+
+    # KEYSET (CURSOR) PAGINATION
+    # .offset(skip) forces Postgres to build and throw away every row before the page,
+    # so deep pages get slower and slower. with a cursor, the page starts right after the
+    # last post id the client has seen -> a primary key index range scan, same cost on
+    # page 1 and page 100,000. 'skip' is still honoured for older clients
+
+    # likes are read straight off the denormalised posts.likes counter (kept up to date by
+    # the vote router) instead of joining votes and counting on every read
+    if selected_fields is None:
+        post_with_likes_query = (
+            select(models.Post, col(models.Post.likes).label("likes"))
+            # each post embeds its owner. left to lazy loading that is one more SELECT
+            # per post while the page is serialised (and an AsyncSession cannot lazy
+            # load at all). the owner is a many-to-one, so it is joined into the page
+            # query itself -> one query per page, however many posts and owners it holds
+            .options(
+                joinedload(models.Post.owner),
+                # never part of the response, not worth reading off the table
+                defer(models.Post.search_vector),
+                defer(models.Post.excerpt),
+            ).limit(limit)
+        )
+    else:
+        # SPARSE FIELDSETS
+        # ?fields=id,title,excerpt -> only those columns are selected, list views get
+        # by on the short excerpt without the full content ever leaving the table
+        post_with_likes_query = utils.sparse_posts_query(selected_fields).limit(limit)
+
+    # SEARCHING
+    # col(models.Post.title).contains(search) compiles to LIKE '%term%', which a plain
+    # b-tree index can never help with -> sequential scan of the whole table.
+    # full-text search goes through the GIN index on the generated search_vector column,
+    # substring search (opt-in) through the trigram GIN index on the title
+    if ranked:
+        # websearch_to_tsquery understands "quoted phrases", OR and -exclusions,
+        # and never raises a syntax error on arbitrary user input
+        # the text search configuration has to reach Postgres as a regconfig, not a string
+        query = func.websearch_to_tsquery(
+            literal_column("'english'::regconfig"), search
+        )
+        rank = func.ts_rank(models.Post.search_vector, query)
+        post_with_likes_query = (
+            post_with_likes_query.where(models.Post.search_vector.op("@@")(query))
+            # most relevant first, id breaks ties so the ordering is stable
+            .order_by(rank.desc(), models.Post.id)
+        )
+    else:
         # to allow for searching by KEYWORD in the TITLE e.g. all posts about formula 1
-        .where(col(models.Post.title).contains(search))
-        .join(models.Vote, isouter=True)
-        .group_by(models.Post.id)
-    ).all()
+        if search:
+            post_with_likes_query = post_with_likes_query.where(
+                col(models.Post.title).contains(search)
+            )
+        # a stable ordering is required, otherwise pages can overlap or skip posts
+        post_with_likes_query = post_with_likes_query.order_by(models.Post.id)
+
+    if last_post_id is not None:
+        post_with_likes_query = post_with_likes_query.where(
+            models.Post.id > last_post_id
+        )
+    else:
+        post_with_likes_query = post_with_likes_query.offset(skip)
+
+    post_with_likes = (await session.exec(post_with_likes_query)).all()
+
+    # a full page means there may be more posts -> hand the client an opaque cursor
+    # pointing at the last post in this page, sent back as ?cursor= for the next page
+    next_cursor = None
+    if not ranked and post_with_likes and len(post_with_likes) == limit:
+        last_post = post_with_likes[-1]
+        next_cursor = utils.encode_cursor(
+            last_post.Post.id if selected_fields is None else last_post.id
+        )
+
+    if not use_cache and selected_fields is None:
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return post_with_likes
+
+    # the page is cached serialised, as the exact bytes FastAPI would have sent, so a
+    # hit skips the validation and JSON encoding as well as the query
+    if selected_fields is None:
+        page = JSONResponse(
+            jsonable_encoder(parse_obj_as(List[models.PostOut], post_with_likes))
+        ).body
+    else:
+        # partial posts, no response model to validate them against
+        page = utils.encode_sparse_posts(post_with_likes, selected_fields)
+    cached_page = (next_cursor or "").encode() + b"\n" + page
+    if not use_cache:
+        return page_response(cached_page)
+    # a lagging replica's page would be kept under the generation of writes it has
+    # not seen yet, and served as if it had
+    if not replicas.read_behind_primary(request):
+        await posts_cache.store(cache_key, cached_page)
+
+    return page_response(cached_page, "MISS")
+
+
+def page_response(cached_page: bytes, cache_status: str = None):
+    """Builds the response of GET /posts/ out of a cached page: the next page's
+    cursor, a newline, then the JSON body"""
+    next_cursor, page = cached_page.split(b"\n", 1)
+    headers = {"X-Cache": cache_status} if cache_status else {}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor.decode()
+    return Response(content=page, media_type="application/json", headers=headers)
+
+
+@router.get("/trending", response_model=List[models.TrendingPostOut])
+async def get_trending_posts(
+    session: AsyncSession = Depends(start_read_session),
+    current_user: models.User = Depends(oauth2.get_current_user),
+    limit: int = Query(default=10, ge=1, le=100),
+):
+    """Posts with the most recent likes, highest trending score first"""
+    # the scores are precomputed (see trending.py), so this is the top of the
+    # (score, post_id) index read backwards plus a primary key lookup per post
+    # -> the same cost whether there are a thousand votes or a billion
+    trending_query = (
+        select(
+            models.Post,
+            col(models.Post.likes).label("likes"),
+            col(models.PostScore.score).label("score"),
+        )
+        .join(models.PostScore, models.PostScore.post_id == models.Post.id)
+        .options(joinedload(models.Post.owner))
+        .order_by(models.PostScore.score.desc(), models.PostScore.post_id.desc())
+        .limit(limit)
+    )
 
-    return post_with_likes
+    return (await session.exec(trending_query)).all()
 
 
 # @app.post("/createposts")
@@ -89,15 +289,20 @@ def get_posts(
 
 # above, refactored with pydantic
 # NOTE: the status code in the decorator
-@router.post("/", response_model=models.PostRead, status_code=status.HTTP_201_CREATED)
+@router.post(
+    "/",
+    response_model=models.PostRead,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(rate_limiter.limit("create_post"))],
+)
 # login enforcement: users have to be logged in so they can create a post
 # therefore, to enforce this, use the JWT token that was created -> check if it is in the request header
 # and that it is valid
 # this is achieved by setting a DEPENDENCY -> get current user fn from oauth2
 # for testing, remember to add "Bearer <token>" to the header (note the space)
-def create_post(
+async def create_post(
     post: models.PostCreate,
-    session: Session = Depends(start_session),
+    session: AsyncSession = Depends(start_session),
     current_user: models.User = Depends(oauth2.get_current_user),
 ):
     """Creates a post"""
@@ -137,18 +342,85 @@ def create_post(
     # passing in the updates that were not sent in the request payload
     new_post = models.Post.from_orm(post, update={"owner_id": current_user.id})
     session.add(new_post)
-    session.commit()
-    session.refresh(new_post)
+    # the post needs its id before it can be copied into the feeds of the owner's
+    # followers, in the same transaction
+    await session.flush()
+    await timeline.fan_out_post(session, new_post.id, current_user.id)
+    await session.commit()
+    # the new post belongs on pages of GET /posts/ that are already cached
+    await posts_cache.invalidate()
+    # re-read the post (server-side defaults included) together with its owner, in one
+    # query. current_user may come from the auth cache, so the owner is not necessarily
+    # loaded in this session already
+    new_post = (
+        await session.exec(
+            select(models.Post)
+            .where(models.Post.id == new_post.id)
+            .options(joinedload(models.Post.owner))
+            .execution_options(populate_existing=True)
+        )
+    ).one()
     new_post.updated_at = new_post.updated_at.strftime("%Y/%m/%d, %H:%M:%S")
 
     return new_post
 
 
+# NOTE: declared before "/{post_id}", otherwise "export" would be taken for a post id
+@router.get("/export")
+async def export_posts(
+    format: models.ExportFormat = models.ExportFormat.ndjson,
+    session: AsyncSession = Depends(start_read_session),
+    current_user: models.User = Depends(oauth2.get_current_user),
+):
+    """Streams every post, as NDJSON or CSV"""
+    # plain columns, no ORM objects -> nothing piles up in the session while streaming.
+    # the database hands rows over in batches through a server-side cursor, and each batch
+    # is encoded and sent before the next one is fetched -> memory use stays the same
+    # whether the export holds 10 thousand or 10 million posts
+    rows = await session.stream(
+        select(*EXPORT_COLUMNS)
+        .order_by(models.Post.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+    async def ndjson_lines():
+        async for batch in rows.partitions(EXPORT_BATCH_SIZE):
+            # orjson encodes datetimes (and everything else here) natively
+            yield b"".join(orjson.dumps(dict(row._mapping)) + b"\n" for row in batch)
+
+    async def csv_lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(column.key for column in EXPORT_COLUMNS)
+        async for batch in rows.partitions(EXPORT_BATCH_SIZE):
+            writer.writerows(batch)
+            yield buffer.getvalue()
+            # reuse the buffer for the next batch
+            buffer.seek(0)
+            buffer.truncate()
+        # only the header was written, the table is empty
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    if format == models.ExportFormat.csv:
+        content, media_type = csv_lines(), "text/csv"
+    else:
+        content, media_type = ndjson_lines(), "application/x-ndjson"
+
+    return StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="posts.{format.value}"'},
+    )
+
+
 # to retrieve a single post
 @router.get("/{post_id}", response_model=models.PostOut)
-def get_post(
+async def get_post(
     post_id: int,
-    session: Session = Depends(start_session),
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None),
+    session: AsyncSession = Depends(start_read_session),
     current_user: models.User = Depends(oauth2.get_current_user),
 ):
     # USING RAW SQL AND PSYCONG2 DIRECTLY
@@ -183,11 +455,40 @@ def get_post(
     # queried_post = session.get(models.Post, post_id)
 
     try:
-        queried_post = session.exec(
-            select(models.Post, func.count(models.Vote.post_id).label("likes"))
-            .where(models.Post.id == post_id)
-            .join(models.Vote, isouter=True)
-            .group_by(models.Post.id)
+        if not utils.in_id_range(post_id):
+            raise NoResultFound
+
+        # CONDITIONAL REQUESTS
+        # a polling client sends back the ETag of the copy it already has. only the few
+        # columns the ETag is built from are read, and if nothing changed the client gets
+        # an empty 304 -> the post is neither fully fetched nor serialised
+        if if_none_match:
+            validators = (
+                await session.exec(
+                    select(
+                        models.Post.updated_at,
+                        models.Post.likes,
+                        models.User.id,
+                        models.User.name,
+                        models.User.email,
+                    )
+                    .join(models.User, models.User.id == models.Post.owner_id)
+                    .where(models.Post.id == post_id)
+                )
+            ).one()
+            etag = utils.make_etag(*validators)
+            if utils.etag_matches(if_none_match, etag):
+                return utils.not_modified(
+                    etag, validators.updated_at, POST_CACHE_CONTROL
+                )
+
+        # plain primary key fetch, the likes come from the denormalised counter
+        queried_post = (
+            await session.exec(
+                select(models.Post, col(models.Post.likes).label("likes"))
+                .where(models.Post.id == post_id)
+                .options(joinedload(models.Post.owner))
+            )
         ).one()
     except NoResultFound as error:
         # if not queried_post:
@@ -197,15 +498,23 @@ def get_post(
         ) from error
     # queried_post.updated_at = queried_post.updated_at.strftime("%Y/%m/%d, %H:%M:%S")
 
-    print(type(queried_post))
+    # same parts, in the same order, as the conditional request check above
+    post = queried_post.Post
+    etag = utils.make_etag(
+        post.updated_at, post.likes, post.owner.id, post.owner.name, post.owner.email
+    )
+    response.headers.update(
+        utils.cache_headers(etag, post.updated_at, POST_CACHE_CONTROL)
+    )
+
     return queried_post
 
 
 # NOTE: the status code in the decorator
 @router.delete("/{post_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_post(
+async def delete_post(
     post_id: int,
-    session: Session = Depends(start_session),
+    session: AsyncSession = Depends(start_session),
     current_user: models.User = Depends(oauth2.get_current_user),
 ):
     # USING RAW SQL AND PSYCONG2 DIRECTLY
@@ -236,7 +545,9 @@ def delete_post(
 
     # USING SQLMODEL ORM
 
-    deleted_post = session.get(models.Post, post_id)
+    deleted_post = utils.in_id_range(post_id) and await session.get(
+        models.Post, post_id
+    )
     if not deleted_post:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -247,18 +558,20 @@ def delete_post(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not your circus, not your monkey.",
         )
-    session.delete(deleted_post)
-    session.commit()
+    await session.delete(deleted_post)
+    await session.commit()
+    # cached pages of GET /posts/ may hold the post
+    await posts_cache.invalidate()
 
     # for a 204, you should not return anything in the response body - just how FastAPI works
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 @router.patch("/{post_id}", response_model=models.PostRead)
-def update_post(
+async def update_post(
     post_id: int,
     post_to_update: models.PostUpdate,
-    session: Session = Depends(start_session),
+    session: AsyncSession = Depends(start_session),
     current_user: models.User = Depends(oauth2.get_current_user),
 ):
     # USING RAW SQL AND PSYCONG2 DIRECTLY
@@ -296,7 +609,9 @@ def update_post(
 
     # USING SQLMODEL ORM
     # using a PATCH request
-    updated_post = session.get(models.Post, post_id)
+    updated_post = utils.in_id_range(post_id) and await session.get(
+        models.Post, post_id
+    )
     if not updated_post:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -322,8 +637,18 @@ def update_post(
 
     # 'returning' the updated database entry
     session.add(updated_post)
-    session.commit()
-    session.refresh(updated_post)
+    await session.commit()
+    # cached pages of GET /posts/ may hold the post
+    await posts_cache.invalidate()
+    # same as in create_post, re-read together with the owner
+    updated_post = (
+        await session.exec(
+            select(models.Post)
+            .where(models.Post.id == post_id)
+            .options(joinedload(models.Post.owner))
+            .execution_options(populate_existing=True)
+        )
+    ).one()
     updated_post.updated_at = updated_post.updated_at.now().strftime(
         "%Y/%m/%d, %H:%M:%S"
     )
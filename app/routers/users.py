@@ -1,39 +1,132 @@
-from sqlmodel import Session
+from typing import Optional
+
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import selectinload
+from sqlmodel import func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 # to 'access the app object' from main, FastAPI uses routers
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
 
-from .. import models, utils
+from .. import models, oauth2, utils
 from ..database import start_session
+from ..ratelimit import rate_limiter
+from ..replicas import start_read_session
 
 # app is not imported from main, use APIRouter
 # refactoring, to avoid repeated "/users"
 router = APIRouter(prefix="/users", tags=["Users"])
 
+# user profiles are public, but clients have to revalidate (If-None-Match) before
+# reusing their copy
+USER_CACHE_CONTROL = "no-cache"
+
 # REMEMBER: FastAPI will execute the first matched path operation (i.e. request + endpoint)
 
 # API endpoint to create a new user
-@router.post("/", status_code=status.HTTP_201_CREATED, response_model=models.UserRead)
-def create_user(user: models.UserCreate, session: Session = Depends(start_session)):
+@router.post(
+    "/",
+    status_code=status.HTTP_201_CREATED,
+    response_model=models.UserRead,
+    dependencies=[Depends(rate_limiter.limit("create_user"))],
+)
+async def create_user(
+    user: models.UserCreate, session: AsyncSession = Depends(start_session)
+):
     # create password hash for password encryption
-    hashed_password = utils.hash(user.password)
+    # bcrypt is deliberately slow CPU work, it runs on its own threads
+    hashed_password = await utils.hash_password(user.password)
 
     # creating the user
     user.password = hashed_password
     new_user = models.User.from_orm(user)
     session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
+    await session.commit()
+    await session.refresh(new_user)
+    # ids can be handed out again (e.g. after a table is reset), never serve a stale user
+    oauth2.forget_user(new_user.id)
     return new_user
 
 
 # API endpoint to retrieve user info based on ID
 @router.get("/{user_id}", response_model=models.UserReadWithPosts)
-def get_user(user_id: int, session: Session = Depends(start_session)):
-    if queried_user := session.get(models.User, user_id):
-        return queried_user
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"User (id: {user_id}) Not Found.",
+async def get_user(
+    user_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None),
+    session: AsyncSession = Depends(start_read_session),
+):
+    not_found = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"User (id: {user_id}) Not Found.",
+    )
+    if not utils.in_id_range(user_id):
+        raise not_found
+
+    # CONDITIONAL REQUESTS
+    # the ETag covers the user and a summary of their posts: any new, edited (updated_at)
+    # or deleted post changes it. only this summary is read for a client that sends
+    # back an ETag, if nothing changed it gets an empty 304
+    if if_none_match:
+        try:
+            validators = (
+                await session.exec(
+                    select(
+                        models.User.id,
+                        models.User.name,
+                        models.User.email,
+                        models.User.joined_in,
+                        func.count(models.Post.id).label("post_count"),
+                        func.max(models.Post.updated_at).label("last_post_update"),
+                        func.coalesce(func.sum(models.Post.id), 0).label("post_id_sum"),
+                    )
+                    .join(
+                        models.Post,
+                        models.Post.owner_id == models.User.id,
+                        isouter=True,
+                    )
+                    .where(models.User.id == user_id)
+                    .group_by(models.User.id)
+                )
+            ).one()
+        except NoResultFound as error:
+            raise not_found from error
+        etag = utils.make_etag(*validators)
+        if utils.etag_matches(if_none_match, etag):
+            last_modified = max(
+                filter(None, (validators.joined_in, validators.last_post_update))
+            )
+            return utils.not_modified(etag, last_modified, USER_CACHE_CONTROL)
+
+    # the posts are loaded up front, an AsyncSession cannot lazy load them later on
+    # while the response is being serialised. selectinload -> one extra query for all of
+    # them (a joined collection would repeat the user's columns on every row). each post
+    # then embeds its owner, which is this very user -> found in the session, no query
+    queried_user = await session.get(
+        models.User, user_id, options=[selectinload(models.User.posts)]
+    )
+    if not queried_user:
+        raise not_found
+
+    # same parts, in the same order, as the conditional request check above
+    last_post_update = max(
+        (post.updated_at for post in queried_user.posts), default=None
+    )
+    etag = utils.make_etag(
+        queried_user.id,
+        queried_user.name,
+        queried_user.email,
+        queried_user.joined_in,
+        len(queried_user.posts),
+        last_post_update,
+        sum(post.id for post in queried_user.posts),
+    )
+    response.headers.update(
+        utils.cache_headers(
+            etag,
+            max(filter(None, (queried_user.joined_in, last_post_update))),
+            USER_CACHE_CONTROL,
         )
+    )
+
+    return queried_user
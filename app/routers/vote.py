@@ -1,54 +1,252 @@
-from sqlalchemy.exc import NoResultFound
-from sqlmodel import Session, select
+from typing import List
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import Integer, column, delete, update, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from .. import models, oauth2
+from fastapi import APIRouter, Body, Depends, HTTPException, status
+
+from .. import models, oauth2, utils
 from ..database import start_session
+from ..ratelimit import rate_limiter
+from ..response_cache import posts_cache
 
 router = APIRouter(prefix="/votes", tags=["Votes"])
 
+# most votes accepted in one POST /votes/batch request
+MAX_BATCH_SIZE = 1000
+
+# Postgres error code (SQLSTATE) for a foreign key violation
+FOREIGN_KEY_VIOLATION = "23503"
+
 
-@router.post("/", status_code=status.HTTP_201_CREATED)
-def add_vote(
+@router.post(
+    "/",
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(rate_limiter.limit("vote"))],
+)
+async def add_vote(
     vote: models.UserVote,
-    session: Session = Depends(start_session),
+    session: AsyncSession = Depends(start_session),
     current_user: models.User = Depends(oauth2.get_current_user),
 ):
-    post = session.get(models.Post, vote.post_id)
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Post (id: {vote.post_id}) Not Found.",
-        )
-
-    vote_query = select(models.Vote).where(
-        models.Vote.post_id == vote.post_id, models.Vote.user_id == current_user.id
+    post_not_found = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"Post (id: {vote.post_id}) Not Found.",
     )
+    if not utils.in_id_range(vote.post_id):
+        raise post_not_found
 
-    try:
-        voted_post = session.exec(vote_query).one()
-        if vote.vote_dir == 1:
+    # ONE STATEMENT PER VOTE
+    # instead of checking the post, then the vote, then writing, the vote is written
+    # straight away and the like counter is bumped off its RETURNING row, all inside one
+    # statement (a data-modifying CTE). no row back -> nothing was written.
+    # concurrent double-taps are settled by the votes primary key, not by a racy check
+    if vote.vote_dir == 1:
+        new_vote = (
+            insert(models.Vote)
+            .values(post_id=vote.post_id, user_id=current_user.id)
+            .on_conflict_do_nothing()
+            .returning(models.Vote.post_id)
+            .cte("new_vote")
+        )
+        try:
+            liked = (
+                await session.execute(
+                    update(models.Post)
+                    .where(models.Post.id == new_vote.c.post_id)
+                    .values(likes=models.Post.likes + 1)
+                    .returning(models.Post.id)
+                    .execution_options(synchronize_session=False)
+                )
+            ).first()
+        except IntegrityError as error:
+            # the vote's foreign key points at a post that does not exist
+            if getattr(error.orig, "pgcode", None) == FOREIGN_KEY_VIOLATION:
+                await session.rollback()
+                raise post_not_found from error
+            raise
+        await session.commit()
+
+        if not liked:
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
                 detail=f"You ({current_user.name}) have already voted on post {vote.post_id}",
             )
+        # cached pages of GET /posts/ hold the old like count
+        await posts_cache.invalidate()
+        return {"message": "post liked successfully."}
 
-        session.delete(voted_post)
-        session.commit()
-        return {"message": "vote deleted."}
+    old_vote = (
+        delete(models.Vote)
+        .where(
+            models.Vote.post_id == vote.post_id,
+            models.Vote.user_id == current_user.id,
+        )
+        .returning(models.Vote.post_id)
+        .cte("old_vote")
+    )
+    unliked = (
+        await session.execute(
+            update(models.Post)
+            .where(models.Post.id == old_vote.c.post_id)
+            .values(likes=models.Post.likes - 1)
+            .returning(models.Post.id)
+            .execution_options(synchronize_session=False)
+        )
+    ).first()
+    await session.commit()
 
-    except NoResultFound as e:
-        if vote.vote_dir == 0:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Vote on post {vote.post_id} not found.",
-            ) from e
+    if not unliked:
+        # only on this (rare) path: tell a missing post apart from a missing vote
+        if not await session.get(models.Post, vote.post_id):
+            raise post_not_found
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Vote on post {vote.post_id} not found.",
+        )
+    await posts_cache.invalidate()
+    return {"message": "vote deleted."}
 
-        new_vote = models.Vote.from_orm(
-            vote, update={"user_id": current_user.id, "post_id": vote.post_id}
+
+# shares the single votes' limit, a batch counting as one request
+@router.post(
+    "/batch",
+    response_model=List[models.VoteOutcome],
+    dependencies=[Depends(rate_limiter.limit("vote"))],
+)
+async def add_votes(
+    votes: List[models.UserVote] = Body(..., max_items=MAX_BATCH_SIZE),
+    session: AsyncSession = Depends(start_session),
+    current_user: models.User = Depends(oauth2.get_current_user),
+):
+    """Applies several votes at once, in a single transaction.
+    Returns one outcome per vote, in the order the votes were sent"""
+    # a post liked and un-liked in the same batch has no well defined outcome
+    post_ids = [vote.post_id for vote in votes]
+    if len(set(post_ids)) != len(post_ids):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="A post can only be voted on once per batch.",
         )
-        session.add(new_vote)
-        session.commit()
-        session.refresh(new_vote)
-        return {"message": "post liked successfully."}
+
+    # the whole batch costs a fixed number of set-based statements, however many votes:
+    # 1. which of the posts exist at all. they are locked until the commit, in id order:
+    # - none of them can be deleted before the votes are written (-> foreign key
+    #   violation), the counters can only be updated by one transaction at a time anyway
+    # - concurrent batches over the same posts queue up one after the other, instead of
+    #   locking them in the UPDATE below, in whatever order its plan visits them, and
+    #   deadlocking
+    # FOR NO KEY UPDATE -> what the UPDATE takes, votes (foreign key checks) and reads
+    # still go through
+    valid_post_ids = [post_id for post_id in post_ids if utils.in_id_range(post_id)]
+    existing_post_ids = set()
+    if valid_post_ids:
+        existing_post_ids = set(
+            (
+                await session.exec(
+                    select(models.Post.id)
+                    .where(col(models.Post.id).in_(valid_post_ids))
+                    .order_by(models.Post.id)
+                    .with_for_update(key_share=True)
+                )
+            ).all()
+        )
+
+    like_ids = [
+        vote.post_id
+        for vote in votes
+        if vote.vote_dir == 1 and vote.post_id in existing_post_ids
+    ]
+    unlike_ids = [
+        vote.post_id
+        for vote in votes
+        if vote.vote_dir == 0 and vote.post_id in existing_post_ids
+    ]
+
+    # 2. INSERT ... ON CONFLICT DO NOTHING, RETURNING tells which likes are new
+    liked = set()
+    if like_ids:
+        liked = set(
+            (
+                await session.execute(
+                    insert(models.Vote)
+                    .values(
+                        [
+                            {"post_id": post_id, "user_id": current_user.id}
+                            for post_id in like_ids
+                        ]
+                    )
+                    .on_conflict_do_nothing()
+                    .returning(models.Vote.post_id)
+                )
+            ).scalars()
+        )
+
+    # 3. DELETE ... RETURNING tells which votes actually existed
+    unliked = set()
+    if unlike_ids:
+        unliked = set(
+            (
+                await session.execute(
+                    delete(models.Vote)
+                    .where(
+                        models.Vote.user_id == current_user.id,
+                        col(models.Vote.post_id).in_(unlike_ids),
+                    )
+                    .returning(models.Vote.post_id)
+                    .execution_options(synchronize_session=False)
+                )
+            ).scalars()
+        )
+
+    # 4. one UPDATE for all the like counters, joined against a VALUES list of changes
+    # (on rows locked in step 1)
+    like_changes = [(post_id, 1) for post_id in liked]
+    like_changes += [(post_id, -1) for post_id in unliked]
+    if like_changes:
+        changes = values(
+            column("post_id", Integer), column("change", Integer), name="changes"
+        ).data(like_changes)
+        await session.execute(
+            update(models.Post)
+            .where(models.Post.id == changes.c.post_id)
+            .values(likes=models.Post.likes + changes.c.change)
+            .execution_options(synchronize_session=False)
+        )
+
+    await session.commit()
+    if like_changes:
+        await posts_cache.invalidate()
+
+    outcomes = []
+    for vote in votes:
+        if vote.post_id not in existing_post_ids:
+            status_code = status.HTTP_404_NOT_FOUND
+            detail = f"Post (id: {vote.post_id}) Not Found."
+        elif vote.post_id in liked:
+            status_code = status.HTTP_201_CREATED
+            detail = "post liked successfully."
+        elif vote.post_id in unliked:
+            status_code = status.HTTP_201_CREATED
+            detail = "vote deleted."
+        elif vote.vote_dir == 1:
+            status_code = status.HTTP_409_CONFLICT
+            detail = (
+                f"You ({current_user.name}) have already voted on post {vote.post_id}"
+            )
+        else:
+            status_code = status.HTTP_404_NOT_FOUND
+            detail = f"Vote on post {vote.post_id} not found."
+        outcomes.append(
+            models.VoteOutcome(
+                post_id=vote.post_id,
+                vote_dir=vote.vote_dir,
+                status_code=status_code,
+                detail=detail,
+            )
+        )
+
+    return outcomes
@@ -0,0 +1,147 @@
+# materialised home timelines (fan-out-on-write), read by GET /feed
+# a new post is copied into the timeline (models.TimelineEntry) of its owner and of each
+# of their followers as it is created, so reading a feed is one primary key range scan
+# instead of a join across the follow graph and posts.
+# accounts with more than fastapi_feed_fanout_max_followers followers would turn every
+# post into that many writes: their posts are not copied, feeds pull them in at read
+# time instead (fan-out-on-read, see routers/feed.py). an account shrinking back under
+# the threshold leaves its posts from the meantime uncopied -> feeds go on pulling
+# those, everything below users.fanned_out_from (see resume_fan_out)
+#
+# NOTE: users.fanned_out_from is never cleared, a later shrink only moves it forward
+# (the posts in between were copied and are pulled as well, the feed lists them once).
+# an account that was too big once stays among the pulled accounts for good: one more
+# index lookup per feed read for those of its followers
+#
+# NOTE: lowering the threshold itself makes no account cross it, the posts of those
+# now under it stop being pulled. raise it freely, lower it along with a backfill
+#
+# timelines are trimmed to the newest fastapi_feed_max_entries posts by each API process
+# on a timer (see main.py), or, with FASTAPI_FEED_TRIM_INTERVAL=0, by cron with:
+# python -m app.timeline
+import asyncio
+
+from sqlalchemy import delete, func, literal, select, true, update
+from sqlalchemy.dialects.postgresql import insert
+
+from . import models
+from .config import config_settings
+from .database import open_session
+
+
+def fans_out(user_id):
+    """SQL condition: the user's posts are copied into their followers' timelines.
+    FOR SHARE -> waits for a follow or unfollow of the user in progress to commit, so
+    a post is either copied or below the boundary set by resume_fan_out"""
+    return (
+        select(models.User.followers)
+        .where(models.User.id == user_id)
+        .with_for_update(read=True)
+        .scalar_subquery()
+        <= config_settings.fastapi_feed_fanout_max_followers
+    )
+
+
+async def fan_out_post(session, post_id: int, owner_id: int):
+    """Copies a new post into the timelines of its owner and, unless they have too many
+    followers, of each of them. Part of the caller's transaction"""
+    followers = select(models.Follow.follower_id, literal(post_id)).where(
+        models.Follow.followee_id == owner_id, fans_out(owner_id)
+    )
+    await session.execute(
+        insert(models.TimelineEntry)
+        .from_select(
+            ["user_id", "post_id"],
+            select(literal(owner_id), literal(post_id)).union_all(followers),
+        )
+        .on_conflict_do_nothing()
+    )
+
+
+async def backfill_timeline(session, follower_id: int, followee_id: int):
+    """Copies the latest posts of a newly followed user into the follower's timeline,
+    so the feed does not only start with their next post"""
+    latest_posts = (
+        select(literal(follower_id), models.Post.id)
+        .where(models.Post.owner_id == followee_id, fans_out(followee_id))
+        .order_by(models.Post.id.desc())
+        .limit(config_settings.fastapi_feed_max_entries)
+    )
+    await session.execute(
+        insert(models.TimelineEntry)
+        .from_select(["user_id", "post_id"], latest_posts)
+        .on_conflict_do_nothing()
+    )
+
+
+async def resume_fan_out(session, user_id: int):
+    """The user just shrank back under the fan-out threshold: their posts from now on
+    are copied, the older ones are pulled at read time. Part of the caller's
+    transaction, which has to hold the lock on the user's row (their follower counter
+    update)"""
+    # every post whose fan-out already went by without copying it committed before the
+    # lock was granted (see fans_out), with an id drawn earlier than this one
+    await session.execute(
+        update(models.User)
+        .where(models.User.id == user_id)
+        .values(
+            fanned_out_from=func.nextval(func.pg_get_serial_sequence("posts", "id"))
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def clear_timeline(session, follower_id: int, followee_id: int):
+    """Takes the posts of an unfollowed user out of the follower's timeline"""
+    await session.execute(
+        delete(models.TimelineEntry)
+        .where(
+            models.TimelineEntry.user_id == follower_id,
+            models.TimelineEntry.post_id.in_(
+                select(models.Post.id).where(models.Post.owner_id == followee_id)
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def trim_timelines(session):
+    """Deletes the entries beyond the newest fastapi_feed_max_entries of each timeline.
+    Returns the number of entries deleted"""
+    # per user, LATERAL -> the newest entry past the limit, found by skipping the
+    # others down the primary key. short timelines have none, and cost that one probe
+    newest_expired = (
+        select(models.TimelineEntry.post_id)
+        .where(models.TimelineEntry.user_id == models.User.id)
+        .order_by(models.TimelineEntry.post_id.desc())
+        .offset(config_settings.fastapi_feed_max_entries)
+        .limit(1)
+        .lateral("newest_expired")
+    )
+    cutoffs = (
+        select(models.User.id.label("user_id"), newest_expired.c.post_id)
+        .join(newest_expired, true())
+        .subquery("cutoffs")
+    )
+
+    # ... and everything from there down goes, again a range of the primary key
+    trimmed = await session.execute(
+        delete(models.TimelineEntry)
+        .where(
+            models.TimelineEntry.user_id == cutoffs.c.user_id,
+            models.TimelineEntry.post_id <= cutoffs.c.post_id,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+
+    return trimmed.rowcount
+
+
+if __name__ == "__main__":
+
+    async def trim_once():
+        async with open_session() as session:
+            return await trim_timelines(session)
+
+    print(f"Trimmed {asyncio.run(trim_once())} timeline entries.")
@@ -0,0 +1,64 @@
+# keeps the trending scores (models.PostScore) of recently liked posts up to date
+# a post's score is the sum of its likes, each weighted 0.5 ** (age / half life): a like
+# cast right now counts 1, one cast a half life ago 0.5, and so on. likes older than the
+# window are left out, so a refresh only reads the latest votes (through the index on
+# votes.created_at) however many votes there are in total
+#
+# every API process refreshes the scores on a timer (see main.py), or, with
+# FASTAPI_TRENDING_REFRESH_INTERVAL=0, cron can run: python -m app.trending
+import asyncio
+from datetime import timedelta
+
+from sqlalchemy import Float, cast, delete, func, insert, select
+
+from . import models
+from .config import config_settings
+from .database import open_session
+
+# key of the Postgres advisory lock letting a single process refresh at a time
+REFRESH_LOCK_KEY = 4_180_001
+
+
+async def refresh_trending_scores(session):
+    """Recomputes the trending scores from the votes cast within the window.
+    Returns the number of posts scored, or None if another process is already at it"""
+    # transaction-level lock, released by the commit (or rollback) below
+    locked = (
+        await session.execute(select(func.pg_try_advisory_xact_lock(REFRESH_LOCK_KEY)))
+    ).scalar()
+    if not locked:
+        await session.rollback()
+        return None
+
+    half_life = config_settings.fastapi_trending_half_life_hours * 3600
+    window = timedelta(hours=config_settings.fastapi_trending_window_hours)
+    age = cast(func.extract("epoch", func.now() - models.Vote.created_at), Float)
+    scores = (
+        select(models.Vote.post_id, func.sum(func.power(0.5, age / half_life)))
+        .where(models.Vote.created_at > func.now() - window)
+        .group_by(models.Vote.post_id)
+    )
+
+    # readers keep seeing the previous scores until the commit swaps in the new ones
+    await session.execute(
+        delete(models.PostScore).execution_options(synchronize_session=False)
+    )
+    scored = await session.execute(
+        insert(models.PostScore).from_select(["post_id", "score"], scores)
+    )
+    await session.commit()
+
+    return scored.rowcount
+
+
+if __name__ == "__main__":
+
+    async def refresh_once():
+        async with open_session() as session:
+            return await refresh_trending_scores(session)
+
+    scored = asyncio.run(refresh_once())
+    if scored is None:
+        print("Another process is refreshing the trending scores.")
+    else:
+        print(f"Scored {scored} trending post(s).")
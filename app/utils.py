@@ -1,8 +1,32 @@
 # utility functions, used to carry out specialised actions within the app
 #
+import asyncio
+import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import orjson
 from passlib.context import CryptContext
+from sqlmodel import col, select
+
+from fastapi import HTTPException, Response, status
+
+from . import models
+from .config import config_settings
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# any stored hash whose cost differs from bcrypt__rounds is flagged by verify_and_update()
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=config_settings.fastapi_bcrypt_rounds,
+)
+
+# ids are stored in 32-bit INTEGER columns. asyncpg refuses to even send a bigger number
+# as a query parameter, so out-of-range ids are weeded out before they reach the database
+ID_MAX = 2**31 - 1
 
 
 def hash(password: str):
@@ -13,3 +37,178 @@ def hash(password: str):
 def verify(input_password: str, hashed_password):
     """Verifies input password by comparing with hash"""
     return pwd_context.verify(input_password, hashed_password)
+
+
+class PasswordHasher:
+    """Runs bcrypt on its own bounded pool of threads.
+    A burst of logins then only queues up behind other logins, instead of starving the
+    threadpool every other endpoint relies on. Once too many jobs are waiting, new ones
+    are turned away with a 503 straight away"""
+
+    def __init__(self, workers: int, queue_depth: int):
+        # bcrypt releases the GIL while hashing, so threads do run in parallel
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt"
+        )
+        self.workers = workers
+        self.queue_depth = queue_depth
+        # running + waiting jobs. only ever touched from the event loop, no lock needed
+        self.pending = 0
+        self.rejected = 0
+
+    async def run(self, function, *args):
+        if self.pending >= self.workers + self.queue_depth:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please try again shortly.",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, function, *args
+            )
+        finally:
+            self.pending -= 1
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "pending": self.pending,
+            "rejected": self.rejected,
+        }
+
+
+password_hasher = PasswordHasher(
+    workers=config_settings.fastapi_bcrypt_workers,
+    queue_depth=config_settings.fastapi_bcrypt_queue_depth,
+)
+
+
+async def hash_password(password: str):
+    """Hashes a password string on the bcrypt threads"""
+    return await password_hasher.run(pwd_context.hash, password)
+
+
+async def verify_password(input_password: str, hashed_password):
+    """Verifies input password on the bcrypt threads.
+    Returns (is valid, new hash), new hash is only set when the stored hash was made with
+    another cost factor and should be replaced"""
+    return await password_hasher.run(
+        pwd_context.verify_and_update, input_password, hashed_password
+    )
+
+
+def in_id_range(_id: int):
+    """Checks if an id can exist at all, i.e. fits in an INTEGER id column"""
+    return -ID_MAX - 1 <= _id <= ID_MAX
+
+
+def encode_cursor(last_id: int):
+    """Encodes the id of the last post on a page into an opaque pagination cursor"""
+    # base64 keeps the cursor opaque, clients should just send it back as they got it
+    return urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Decodes a pagination cursor back into the id of the last post seen"""
+    try:
+        last_id = int(json.loads(urlsafe_b64decode(cursor.encode()))["id"])
+        if not in_id_range(last_id):
+            raise ValueError(last_id)
+        return last_id
+    except (ValueError, KeyError, TypeError) as error:
+        # binascii.Error and json.JSONDecodeError are both ValueErrors
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor."
+        ) from error
+
+
+def parse_post_fields(fields: str):
+    """?fields=excerpt,title -> ("title", "excerpt"), None -> the whole post.
+    Deduplicated and in response order, so every spelling of the same selection builds
+    the same query (and shares cached pages)"""
+    if fields is None:
+        return None
+    requested = {field.strip() for field in fields.split(",")} - {""}
+    if not requested or not requested <= set(models.POST_FIELDS):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid fields, pick from: {', '.join(models.POST_FIELDS)}.",
+        )
+    return tuple(field for field in models.POST_FIELDS if field in requested)
+
+
+def sparse_posts_query(fields: tuple):
+    """SELECT of just the columns behind 'fields': the long ones (content) are never
+    read off the table unless asked for, the owner only joined if asked for.
+    The id (for the cursor) and the like count always come along"""
+    columns = [col(models.Post.id).label("id"), col(models.Post.likes).label("likes")]
+    columns += [
+        getattr(models.Post, field).label(field)
+        for field in fields
+        if field not in ("id", "owner")
+    ]
+    if "owner" not in fields:
+        return select(*columns)
+    columns += [
+        col(models.User.id).label("owner_id"),
+        col(models.User.email).label("owner_email"),
+        col(models.User.name).label("owner_name"),
+    ]
+    return select(*columns).join(models.User, models.User.id == models.Post.owner_id)
+
+
+def encode_sparse_posts(rows, fields: tuple):
+    """JSON of a page of sparse_posts_query rows, shaped like models.PostOut with the
+    post narrowed down to 'fields'"""
+    posts = []
+    for row in rows:
+        post = {}
+        for field in fields:
+            if field == "owner":
+                post["owner"] = {
+                    "email": row.owner_email,
+                    "name": row.owner_name,
+                    "id": row.owner_id,
+                }
+            else:
+                post[field] = row._mapping[field]
+        posts.append({"Post": post, "likes": row.likes})
+    return orjson.dumps(posts)
+
+
+def make_etag(*parts):
+    """Builds a strong ETag out of everything a response's content depends on"""
+    digest = hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str):
+    """Checks an If-None-Match request header against the current ETag"""
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison -> W/"x" matches "x"
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def cache_headers(etag: str, last_modified: datetime, cache_control: str):
+    """HTTP caching headers for a response, or for the 304 that replaces it"""
+    return {
+        "ETag": etag,
+        # the database hands timestamps back in its session TimeZone, HTTP dates are GMT
+        "Last-Modified": format_datetime(
+            last_modified.astimezone(timezone.utc), usegmt=True
+        ),
+        "Cache-Control": cache_control,
+    }
+
+
+def not_modified(etag: str, last_modified: datetime, cache_control: str):
+    """Empty 304 response, tells the client its cached copy is still current"""
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers=cache_headers(etag, last_modified, cache_control),
+    )
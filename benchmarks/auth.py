@@ -0,0 +1,107 @@
+# microbenchmark of the per-request cost of authentication: verifying the bearer token
+# (oauth2.verify_access_token), for each JWT backend and algorithm, against the
+# original code (python-jose handed the key as a string, no cache)
+#
+# no server or database needed, only the FASTAPI_* environment variables
+# usage: python -m benchmarks.auth --iterations 20000
+import argparse
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from fastapi import HTTPException
+from jose import jwt
+
+from app import models, oauth2
+from app.cache import TTLCache
+
+# HS256 secret of the benchmark's own tokens
+SECRET_KEY = "benchmark-secret"
+
+
+def pem_key_pair(private_key):
+    """Returns a private key and its public key, both as PEM strings"""
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return private_pem.decode(), public_pem.decode()
+
+
+def verify_before(token: str, public_key: str, algorithm: str):
+    """verify_access_token as it was: a full jose.jwt.decode on every request"""
+    payload = jwt.decode(token, public_key, algorithm)
+    return models.TokenPayload(id=payload.get("user_id"), name=payload.get("username"))
+
+
+def per_call(function, iterations: int):
+    """Microseconds per call of 'function', best of 3 runs"""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return best / iterations * 1_000_000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request token verification cost")
+    parser.add_argument("--iterations", type=int, default=20_000)
+    args = parser.parse_args()
+
+    # algorithm -> (private key, public key)
+    keys = {
+        "HS256": (SECRET_KEY, SECRET_KEY),
+        "ES256": pem_key_pair(ec.generate_private_key(ec.SECP256R1())),
+        "EdDSA": pem_key_pair(ed25519.Ed25519PrivateKey.generate()),
+    }
+    claims = {"user_id": 1, "username": "Goose", "exp": int(time.time()) + 3600}
+    unauthorised = HTTPException(status_code=401)
+
+    print(f"{'algorithm':<10}{'backend':<8}{'before':>10}{'after':>10}{'cached':>10}")
+    for algorithm, (private_key, public_key) in keys.items():
+        for backend in ("jose", "pyjwt"):
+            if backend == "jose" and algorithm == "EdDSA":
+                continue
+            codec = oauth2.TokenCodec(
+                backend,
+                algorithm,
+                secret_key=SECRET_KEY,
+                private_key=private_key,
+                public_key=public_key,
+            )
+            token = codec.encode(claims)
+            # verify_access_token reads both from the module at call time
+            oauth2.token_codec = codec
+
+            before = (
+                per_call(
+                    lambda: verify_before(token, public_key, algorithm),
+                    args.iterations,
+                )
+                if backend == "jose"
+                else None
+            )
+            # every request a cache miss -> a full signature check
+            oauth2.token_cache = TTLCache(maxsize=0, ttl=0)
+            after = per_call(
+                lambda: oauth2.verify_access_token(token, unauthorised),
+                args.iterations,
+            )
+            # the same token again, as sent by a client for its whole lifetime
+            oauth2.token_cache = TTLCache(maxsize=10, ttl=3600)
+            cached = per_call(
+                lambda: oauth2.verify_access_token(token, unauthorised),
+                args.iterations,
+            )
+
+            before_column = f"{before:8.1f}us" if before is not None else f"{'-':>10}"
+            print(
+                f"{algorithm:<10}{backend:<8}{before_column}"
+                f"{after:8.1f}us{cached:8.1f}us"
+            )
@@ -0,0 +1,269 @@
+# end-to-end load benchmark: seeds a large dataset, then drives the API at a fixed
+# concurrency and records throughput and latency percentiles per endpoint
+#
+# the API must already be running, with the rate limits off (they would turn most of
+# the login and vote requests away), e.g.:
+#   FASTAPI_RATE_LIMIT_BACKEND=off uvicorn app.main:app --workers 4
+# usage:
+#   python -m benchmarks.load --seed                      (first run, builds the dataset)
+#   python -m benchmarks.load --output results/HEAD.json
+#   python -m benchmarks.load --compare results/main.json (regressions against a baseline)
+#
+# WARNING: --seed empties the users, posts and votes tables of the database configured
+# through the FASTAPI_* environment variables, only ever point it at a throwaway database
+import argparse
+import json
+import math
+import random
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+from sqlalchemy import text
+from sqlmodel import Session
+
+from app.database import engine
+from app.seed import DEFAULT_PASSWORD, VOCABULARY, seed
+
+SCENARIOS = [
+    "login",
+    "list",
+    "excerpts",
+    "search",
+    "get",
+    "trending",
+    "feed",
+    "patch",
+    "vote",
+]
+
+
+def dataset_size():
+    """Returns the number of rows the benchmark runs against"""
+    with Session(engine) as session:
+        return {
+            table: session.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+            for table in ("users", "posts", "votes")
+        }
+
+
+def login(http, base_url: str, user_id: int):
+    return http.post(
+        f"{base_url}/login",
+        data={"username": f"user{user_id}@seed.com", "password": DEFAULT_PASSWORD},
+    )
+
+
+def make_scenario(name: str, base_url: str, users: int, posts: int):
+    """Returns a function sending one request of the scenario, and the status codes
+    that count as a success"""
+
+    def send_login(http, rng, user_id, headers):
+        return login(http, base_url, rng.randint(1, users))
+
+    def send_list(http, rng, user_id, headers):
+        return http.get(
+            f"{base_url}/posts/",
+            params={"limit": 10, "skip": rng.randrange(1000)},
+            headers=headers,
+        )
+
+    def send_excerpts(http, rng, user_id, headers):
+        # the same pages as 'list', as a list view would ask for them
+        return http.get(
+            f"{base_url}/posts/",
+            params={
+                "limit": 10,
+                "skip": rng.randrange(1000),
+                "fields": "id,title,excerpt",
+            },
+            headers=headers,
+        )
+
+    def send_search(http, rng, user_id, headers):
+        return http.get(
+            f"{base_url}/posts/",
+            params={"limit": 10, "search": rng.choice(VOCABULARY)},
+            headers=headers,
+        )
+
+    def send_get(http, rng, user_id, headers):
+        return http.get(f"{base_url}/posts/{rng.randint(1, posts)}", headers=headers)
+
+    def send_trending(http, rng, user_id, headers):
+        return http.get(f"{base_url}/posts/trending", headers=headers)
+
+    def send_feed(http, rng, user_id, headers):
+        return http.get(f"{base_url}/feed/", headers=headers)
+
+    def send_patch(http, rng, user_id, headers):
+        # a post owned by the logged in user, see app/seed.py
+        post_id = user_id + users * rng.randrange(max(posts // users, 1))
+        return http.patch(
+            f"{base_url}/posts/{post_id}",
+            json={"content": f"edited {rng.random()}"},
+            headers=headers,
+        )
+
+    def send_vote(http, rng, user_id, headers):
+        # like or un-like, a post the user already liked (or not) answers 409 (or 404)
+        return http.post(
+            f"{base_url}/votes/",
+            json={"post_id": rng.randint(1, posts), "vote_dir": rng.randint(0, 1)},
+            headers=headers,
+        )
+
+    return {
+        "login": (send_login, {200}),
+        "list": (send_list, {200}),
+        "excerpts": (send_excerpts, {200}),
+        "search": (send_search, {200}),
+        "get": (send_get, {200}),
+        "trending": (send_trending, {200}),
+        "feed": (send_feed, {200}),
+        "patch": (send_patch, {200}),
+        "vote": (send_vote, {201, 404, 409}),
+    }[name]
+
+
+def percentile(ordered, percent: float):
+    """Nearest-rank percentile of an already sorted list"""
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def run_scenario(send, expected, total: int, concurrency: int, tokens):
+    """Sends 'total' requests from 'concurrency' clients, each with its own connection
+    and logged in user. Returns the scenario's throughput and latencies"""
+
+    def client(worker: int):
+        http = requests.Session()
+        rng = random.Random(worker)
+        headers = {"Authorization": f"Bearer {tokens[worker]}"}
+        latencies = []
+        errors = 0
+        # the first clients take one request more when total does not split evenly
+        for _ in range(total // concurrency + (worker < total % concurrency)):
+            start = time.perf_counter()
+            try:
+                status_code = send(http, rng, worker + 1, headers).status_code
+            except requests.RequestException:
+                status_code = None
+            latencies.append(time.perf_counter() - start)
+            errors += status_code not in expected
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for outcome in outcomes for latency in outcome[0])
+    return {
+        "requests": len(latencies),
+        "errors": sum(outcome[1] for outcome in outcomes),
+        "seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) * 1000,
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": latencies[-1] * 1000,
+        },
+    }
+
+
+def git_commit():
+    """Returns the commit being benchmarked, if run from a git checkout"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints each scenario's throughput and p95 latency against a baseline run"""
+    print(f"against {baseline.get('commit') or 'baseline'}:")
+    for name, result in results["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        throughput = result["throughput_rps"] / before["throughput_rps"] - 1
+        p95 = result["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1
+        print(f"  {name:<8} throughput {throughput:+7.1%}   p95 {p95:+7.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load benchmark of the API")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--seed", action="store_true", help="(re)build the dataset")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--posts", type=int, default=1_000_000)
+    parser.add_argument("--votes", type=int, default=10_000_000)
+    parser.add_argument("--skew", type=float, default=1.0, help="see app/seed.py")
+    parser.add_argument("--random-seed", type=int, default=0, help="see app/seed.py")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--requests", type=int, default=5000, help="requests per scenario"
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="results file of an earlier run")
+    args = parser.parse_args()
+
+    if args.seed:
+        start = time.perf_counter()
+        seed(
+            args.users,
+            args.posts,
+            args.votes,
+            skew=args.skew,
+            random_seed=args.random_seed,
+        )
+        print(f"seeded in {time.perf_counter() - start:.0f} s")
+
+    dataset = dataset_size()
+    if dataset["users"] < args.concurrency:
+        parser.error("fewer users than clients, run with --seed first")
+
+    # one logged in user per client, logging in is itself a scenario so it is kept out
+    # of the others
+    with requests.Session() as http:
+        tokens = [
+            login(http, args.base_url, user_id).json()["access_token"]
+            for user_id in range(1, args.concurrency + 1)
+        ]
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "base_url": args.base_url,
+        "concurrency": args.concurrency,
+        "dataset": dataset,
+        "scenarios": {},
+    }
+    for name in args.scenarios:
+        send, expected = make_scenario(
+            name, args.base_url, dataset["users"], dataset["posts"]
+        )
+        result = run_scenario(send, expected, args.requests, args.concurrency, tokens)
+        results["scenarios"][name] = result
+        print(
+            f"{name:<8} {result['throughput_rps']:8.1f} req/s   "
+            f"p50 {result['latency_ms']['p50']:7.1f} ms   "
+            f"p95 {result['latency_ms']['p95']:7.1f} ms   "
+            f"p99 {result['latency_ms']['p99']:7.1f} ms   "
+            f"errors {result['errors']}"
+        )
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
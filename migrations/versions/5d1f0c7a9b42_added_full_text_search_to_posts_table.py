@@ -0,0 +1,43 @@
+"""added full-text search column and indexes to posts table
+
+Revision ID: 5d1f0c7a9b42
+Revises: 082c9b50fc63
+Create Date: 2026-10-18 10:52:11.318406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1f0c7a9b42'
+down_revision = '082c9b50fc63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # generated column -> Postgres keeps it in sync with title and content on every write
+    op.add_column('posts', sa.Column(
+        'search_vector',
+        postgresql.TSVECTOR(),
+        sa.Computed(
+            "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(content, '')), 'B')",
+            persisted=True,
+        ),
+        nullable=True,
+    ))
+    op.create_index('ix_posts_search_vector', 'posts', ['search_vector'], unique=False, postgresql_using='gin')
+
+    # trigram index, lets LIKE '%term%' (search_mode=substring) use an index scan
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_posts_title_trgm', 'posts', ['title'], unique=False, postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_title_trgm', table_name='posts')
+    op.drop_index('ix_posts_search_vector', table_name='posts')
+    op.drop_column('posts', 'search_vector')
@@ -0,0 +1,42 @@
+"""added vote timestamps and trending post scores table
+
+Revision ID: a7e4c2d19b63
+Revises: c3a81e5f27d9
+Create Date: 2026-10-18 12:04:37.519204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7e4c2d19b63'
+down_revision = 'c3a81e5f27d9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # when existing votes were cast is unknown: they are dated back to the epoch, out of
+    # every trending window. dated with the migration time, all of them would count as
+    # fresh likes at once and trending would rank by all-time likes until they aged out
+    op.add_column('votes', sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text("'epoch'"), nullable=False))
+    # votes cast from now on get their own time
+    op.alter_column('votes', 'created_at', server_default=sa.text('now()'))
+    op.create_index(op.f('ix_votes_created_at'), 'votes', ['created_at'], unique=False)
+
+    op.create_table('post_scores',
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], onupdate='cascade', ondelete='cascade'),
+    sa.PrimaryKeyConstraint('post_id')
+    )
+    op.create_index('ix_post_scores_score', 'post_scores', ['score', 'post_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_post_scores_score', table_name='post_scores')
+    op.drop_table('post_scores')
+    op.drop_index(op.f('ix_votes_created_at'), table_name='votes')
+    op.drop_column('votes', 'created_at')
@@ -0,0 +1,30 @@
+"""added denormalised likes counter to posts table
+
+Revision ID: c3a81e5f27d9
+Revises: 5d1f0c7a9b42
+Create Date: 2026-10-18 11:20:47.902113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a81e5f27d9'
+down_revision = '5d1f0c7a9b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('posts', sa.Column('likes', sa.Integer(), server_default='0', nullable=False))
+    # backfill the counter from the existing votes
+    op.execute(
+        'UPDATE posts SET likes = '
+        '(SELECT count(*) FROM votes WHERE votes.post_id = posts.id)'
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('posts', 'likes')
@@ -0,0 +1,37 @@
+"""added excerpt column to posts table
+
+Revision ID: c7d2e4f19a36
+Revises: b3d9f1a6c2e8
+Create Date: 2026-10-18 16:21:37.904152
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e4f19a36'
+down_revision = 'b3d9f1a6c2e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # generated column -> Postgres fills it in for the existing posts, and keeps it in
+    # sync with the content on every write. rewrites the posts table once
+    op.add_column('posts', sa.Column(
+        'excerpt',
+        sa.String(),
+        sa.Computed(
+            "CASE WHEN char_length(content) > 200 "
+            "THEN rtrim(left(content, 200)) || '...' "
+            "ELSE content END",
+            persisted=True,
+        ),
+        nullable=True,
+    ))
+
+
+def downgrade() -> None:
+    op.drop_column('posts', 'excerpt')
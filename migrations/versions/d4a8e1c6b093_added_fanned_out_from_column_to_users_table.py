@@ -0,0 +1,29 @@
+"""added fanned_out_from column to users table
+
+Revision ID: d4a8e1c6b093
+Revises: c7d2e4f19a36
+Create Date: 2026-10-18 19:42:15.318407
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8e1c6b093'
+down_revision = 'c7d2e4f19a36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # NULL for every existing account: those that shrank back under the fan-out
+    # threshold before this column existed are not known any more
+    op.add_column('users', sa.Column('fanned_out_from', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_users_fanned_out_from'), 'users', ['fanned_out_from'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_users_fanned_out_from'), table_name='users')
+    op.drop_column('users', 'fanned_out_from')
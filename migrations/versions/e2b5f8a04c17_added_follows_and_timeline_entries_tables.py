@@ -0,0 +1,55 @@
+"""added follows and timeline entries tables, follower counter to users table
+
+Revision ID: e2b5f8a04c17
+Revises: a7e4c2d19b63
+Create Date: 2026-10-18 12:31:09.226750
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b5f8a04c17'
+down_revision = 'a7e4c2d19b63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('followers', sa.Integer(), server_default='0', nullable=False))
+    op.create_index(op.f('ix_users_followers'), 'users', ['followers'], unique=False)
+    op.create_index('ix_posts_owner_id_id', 'posts', ['owner_id', 'id'], unique=False)
+
+    op.create_table('follows',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followee_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['followee_id'], ['users.id'], onupdate='cascade', ondelete='cascade'),
+    sa.ForeignKeyConstraint(['follower_id'], ['users.id'], onupdate='cascade', ondelete='cascade'),
+    sa.PrimaryKeyConstraint('follower_id', 'followee_id')
+    )
+    op.create_index(op.f('ix_follows_followee_id'), 'follows', ['followee_id'], unique=False)
+
+    op.create_table('timeline_entries',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], onupdate='cascade', ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], onupdate='cascade', ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index(op.f('ix_timeline_entries_post_id'), 'timeline_entries', ['post_id'], unique=False)
+
+    # every existing post goes into its owner's own timeline (nobody follows anyone yet)
+    op.execute('INSERT INTO timeline_entries (user_id, post_id) SELECT owner_id, id FROM posts')
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_timeline_entries_post_id'), table_name='timeline_entries')
+    op.drop_table('timeline_entries')
+    op.drop_index(op.f('ix_follows_followee_id'), table_name='follows')
+    op.drop_table('follows')
+    op.drop_index('ix_posts_owner_id_id', table_name='posts')
+    op.drop_index(op.f('ix_users_followers'), table_name='users')
+    op.drop_column('users', 'followers')
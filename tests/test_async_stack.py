@@ -0,0 +1,130 @@
+# the rest of the suite runs the routes on the test's own blocking session (see
+# conftest.py). the tests below run them as deployed instead: AsyncSession on the
+# asyncpg engine, opened per request by start_session / start_read_session
+import csv
+import io
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app import database
+from app.config import config_settings
+from app.database import start_session
+from app.main import app
+from app.replicas import start_read_session
+
+from .conftest import SQLMODEL_DATABASE_URL
+
+# asyncpg connections are separate from the test's session -> the writes are committed
+pytestmark = pytest.mark.committed
+
+
+@pytest.fixture
+def async_client(client, monkeypatch):
+    """
+    TestClient on the real async database stack, against the test database.
+    Its asyncpg statements in async_client.statements
+    """
+    monkeypatch.setattr(config_settings, "fastapi_database_async", True)
+    sync_engine, asyncpg_engine = database.create_engines(
+        SQLMODEL_DATABASE_URL,
+        SQLMODEL_DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1),
+    )
+    monkeypatch.setattr(database, "engine", sync_engine)
+    monkeypatch.setattr(database, "async_engine", asyncpg_engine)
+    monkeypatch.delitem(app.dependency_overrides, start_session)
+    monkeypatch.delitem(app.dependency_overrides, start_read_session)
+
+    statements = []
+
+    @event.listens_for(asyncpg_engine.sync_engine, "before_cursor_execute")
+    def record_statement(conn, cursor, statement, parameters, context, many):
+        statements.append(statement)
+
+    # used as a context manager, the TestClient serves every request on one event
+    # loop, like a server process: pooled asyncpg connections belong to the loop
+    # they were opened on (the startup jobs run on it too)
+    with TestClient(app) as async_client:
+        async_client.statements = statements
+        yield async_client
+        async_client.portal.call(asyncpg_engine.dispose)
+    sync_engine.dispose()
+
+
+def sign_up(client, email="async@stack.com"):
+    """Creates a user and logs them in, returns their Authorization header"""
+    user = {"email": email, "name": "Async", "password": "password123"}
+    assert client.post("/users/", json=user).status_code == 201
+    res = client.post(
+        "/login", data={"username": user["email"], "password": user["password"]}
+    )
+    return {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+
+def test_async_stack_posts(async_client):
+    """
+    Tests the post, vote, user and feed routes on AsyncSession: objects read back
+    after their commit (expire_on_commit=False), eager loads, conditional reads
+    """
+    headers = sign_up(async_client)
+
+    res = async_client.post(
+        "/posts/", json={"title": "title", "content": "content"}, headers=headers
+    )
+    assert res.status_code == 201
+    post = res.json()
+    assert post["owner"]["email"] == "async@stack.com"
+
+    res = async_client.patch(
+        f"/posts/{post['id']}", json={"content": "edited"}, headers=headers
+    )
+    assert res.json()["content"] == "edited"
+    res = async_client.post(
+        "/votes/", json={"post_id": post["id"], "vote_dir": 1}, headers=headers
+    )
+    assert res.status_code == 201
+
+    res = async_client.get("/posts/", headers=headers)
+    assert [(p["Post"]["content"], p["likes"]) for p in res.json()] == [("edited", 1)]
+    res = async_client.get(f"/posts/{post['id']}", headers=headers)
+    assert res.json()["likes"] == 1
+    res = async_client.get(
+        f"/posts/{post['id']}",
+        headers={**headers, "If-None-Match": res.headers["ETag"]},
+    )
+    assert res.status_code == 304
+
+    res = async_client.get(f"/users/{post['owner']['id']}", headers=headers)
+    assert [p["id"] for p in res.json()["posts"]] == [post["id"]]
+    res = async_client.get("/feed/", headers=headers)
+    assert [p["Post"]["id"] for p in res.json()] == [post["id"]]
+
+    assert async_client.post("/logout", headers=headers).status_code == 204
+    assert async_client.get("/posts/", headers=headers).status_code == 401
+    # all of it through asyncpg
+    assert any(
+        statement.startswith("INSERT INTO posts")
+        for statement in async_client.statements
+    )
+
+
+def test_async_stack_export(async_client, monkeypatch):
+    """Tests streaming the posts out of an asyncpg server-side cursor, over several
+    batches"""
+    monkeypatch.setattr("app.routers.posts.EXPORT_BATCH_SIZE", 2)
+    headers = sign_up(async_client)
+    for number in range(5):
+        async_client.post(
+            "/posts/",
+            json={"title": f"title {number}", "content": "content"},
+            headers=headers,
+        )
+
+    res = async_client.get("/posts/export", headers=headers)
+    exported = [json.loads(line) for line in res.text.splitlines()]
+    assert [post["title"] for post in exported] == [f"title {n}" for n in range(5)]
+
+    res = async_client.get("/posts/export", params={"format": "csv"}, headers=headers)
+    assert len(list(csv.DictReader(io.StringIO(res.text)))) == 5
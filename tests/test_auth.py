@@ -0,0 +1,228 @@
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta, timezone
+from itertools import repeat
+
+import anyio
+from sqlmodel import select
+
+from app import models, oauth2
+from app.database import ThreadedSession
+from app.oauth2 import create_access_token, hash_refresh_token, verify_access_token
+from app.revocation import (
+    MIN_CAPACITY,
+    RevocationList,
+    revoked_tokens,
+    sync_revoked_tokens,
+)
+
+
+def login(client, user):
+    res = client.post(
+        "/login", data={"username": user["email"], "password": user["password"]}
+    )
+    assert res.status_code == 200
+    return res.json()
+
+
+def refresh(client, refresh_token):
+    return client.post("/token/refresh", json={"refresh_token": refresh_token})
+
+
+def authorised(client, access_token):
+    """Whether a request with the access token gets through"""
+    res = client.get("/posts/", headers={"Authorization": f"Bearer {access_token}"})
+    assert res.status_code in (200, 401)
+    return res.status_code == 200
+
+
+def test_login_issues_refresh_token(client, test_dummy_user, session):
+    """Tests that logging in hands out a refresh token, stored as a hash only"""
+    tokens = login(client, test_dummy_user)
+
+    stored = session.exec(select(models.RefreshToken)).one()
+    assert stored.token_hash == hash_refresh_token(tokens["refresh_token"])
+    assert stored.user_id == test_dummy_user["id"]
+    assert stored.access_jti == verify_access_token(tokens["access_token"], None).jti
+
+
+def test_refresh_rotation(client, test_dummy_user):
+    """
+    Tests that a refresh token is exchanged for a new pair, once: using it a second
+    time logs out every token of the login
+    """
+    tokens = login(client, test_dummy_user)
+
+    res = refresh(client, tokens["refresh_token"])
+    assert res.status_code == 200
+    new_tokens = res.json()
+    assert new_tokens["refresh_token"] != tokens["refresh_token"]
+    assert authorised(client, new_tokens["access_token"])
+
+    # replayed, e.g. by whoever stole it
+    res = refresh(client, tokens["refresh_token"])
+    assert res.status_code == 401
+
+    assert not authorised(client, new_tokens["access_token"])
+    assert refresh(client, new_tokens["refresh_token"]).status_code == 401
+
+
+def test_refresh_invalid(client, test_dummy_user, session):
+    """Tests that unknown and expired refresh tokens are refused"""
+    assert refresh(client, "not-a-token").status_code == 401
+
+    tokens = login(client, test_dummy_user)
+    stored = session.exec(select(models.RefreshToken)).one()
+    stored.expires_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+    session.add(stored)
+    session.commit()
+
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+
+
+def test_refresh_user_deleted_meanwhile(client, test_dummy_user, monkeypatch):
+    """Tests that a refresh token whose user is gone by the time it is claimed is
+    refused rather than failing"""
+    tokens = login(client, test_dummy_user)
+    get = ThreadedSession.get
+
+    async def get_deleted_user(self, entity, *args, **kwargs):
+        if entity is models.User:
+            return None
+        return await get(self, entity, *args, **kwargs)
+
+    monkeypatch.setattr(ThreadedSession, "get", get_deleted_user)
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+
+
+def test_logout(client, test_dummy_user):
+    """Tests that logging out revokes the access token and its refresh token"""
+    tokens = login(client, test_dummy_user)
+    other_tokens = login(client, test_dummy_user)
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+    res = client.post("/logout", headers=headers)
+    assert res.status_code == 204
+
+    assert not authorised(client, tokens["access_token"])
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+    # another login of the same user is left alone
+    assert authorised(client, other_tokens["access_token"])
+
+
+def test_logout_token_revoked_meanwhile(client, test_dummy_user, monkeypatch):
+    """Tests that a logout whose token is revoked once it was verified (e.g. by a
+    double-submitted logout) still goes through"""
+    tokens = login(client, test_dummy_user)
+    verify_access_token = oauth2.verify_access_token
+
+    def verify_then_revoke(token, credentials_exception):
+        token_data = verify_access_token(token, credentials_exception)
+        revoked_tokens.add(token_data.jti)
+        return token_data
+
+    monkeypatch.setattr(oauth2, "verify_access_token", verify_then_revoke)
+    res = client.post(
+        "/logout", headers={"Authorization": f"Bearer {tokens['access_token']}"}
+    )
+    assert res.status_code == 204
+    assert refresh(client, tokens["refresh_token"]).status_code == 401
+
+
+def test_logout_token_without_jti(client, test_dummy_user, session):
+    """Tests that a token issued before revocation existed, without a jti, is refused
+    rather than logged out with"""
+    token = oauth2.token_codec.encode(
+        {
+            "user_id": test_dummy_user["id"],
+            "exp": datetime.now(timezone.utc) + timedelta(minutes=5),
+        }
+    )
+    res = client.post("/logout", headers={"Authorization": f"Bearer {token}"})
+    assert res.status_code == 401
+    assert not session.exec(select(models.RevokedToken)).all()
+
+
+def test_sync_revoked_tokens(authenticated_client, test_dummy_user, session):
+    """
+    Tests that tokens revoked by another process are refused once the table is
+    reloaded, and that expired revocations are pruned
+    """
+    jti = uuid.uuid4().hex
+    token = create_access_token(
+        {"user_id": test_dummy_user["id"], "username": test_dummy_user["name"]},
+        jti=jti,
+    )
+    assert authorised(authenticated_client, token)
+
+    now = datetime.now(timezone.utc)
+    session.add(models.RevokedToken(jti=jti, expires_at=now + timedelta(minutes=5)))
+    session.add(models.RevokedToken(jti="expired", expires_at=now - timedelta(days=1)))
+    session.commit()
+
+    assert anyio.run(sync_revoked_tokens, ThreadedSession(session)) == 1
+    assert jti in revoked_tokens
+    assert not authorised(authenticated_client, token)
+    assert session.get(models.RevokedToken, "expired") is None
+
+
+def test_revocation_list():
+    """Tests the Bloom filter and exact set through growth and reloads"""
+    revocations = RevocationList(ttl=60)
+    revoked = [uuid.uuid4().hex for _ in range(3000)]
+    # past the filter's initial capacity -> rebuilt on the way
+    for jti in revoked:
+        revocations.add(jti)
+    assert all(jti in revocations for jti in revoked)
+
+    others = [uuid.uuid4().hex for _ in range(10000)]
+    assert not any(jti in revocations for jti in others)
+
+    # a reload from the table keeps what this process revoked since, until a reload
+    # includes it
+    revocations.replace(revoked[:10])
+    assert len(revocations) == 3000
+    # the first ten were pruned from the table since
+    revocations.replace([])
+    assert len(revocations) == 2990
+    assert revoked[0] not in revocations and revoked[10] in revocations
+
+
+def test_revocation_list_expiry():
+    """Tests that the revocations of this process are forgotten once their tokens
+    expired, even with the table never reloaded (FASTAPI_JWT_REVOCATION_SYNC_INTERVAL=0)"""
+    # every revocation expires as soon as it is made
+    revocations = RevocationList(ttl=0)
+    revoked = [uuid.uuid4().hex for _ in range(3 * MIN_CAPACITY)]
+    for jti in revoked:
+        revocations.add(jti)
+    # dropped whenever the filter outgrows its capacity, the latest one is kept
+    assert len(revocations) <= MIN_CAPACITY
+    assert revoked[0] not in revocations and revoked[-1] in revocations
+
+    # and by a reload
+    revocations.replace([])
+    assert len(revocations) == 0
+
+
+def test_revocation_check_allocations():
+    """Tests that checking a token leaves nothing allocated behind"""
+    revocations = RevocationList(ttl=60)
+    for _ in range(100):
+        revocations.add(uuid.uuid4().hex)
+    jti = uuid.uuid4().hex
+    jti in revocations
+    # no loop counter, it would be an integer left allocated
+    checks = repeat(None, 10000)
+
+    tracemalloc.start()
+    try:
+        for _ in checks:
+            jti in revocations
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert current == 0
+    # at most a few transient integers at any one time
+    assert peak < 1024
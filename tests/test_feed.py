@@ -0,0 +1,303 @@
+import anyio
+from sqlmodel import select
+
+from app import models
+from app.config import config_settings
+from app.database import ThreadedSession
+from app.oauth2 import create_access_token
+from app.reconcile import reconcile_followers
+from app.timeline import trim_timelines
+
+
+def auth_header(user):
+    """Authorization header of a test user, to act as someone other than the client"""
+    token = create_access_token(data={"user_id": user["id"], "username": user["name"]})
+    return {"Authorization": f"Bearer {token}"}
+
+
+def feed_ids(client, **params):
+    res = client.get("/feed/", params=params)
+    assert res.status_code == 200
+    return [post["Post"]["id"] for post in res.json()]
+
+
+def test_follow_and_feed(
+    authenticated_client, test_dummy_user, test_another_dummy_user, test_posts, session
+):
+    """
+    Tests that following a user brings their latest posts, and every new one,
+    into the follower's feed
+    """
+    followee_id = test_another_dummy_user["id"]
+    old_post_id = test_posts[3].id
+    res = authenticated_client.post("/follows/", json={"user_id": followee_id})
+    assert res.status_code == 201
+    assert session.get(models.User, followee_id).followers == 1
+
+    # their existing post is backfilled
+    assert feed_ids(authenticated_client) == [old_post_id]
+
+    # new posts, theirs and the user's own, are fanned out as they are created
+    res = authenticated_client.post(
+        "/posts/",
+        json={"title": "new title", "content": "new content"},
+        headers=auth_header(test_another_dummy_user),
+    )
+    followee_post_id = res.json()["id"]
+    res = authenticated_client.post(
+        "/posts/", json={"title": "my title", "content": "my content"}
+    )
+    own_post_id = res.json()["id"]
+
+    assert feed_ids(authenticated_client) == [
+        own_post_id,
+        followee_post_id,
+        old_post_id,
+    ]
+    # the followee's feed only holds their own posts
+    res = authenticated_client.get(
+        "/feed/", headers=auth_header(test_another_dummy_user)
+    )
+    assert [post["Post"]["id"] for post in res.json()] == [followee_post_id]
+
+
+def test_follow_errors(authenticated_client, test_dummy_user, test_another_dummy_user):
+    """Tests following oneself, a missing user, and the same user twice"""
+    res = authenticated_client.post(
+        "/follows/", json={"user_id": test_dummy_user["id"]}
+    )
+    assert res.status_code == 400
+
+    res = authenticated_client.post("/follows/", json={"user_id": 999999})
+    assert res.status_code == 404
+
+    res = authenticated_client.post(
+        "/follows/", json={"user_id": test_another_dummy_user["id"]}
+    )
+    assert res.status_code == 201
+    res = authenticated_client.post(
+        "/follows/", json={"user_id": test_another_dummy_user["id"]}
+    )
+    assert res.status_code == 409
+
+
+def test_unfollow(authenticated_client, test_another_dummy_user, test_posts, session):
+    """Tests that unfollowing a user takes their posts out of the follower's feed"""
+    followee_id = test_another_dummy_user["id"]
+    authenticated_client.post("/follows/", json={"user_id": followee_id})
+
+    res = authenticated_client.delete(f"/follows/{followee_id}")
+    assert res.status_code == 204
+    assert session.get(models.User, followee_id).followers == 0
+    assert feed_ids(authenticated_client) == []
+
+    res = authenticated_client.delete(f"/follows/{followee_id}")
+    assert res.status_code == 404
+
+
+def test_feed_big_account(
+    authenticated_client, test_another_dummy_user, test_posts, session, monkeypatch
+):
+    """
+    Tests that the posts of accounts with too many followers to fan out to are pulled
+    into feeds at read time instead, each post listed once
+    """
+    followee_id = test_another_dummy_user["id"]
+    old_post_id = test_posts[3].id
+    authenticated_client.post("/follows/", json={"user_id": followee_id})
+    # from now on, one follower is one too many
+    monkeypatch.setattr(config_settings, "fastapi_feed_fanout_max_followers", 0)
+
+    res = authenticated_client.post(
+        "/posts/",
+        json={"title": "new title", "content": "new content"},
+        headers=auth_header(test_another_dummy_user),
+    )
+    new_post_id = res.json()["id"]
+
+    # not copied into the follower's timeline...
+    fanned_out = session.exec(
+        select(models.TimelineEntry.post_id).where(
+            models.TimelineEntry.user_id != followee_id
+        )
+    ).all()
+    assert fanned_out == [old_post_id]
+    # ...but in their feed all the same, next to the post backfilled earlier
+    assert feed_ids(authenticated_client) == [new_post_id, old_post_id]
+
+
+def test_feed_account_shrinks_back(
+    authenticated_client, test_dummy_user, test_another_dummy_user, session, monkeypatch
+):
+    """
+    Tests that the posts an account made while it had too many followers to fan out
+    to stay in feeds once it is back under the threshold, next to its new posts
+    """
+    followee = test_another_dummy_user
+    other_follower = models.User(email="other@follower.com", name="Other", password="x")
+    session.add(other_follower)
+    session.commit()
+    other_follower = {"id": other_follower.id, "name": other_follower.name}
+    monkeypatch.setattr(config_settings, "fastapi_feed_fanout_max_followers", 1)
+
+    def new_post():
+        res = authenticated_client.post(
+            "/posts/",
+            json={"title": "title", "content": "content"},
+            headers=auth_header(followee),
+        )
+        return res.json()["id"]
+
+    authenticated_client.post("/follows/", json={"user_id": followee["id"]})
+    authenticated_client.post(
+        "/follows/",
+        json={"user_id": followee["id"]},
+        headers=auth_header(other_follower),
+    )
+    # 2 followers -> too big, pulled at read time
+    pulled_post_id = new_post()
+    assert feed_ids(authenticated_client) == [pulled_post_id]
+
+    # 1 follower -> fanned out again, the post from before is still pulled
+    res = authenticated_client.delete(
+        f"/follows/{followee['id']}", headers=auth_header(other_follower)
+    )
+    assert res.status_code == 204
+    session.expire_all()
+    assert session.get(models.User, followee["id"]).fanned_out_from > pulled_post_id
+    fanned_out_post_id = new_post()
+    assert feed_ids(authenticated_client) == [fanned_out_post_id, pulled_post_id]
+    timeline = session.exec(
+        select(models.TimelineEntry.post_id).where(
+            models.TimelineEntry.user_id == test_dummy_user["id"]
+        )
+    ).all()
+    assert timeline == [fanned_out_post_id]
+
+
+def test_reconcile_followers(
+    authenticated_client, test_dummy_user, test_another_dummy_user, session, monkeypatch
+):
+    """
+    Tests that the reconcile command repairs follower counters that drifted from the
+    follows table, and that an account it brings back under the fan-out threshold
+    keeps the posts it made while too big in feeds
+    """
+    followee = test_another_dummy_user
+    deleted_follower = models.User(
+        email="deleted@follower.com", name="Gone", password="x"
+    )
+    session.add(deleted_follower)
+    session.commit()
+    deleted_follower_id = deleted_follower.id
+    monkeypatch.setattr(config_settings, "fastapi_feed_fanout_max_followers", 1)
+
+    authenticated_client.post("/follows/", json={"user_id": followee["id"]})
+    authenticated_client.post(
+        "/follows/",
+        json={"user_id": followee["id"]},
+        headers=auth_header({"id": deleted_follower_id, "name": "Gone"}),
+    )
+    pulled_post_id = authenticated_client.post(
+        "/posts/",
+        json={"title": "title", "content": "content"},
+        headers=auth_header(followee),
+    ).json()["id"]
+
+    # the follow goes with the user (ON DELETE CASCADE), the counter stays at 2
+    session.delete(session.get(models.User, deleted_follower_id))
+    session.commit()
+    assert reconcile_followers(session) == 1
+    session.expire_all()
+    followee_row = session.get(models.User, followee["id"])
+    assert followee_row.followers == 1
+    assert followee_row.fanned_out_from > pulled_post_id
+    assert feed_ids(authenticated_client) == [pulled_post_id]
+
+    # nothing left to repair
+    assert reconcile_followers(session) == 0
+
+
+def test_feed_cursor_pagination(authenticated_client):
+    """Tests paging through a feed, newest first, with the X-Next-Cursor header"""
+    post_ids = [
+        authenticated_client.post(
+            "/posts/", json={"title": f"title {number}", "content": "content"}
+        ).json()["id"]
+        for number in range(5)
+    ]
+
+    seen_ids = []
+    res = authenticated_client.get("/feed/", params={"limit": 2})
+    while True:
+        seen_ids += [post["Post"]["id"] for post in res.json()]
+        if "X-Next-Cursor" not in res.headers:
+            break
+        res = authenticated_client.get(
+            "/feed/", params={"limit": 2, "cursor": res.headers["X-Next-Cursor"]}
+        )
+
+    assert seen_ids == post_ids[::-1]
+
+
+def test_feed_sparse_fields(authenticated_client):
+    """Tests narrowing the feed's posts down with ?fields=, cursor included"""
+    post_ids = [
+        authenticated_client.post(
+            "/posts/", json={"title": f"title {number}", "content": "content"}
+        ).json()["id"]
+        for number in range(2)
+    ]
+
+    res = authenticated_client.get(
+        "/feed/", params={"limit": 1, "fields": "id,excerpt"}
+    )
+    assert res.json() == [
+        {"Post": {"excerpt": "content", "id": post_ids[1]}, "likes": 0}
+    ]
+    res = authenticated_client.get(
+        "/feed/",
+        params={"fields": "id", "cursor": res.headers["X-Next-Cursor"]},
+    )
+    assert res.json() == [{"Post": {"id": post_ids[0]}, "likes": 0}]
+
+
+def test_trim_timelines(
+    authenticated_client, test_another_dummy_user, session, monkeypatch
+):
+    """Tests that timelines are trimmed down to their newest entries, and that those
+    already short enough are left alone"""
+    post_ids = [
+        authenticated_client.post(
+            "/posts/", json={"title": f"title {number}", "content": "content"}
+        ).json()["id"]
+        for number in range(3)
+    ]
+    short_timeline_headers = auth_header(test_another_dummy_user)
+    short_timeline_post_id = authenticated_client.post(
+        "/posts/",
+        json={"title": "title", "content": "content"},
+        headers=short_timeline_headers,
+    ).json()["id"]
+    monkeypatch.setattr(config_settings, "fastapi_feed_max_entries", 2)
+
+    assert anyio.run(trim_timelines, ThreadedSession(session)) == 1
+    assert feed_ids(authenticated_client) == post_ids[:0:-1]
+    res = authenticated_client.get("/feed/", headers=short_timeline_headers)
+    assert [post["Post"]["id"] for post in res.json()] == [short_timeline_post_id]
+
+
+def test_feed_query_count(authenticated_client, many_owners_posts, max_queries):
+    """
+    Tests that a feed page costs a constant number of queries, however many accounts
+    it draws from
+    """
+    for post in many_owners_posts:
+        authenticated_client.post("/follows/", json={"user_id": post.owner_id})
+
+    # 1 feed query (owners joined in) + at most 1 for the authenticated user
+    with max_queries(2):
+        res = authenticated_client.get("/feed/")
+
+    assert res.status_code == 200
+    assert len({post["Post"]["owner"]["id"] for post in res.json()}) == 10
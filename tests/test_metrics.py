@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from app.config import config_settings
+from app.metrics import RequestMetrics
+
+
+def test_pool_stats(client, internal_headers):
+    """Tests the internal connection pool statistics endpoint"""
+    res = client.get("/internal/pool", headers=internal_headers)
+
+    assert res.status_code == 200
+    for engine_name in ("async", "sync"):
+        assert {"checked_out", "overflow", "wait_seconds_total"} <= set(
+            res.json()[engine_name]
+        )
+
+
+@pytest.mark.parametrize("path", ["/internal/pool", "/internal/replicas", "/metrics"])
+def test_internal_endpoints_guarded(client, monkeypatch, path):
+    """Tests that the operational endpoints are only served with an internal token
+    set, and only to requests bearing it"""
+    assert client.get(path).status_code == 404
+
+    monkeypatch.setattr(config_settings, "fastapi_internal_token", "internal-token")
+    for authorization in (None, "Bearer wrong-token", "internal-token"):
+        headers = {"Authorization": authorization} if authorization else {}
+        res = client.get(path, headers=headers)
+        assert res.status_code == 401
+        assert res.headers["WWW-Authenticate"] == "Bearer"
+    res = client.get(path, headers={"Authorization": "Bearer internal-token"})
+    assert res.status_code == 200
+
+
+def test_metrics(client, test_dummy_user, internal_headers):
+    """Tests if requests are reported at /metrics, labelled by their route template"""
+    user_id = test_dummy_user["id"]
+    client.get(f"/users/{user_id}")
+    client.get("/users/999999")
+
+    res = client.get("/metrics", headers=internal_headers)
+
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain; version=0.0.4")
+    samples = dict(
+        line.rsplit(" ", 1) for line in res.text.splitlines() if line[0] != "#"
+    )
+    # one series per route, not per user id
+    route = 'method="GET",route="/users/{user_id}"'
+    assert int(samples[f'http_requests_total{{{route},status="200"}}']) >= 1
+    assert int(samples[f'http_requests_total{{{route},status="404"}}']) >= 1
+    assert (
+        int(samples[f'http_request_duration_seconds_bucket{{{route},le="+Inf"}}']) >= 2
+    )
+    assert not any(f"/users/{user_id}" in name for name in samples)
+    # the scrape itself is still being served
+    assert int(samples["http_requests_in_flight"]) >= 1
+    assert {'db_pool_checked_out{engine="async"}', "auth_user_cache_hits_total"} <= set(
+        samples
+    )
+
+
+def test_request_metrics_threads():
+    """Tests if requests recorded by several threads all add up in the metrics"""
+    request_metrics = RequestMetrics(buckets=(0.1, 1.0))
+
+    def record():
+        for _ in range(1000):
+            request_metrics.started()
+            request_metrics.finished("GET", "/posts/", 200, 0.5)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    in_flight, requests, latencies = request_metrics.collect()
+    assert in_flight == 0
+    assert requests == {("GET", "/posts/", 200): 4000}
+    # count, sum, then hits per bucket: <= 0.1, <= 1.0, +Inf
+    assert latencies[("GET", "/posts/")] == [4000, 2000.0, 0, 4000, 0]
@@ -0,0 +1,87 @@
+from pathlib import Path
+
+import anyio
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlmodel import Session, create_engine, text
+
+from app.config import config_settings
+from app.database import ThreadedSession
+from app.trending import refresh_trending_scores
+
+from .conftest import SQLMODEL_DATABASE_URL, test_database_name
+
+MIGRATIONS_DIRECTORY = Path(__file__).parents[1] / "migrations"
+
+
+@pytest.fixture
+def migrations_database(monkeypatch):
+    """
+    A fresh, empty database for the migrations to run against.
+    Returns (alembic config, engine)
+    """
+    database_name = f"{test_database_name}_migrations"
+    server_engine = create_engine(
+        SQLMODEL_DATABASE_URL.rsplit("/", 1)[0] + "/postgres",
+        isolation_level="AUTOCOMMIT",
+    )
+    with server_engine.connect() as connection:
+        # the trigram index of the search migration needs the extension (a contrib
+        # module, not part of every Postgres build)
+        if not connection.execute(
+            text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        ).scalar():
+            pytest.skip("the pg_trgm extension is not available")
+        connection.execute(text(f'DROP DATABASE IF EXISTS "{database_name}"'))
+        connection.execute(text(f'CREATE DATABASE "{database_name}"'))
+
+    # migrations/env.py connects to the database the app is configured for. no
+    # alembic.ini -> its logging configuration is left alone
+    monkeypatch.setattr(config_settings, "fastapi_postgresql_db_name", database_name)
+    alembic_config = Config()
+    alembic_config.set_main_option("script_location", str(MIGRATIONS_DIRECTORY))
+    engine = create_engine(
+        SQLMODEL_DATABASE_URL.rsplit("/", 1)[0] + f"/{database_name}"
+    )
+
+    yield alembic_config, engine
+
+    engine.dispose()
+    with server_engine.connect() as connection:
+        connection.execute(text(f'DROP DATABASE "{database_name}"'))
+    server_engine.dispose()
+
+
+def test_vote_timestamps_migration(migrations_database):
+    """
+    Tests that the votes cast before they were timestamped do not count as fresh
+    likes for trending, unlike the ones cast after the migration
+    """
+    alembic_config, engine = migrations_database
+    command.upgrade(alembic_config, "c3a81e5f27d9")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO users (email, name, password) "
+                "VALUES ('old@votes.com', 'Old', 'x'), ('new@votes.com', 'New', 'x')"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO posts (title, content, owner_id) "
+                "VALUES ('old', 'liked long ago', 1), ('new', 'liked lately', 2)"
+            )
+        )
+        connection.execute(text("INSERT INTO votes (post_id, user_id) VALUES (1, 1)"))
+
+    command.upgrade(alembic_config, "a7e4c2d19b63")
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO votes (post_id, user_id) VALUES (2, 1)"))
+
+    with Session(engine) as session:
+        assert anyio.run(refresh_trending_scores, ThreadedSession(session)) == 1
+        assert session.execute(text("SELECT post_id FROM post_scores")).all() == [(2,)]
+
+    # and on to the latest revision
+    command.upgrade(alembic_config, "head")
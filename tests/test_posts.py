@@ -1,6 +1,17 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+
+import anyio
 import pytest
+from sqlmodel import text
 
 from app import models
+from app.config import config_settings
+from app.database import ThreadedSession
+from app.trending import refresh_trending_scores
 
 ### TESTS FOR GETTING POSTS ###
 
@@ -37,11 +48,147 @@ def test_get_one_post(authenticated_client, test_posts):
     dummy_data = models.PostOut(**res.json())
 
     assert res.status_code == 200
-    assert dummy_data.Post.owner.id == 1
+    assert dummy_data.Post.owner.id == test_posts[0].owner_id
     assert dummy_data.Post.id == test_posts[0].id
     assert dummy_data.Post.content == test_posts[0].content
 
 
+def test_get_posts_cursor_pagination(authenticated_client, test_posts):
+    """
+    Tests paging through all posts using the opaque cursor from the X-Next-Cursor header
+    """
+
+    seen_ids = []
+    res = authenticated_client.get("/posts/", params={"limit": 3})
+    while True:
+        assert res.status_code == 200
+        seen_ids += [post["Post"]["id"] for post in res.json()]
+        if "X-Next-Cursor" not in res.headers:
+            break
+        res = authenticated_client.get(
+            "/posts/", params={"limit": 3, "cursor": res.headers["X-Next-Cursor"]}
+        )
+
+    assert seen_ids == sorted(post.id for post in test_posts)
+
+
+def test_reject_invalid_cursor(authenticated_client, test_posts):
+    """
+    Tests if a 400 is thrown if a user sends a cursor that was not issued by the API
+    """
+
+    res = authenticated_client.get("/posts/", params={"cursor": "not-a-cursor"})
+    assert res.status_code == 400
+
+
+def test_get_posts_sparse_fields(authenticated_client, max_queries):
+    """
+    Tests that ?fields= narrows the posts down to the fields asked for, the others
+    (the long content above all) never even read off the table, and that the excerpt
+    follows the content through edits
+    """
+    content = "word " * 500
+    post_id = authenticated_client.post(
+        "/posts/", json={"title": "long", "content": content}
+    ).json()["id"]
+    full = authenticated_client.get("/posts/")
+
+    with max_queries(2) as statements:
+        res = authenticated_client.get("/posts/", params={"fields": "excerpt,title"})
+
+    assert res.status_code == 200
+    excerpt = content[: models.EXCERPT_LENGTH].rstrip() + "..."
+    assert res.json() == [{"Post": {"title": "long", "excerpt": excerpt}, "likes": 0}]
+    assert not any("content" in statement for statement in statements)
+    assert len(res.content) * 10 < len(full.content)
+    # the full posts are left as they were
+    assert "excerpt" not in full.json()[0]["Post"]
+
+    authenticated_client.patch(f"/posts/{post_id}", json={"content": "short"})
+    res = authenticated_client.get("/posts/", params={"fields": "excerpt"})
+    assert res.json()[0]["Post"] == {"excerpt": "short"}
+
+
+def test_get_posts_sparse_fields_pages(authenticated_client, test_posts):
+    """Tests paging through sparse posts with their owners, and that every spelling
+    of the same fields shares the cached pages"""
+    seen_ids = []
+    params = {"limit": 3, "fields": "owner,id"}
+    res = authenticated_client.get("/posts/", params=params)
+    while True:
+        assert res.status_code == 200
+        for post in res.json():
+            assert set(post["Post"]) == {"id", "owner"}
+            assert set(post["Post"]["owner"]) == {"id", "email", "name"}
+            seen_ids.append(post["Post"]["id"])
+        if "X-Next-Cursor" not in res.headers:
+            break
+        res = authenticated_client.get(
+            "/posts/", params={**params, "cursor": res.headers["X-Next-Cursor"]}
+        )
+    assert seen_ids == sorted(post.id for post in test_posts)
+
+    res = authenticated_client.get(
+        "/posts/", params={"limit": 3, "fields": "id, owner,id"}
+    )
+    assert res.headers["X-Cache"] == "HIT"
+
+
+@pytest.mark.parametrize("fields", ["", "password", "title,secret"])
+def test_reject_invalid_fields(authenticated_client, fields):
+    res = authenticated_client.get("/posts/", params={"fields": fields})
+    assert res.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "search, search_mode, expected_titles",
+    [
+        ("first", "fulltext", ["first title"]),
+        (
+            "contents",
+            "fulltext",
+            ["first title", "2nd title", "3rd title", "4th title"],
+        ),
+        ("irst", "fulltext", []),
+        ("irst", "substring", ["first title"]),
+    ],
+)
+def test_search_posts(
+    authenticated_client, test_posts, search, search_mode, expected_titles
+):
+    """
+    Tests full-text (stemmed, over title and content) and substring post searches
+    """
+
+    res = authenticated_client.get(
+        "/posts/", params={"search": search, "search_mode": search_mode}
+    )
+
+    assert res.status_code == 200
+    assert sorted(post["Post"]["title"] for post in res.json()) == sorted(
+        expected_titles
+    )
+
+
+def test_search_posts_ranked_by_relevance(authenticated_client, test_posts, session):
+    """
+    Tests that full-text search results are ordered by relevance, title matches first
+    """
+
+    session.add(
+        models.Post(title="unrelated", content="pizza", owner_id=test_posts[0].owner_id)
+    )
+    session.add(
+        models.Post(title="pizza", content="pizza", owner_id=test_posts[0].owner_id)
+    )
+    session.commit()
+
+    res = authenticated_client.get("/posts/", params={"search": "pizza"})
+
+    assert res.status_code == 200
+    assert [post["Post"]["title"] for post in res.json()] == ["pizza", "unrelated"]
+
+
 def test_unauthenticated_user_reject_all_posts(client, test_posts):
     """
     Tests if an unauthenticated user is denied access to all posts
@@ -203,3 +350,178 @@ def test_unauthenticated_user_reject_update_post(client, test_dummy_user, test_p
     )
 
     assert res.status_code == 401
+
+
+def test_get_one_post_not_modified(authenticated_client, test_posts):
+    """
+    Tests that a client revalidating its copy of a post gets a 304 until the post changes
+    """
+
+    res = authenticated_client.get(f"/posts/{test_posts[0].id}")
+    etag = res.headers["ETag"]
+    assert res.headers["Cache-Control"] == "private, no-cache"
+    assert "Last-Modified" in res.headers
+
+    res = authenticated_client.get(
+        f"/posts/{test_posts[0].id}", headers={"If-None-Match": etag}
+    )
+    assert res.status_code == 304
+    assert res.headers["ETag"] == etag
+    assert not res.content
+
+    # a like changes the post's representation
+    authenticated_client.post(
+        "/votes/", json={"post_id": test_posts[0].id, "vote_dir": 1}
+    )
+    res = authenticated_client.get(
+        f"/posts/{test_posts[0].id}", headers={"If-None-Match": etag}
+    )
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+
+
+def test_last_modified_outside_utc(
+    authenticated_client, test_dummy_user, test_posts, session
+):
+    """Tests that Last-Modified is sent in GMT whatever time zone the database reads
+    timestamps back in"""
+    session.execute(text("SET TIME ZONE 'Africa/Nairobi'"))
+    # the posts and user loaded so far were read in UTC
+    session.expire_all()
+
+    res = authenticated_client.get(f"/posts/{test_posts[0].id}")
+    assert res.status_code == 200
+    assert res.headers["Last-Modified"].endswith(" GMT")
+    updated_at = parsedate_to_datetime(res.headers["Last-Modified"])
+    assert updated_at == test_posts[0].updated_at.replace(microsecond=0)
+
+    res = authenticated_client.get(f"/users/{test_dummy_user['id']}")
+    assert res.status_code == 200
+    res = authenticated_client.get(
+        f"/users/{test_dummy_user['id']}",
+        headers={"If-None-Match": res.headers["ETag"]},
+    )
+    assert res.status_code == 304
+    assert res.headers["Last-Modified"].endswith(" GMT")
+
+
+def test_export_posts_ndjson(authenticated_client, test_posts):
+    """Tests streaming every post out as newline-delimited JSON"""
+    post_ids = sorted(post.id for post in test_posts)
+
+    res = authenticated_client.get("/posts/export")
+
+    assert res.status_code == 200
+    assert res.headers["Content-Type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in res.text.splitlines()]
+    assert [post["id"] for post in exported] == post_ids
+    assert exported[0]["title"] == "first title"
+
+
+def test_export_posts_csv(authenticated_client, test_posts):
+    """Tests streaming every post out as CSV"""
+    post_count = len(test_posts)
+
+    res = authenticated_client.get("/posts/export", params={"format": "csv"})
+
+    assert res.status_code == 200
+    assert res.headers["Content-Type"].startswith("text/csv")
+    exported = list(csv.DictReader(io.StringIO(res.text)))
+    assert len(exported) == post_count
+    assert exported[0]["content"] == "first content"
+
+
+def test_unauthenticated_user_reject_export(client, test_posts):
+    """Tests if an unauthenticated user is denied the posts export"""
+    res = client.get("/posts/export")
+    assert res.status_code == 401
+
+
+def test_get_all_posts_constant_queries(
+    authenticated_client, many_owners_posts, max_queries
+):
+    """
+    Tests that a page of posts, each with a different owner, costs a constant number
+    of queries instead of one more per post (N+1)
+    """
+    # warm up the authenticated user cache, with a request the page cache has no part in
+    assert authenticated_client.get("/feed/").status_code == 200
+
+    # the page query alone, owners joined in and the authenticated user cached
+    with max_queries(1):
+        res = authenticated_client.get("/posts/", params={"limit": 10})
+
+    assert res.status_code == 200
+    assert len({post["Post"]["owner"]["id"] for post in res.json()}) == 10
+
+
+def test_server_timing(authenticated_client, test_posts, monkeypatch):
+    """Tests if the SQL a request ran is reported in its Server-Timing header"""
+    monkeypatch.setattr(config_settings, "fastapi_sql_timing", True)
+
+    res = authenticated_client.get("/posts/")
+
+    assert res.status_code == 200
+    db, db_count = res.headers["Server-Timing"].split(", ")
+    assert db.startswith("db;dur=") and float(db.removeprefix("db;dur=")) > 0
+    assert db_count.startswith("db-count;desc=")
+    assert int(db_count.removeprefix("db-count;desc=")) >= 1
+
+
+def test_server_timing_off(authenticated_client, test_posts):
+    """Tests if no Server-Timing header is sent while SQL timing is switched off"""
+    res = authenticated_client.get("/posts/")
+    assert res.status_code == 200
+    assert "Server-Timing" not in res.headers
+
+
+def test_trending_posts(authenticated_client, test_posts, session):
+    """
+    Tests that trending posts are ranked by their recent likes, older likes counting
+    less and likes outside the trending window not at all
+    """
+    voters = [
+        models.User(email=f"voter{number}@votes.com", name="Voter", password="x")
+        for number in range(5)
+    ]
+    session.add_all(voters)
+    session.commit()
+
+    now = datetime.now(timezone.utc)
+    # post 0: 2 likes now -> about 2, post 1: 3 likes 12 hours (2 half lives) ago ->
+    # about 0.75, post 2: 5 likes 4 days ago -> out of the 72 hour window
+    likes = {
+        0: (2, now),
+        1: (3, now - timedelta(hours=12)),
+        2: (5, now - timedelta(days=4)),
+    }
+    post_ids = [post.id for post in test_posts]
+    for index, (count, created_at) in likes.items():
+        session.add_all(
+            models.Vote(
+                post_id=post_ids[index], user_id=voter.id, created_at=created_at
+            )
+            for voter in voters[:count]
+        )
+    session.commit()
+
+    assert anyio.run(refresh_trending_scores, ThreadedSession(session)) == 2
+
+    res = authenticated_client.get("/posts/trending")
+
+    assert res.status_code == 200
+    trending = [models.TrendingPostOut(**post) for post in res.json()]
+    assert [post.Post.id for post in trending] == post_ids[:2]
+    assert trending[0].score == pytest.approx(2, rel=0.01)
+    assert trending[1].score == pytest.approx(0.75, rel=0.01)
+
+
+def test_trending_posts_limit(authenticated_client, test_posts):
+    """Tests the bounds of the trending posts limit"""
+    res = authenticated_client.get("/posts/trending", params={"limit": 0})
+    assert res.status_code == 422
+
+    res = authenticated_client.get("/posts/trending", params={"limit": 100})
+    assert res.status_code == 200
+    # nothing has been liked yet
+    assert res.json() == []
@@ -0,0 +1,171 @@
+import socketserver
+from types import SimpleNamespace
+
+import anyio
+import pytest
+
+from app import ratelimit, utils
+from app.oauth2 import create_access_token
+from app.ratelimit import MemoryLimiter, RedisLimiter, parse_rule, rate_limiter
+
+
+def login(client, email, password="password123"):
+    return client.post("/login", data={"username": email, "password": password})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Stops the limiter's clocks, moved on by setting clock.now"""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(
+        ratelimit,
+        "time",
+        SimpleNamespace(monotonic=lambda: clock.now, time=lambda: clock.now),
+    )
+    return clock
+
+
+def test_login_rate_limited_per_email(
+    client, test_dummy_user, max_queries, monkeypatch, clock, internal_headers
+):
+    """
+    Tests that repeated logins on one account are turned away with a 429, before the
+    user is looked up or a password hashed, while other accounts can still log in
+    """
+    verifications = []
+    verify_password = utils.verify_password
+
+    async def counted_verify_password(*args):
+        verifications.append(args)
+        return await verify_password(*args)
+
+    monkeypatch.setattr(utils, "verify_password", counted_verify_password)
+
+    email = test_dummy_user["email"]
+    # 5 attempts a minute, right or wrong
+    statuses = [login(client, email, "wrong").status_code for _ in range(4)]
+    assert statuses + [login(client, email).status_code] == [403] * 4 + [200]
+
+    with max_queries(0):
+        # differently spelt, the same account
+        res = login(client, email.upper())
+    assert res.status_code == 429
+    # one attempt refills every 12 seconds
+    assert res.headers["Retry-After"] == "12"
+    assert len(verifications) == 5
+
+    assert login(client, "someone@else.com").status_code == 403
+
+    assert rate_limiter.stats()["rejected"] == {"login": 1}
+    metrics = client.get("/metrics", headers=internal_headers).text
+    assert 'rate_limit_rejected_total{route="login"} 1' in metrics
+
+
+def test_login_rate_limited_per_ip(client, monkeypatch, clock):
+    """Tests that one client trying many accounts is turned away"""
+    monkeypatch.setitem(rate_limiter.rules, "login", [parse_rule("ip:2/60")])
+
+    assert login(client, "first@guess.com").status_code == 403
+    assert login(client, "second@guess.com").status_code == 403
+    res = login(client, "third@guess.com")
+    assert res.status_code == 429
+    assert res.headers["Retry-After"] == "30"
+
+
+def test_user_rate_limit(authenticated_client, test_another_dummy_user, monkeypatch):
+    """
+    Tests that limits keyed by user count each user apart, and leave invalid tokens
+    to the route's authentication
+    """
+    monkeypatch.setitem(rate_limiter.rules, "create_post", [parse_rule("user:2/60")])
+    post = {"title": "title", "content": "content"}
+
+    statuses = [authenticated_client.post("/posts/", json=post).status_code]
+    statuses.append(authenticated_client.post("/posts/", json=post).status_code)
+    statuses.append(authenticated_client.post("/posts/", json=post).status_code)
+    assert statuses == [201, 201, 429]
+
+    other_token = create_access_token(
+        {
+            "user_id": test_another_dummy_user["id"],
+            "username": test_another_dummy_user["name"],
+        }
+    )
+    res = authenticated_client.post(
+        "/posts/", json=post, headers={"Authorization": f"Bearer {other_token}"}
+    )
+    assert res.status_code == 201
+
+    res = authenticated_client.post(
+        "/posts/", json=post, headers={"Authorization": "Bearer not-a-token"}
+    )
+    assert res.status_code == 401
+
+
+def test_parse_rule():
+    assert parse_rule("email:5/60") == ("email", 5, 60)
+    for rule in ("ip:20", "ip:0/60", "ip:1/0", "host:1/60", "ip:a/60"):
+        with pytest.raises(ValueError):
+            parse_rule(rule)
+
+
+def test_memory_limiter(clock):
+    """Tests the token buckets: a burst up to the limit, then the refill rate, and
+    the bound on the keys tracked"""
+    limiter = MemoryLimiter(max_keys=2)
+
+    async def scenario():
+        assert [await limiter.hit("a", 2, 10) for _ in range(3)] == [0, 0, 5]
+        # half a token back
+        clock.now += 2.5
+        assert await limiter.hit("a", 2, 10) == 2.5
+        clock.now += 2.5
+        assert await limiter.hit("a", 2, 10) == 0
+
+        await limiter.hit("b", 2, 10)
+        await limiter.hit("c", 2, 10)
+        # 'a' was the least recently hit, forgotten -> a full bucket again
+        assert limiter.stats()["keys"] == 2
+        assert [await limiter.hit("a", 2, 10) for _ in range(2)] == [0, 0]
+
+    anyio.run(scenario)
+
+
+def test_redis_limiter(redis_stand_in, clock):
+    """Tests the sliding windows against a stand-in server, shared by two processes"""
+    url = f"redis://127.0.0.1:{redis_stand_in.server_address[1]}"
+    limiter, other_process = RedisLimiter(url), RedisLimiter(url)
+
+    async def scenario():
+        # at the start of a 10 second window
+        assert [await limiter.hit("k", 3, 10) for _ in range(3)] == [0, 0, 0]
+        # the 4 requests of this window weigh 2 halfway through the next one
+        assert await other_process.hit("k", 3, 10) == 15
+        clock.now += 15
+        assert await other_process.hit("k", 3, 10) == 0
+        # 2 + 2 -> over, one more only fits once the previous window slid out
+        assert await limiter.hit("k", 3, 10) == 5
+
+    try:
+        anyio.run(scenario)
+    finally:
+        limiter.clear()
+        other_process.clear()
+    # both counters expire, one round trip each time
+    assert redis_stand_in.commands.count(b"PEXPIRE") == 6
+    assert all(expiry for _, expiry in redis_stand_in.store.values())
+
+
+def test_rate_limit_backend_down(client, test_dummy_user, monkeypatch):
+    """Tests that requests are let through when the limiter's server cannot be
+    reached"""
+    with socketserver.TCPServer(("127.0.0.1", 0), socketserver.BaseRequestHandler) as s:
+        # a port nothing listens on any more
+        port = s.server_address[1]
+    monkeypatch.setattr(
+        rate_limiter, "backend", RedisLimiter(f"redis://127.0.0.1:{port}")
+    )
+
+    assert login(client, test_dummy_user["email"]).status_code == 200
+    # the ip and email rules, each tried
+    assert rate_limiter.errors == 2
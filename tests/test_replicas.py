@@ -0,0 +1,178 @@
+import socketserver
+
+import anyio
+import pytest
+from sqlalchemy import event
+
+from app.config import config_settings
+from app.main import app
+from app.oauth2 import create_access_token
+from app.replicas import Replica, replicas, replication_lag, start_read_session
+from app.response_cache import posts_cache
+
+
+@pytest.fixture
+def replica(session, monkeypatch):
+    """The test database again, through engines of its own, as the only replica.
+    Its statements in replica.statements"""
+    # every request gets an event loop of its own from the TestClient, asyncpg
+    # connections cannot be pooled across them -> the blocking stack
+    monkeypatch.setattr(config_settings, "fastapi_database_async", False)
+    replica = Replica(
+        session.get_bind().engine.url.render_as_string(hide_password=False)
+    )
+    replica.statements = []
+
+    @event.listens_for(replica.engines[0], "before_cursor_execute")
+    def record_statement(conn, cursor, statement, parameters, context, many):
+        replica.statements.append(statement)
+
+    monkeypatch.setattr(replicas, "replicas", [replica])
+    # reads reach start_read_session, and the primary through start_session (the
+    # test's session)
+    monkeypatch.delitem(app.dependency_overrides, start_read_session)
+    yield replica
+    replica.engines[0].dispose()
+
+
+@pytest.mark.committed
+def test_reads_from_replica(
+    authenticated_client,
+    test_another_dummy_user,
+    replica,
+    monkeypatch,
+    internal_headers,
+):
+    """
+    Tests that the GET routes read from a healthy replica, except for a user who just
+    wrote something: their reads stay on the primary for a while
+    """
+    # committed -> the replica sees what the primary wrote
+    monkeypatch.setattr(posts_cache, "ttl", 0)
+    other_user = {
+        "Authorization": "Bearer "
+        + create_access_token(
+            {
+                "user_id": test_another_dummy_user["id"],
+                "username": test_another_dummy_user["name"],
+            }
+        )
+    }
+
+    # not checked yet -> the primary
+    assert authenticated_client.get("/posts/").status_code == 200
+    assert replica.statements == []
+
+    assert anyio.run(replicas.check) == 1
+    assert replica.lag == 0
+    replica.statements.clear()
+    assert authenticated_client.get("/posts/").json() == []
+    assert replica.statements
+
+    post_id = authenticated_client.post(
+        "/posts/", json={"title": "title", "content": "content"}
+    ).json()["id"]
+    replica.statements.clear()
+    # its author reads from the primary
+    res = authenticated_client.get(f"/posts/{post_id}")
+    assert res.status_code == 200
+    assert replica.statements == []
+    # everyone else from the replica
+    res = authenticated_client.get(f"/posts/{post_id}", headers=other_user)
+    assert res.status_code == 200
+    assert replica.statements
+
+    stats = authenticated_client.get("/internal/replicas", headers=internal_headers)
+    stats = stats.json()
+    assert [(r["healthy"], r["lag_seconds"]) for r in stats] == [(True, 0)]
+    metrics = authenticated_client.get("/metrics", headers=internal_headers).text
+    assert f'database_replica_healthy{{replica="{replica.name}"}} 1' in metrics
+
+
+def test_replica_health(authenticated_client, replica, monkeypatch):
+    """Tests that replicas which are unreachable or too far behind serve no reads"""
+    with socketserver.TCPServer(("127.0.0.1", 0), socketserver.BaseRequestHandler) as s:
+        # a port nothing listens on any more
+        port = s.server_address[1]
+    unreachable = Replica(f"postgresql://postgres:x@127.0.0.1:{port}/fastapi")
+    monkeypatch.setattr(replicas, "replicas", [replica, unreachable])
+
+    assert anyio.run(replicas.check) == 1
+    assert not unreachable.healthy and unreachable.error
+    assert {replicas.pick() for _ in range(4)} == {replica}
+
+    monkeypatch.setattr(config_settings, "fastapi_database_replica_max_lag", -1)
+    assert anyio.run(replicas.check) == 0
+    assert replicas.pick() is None
+
+    # reads are then served by the primary
+    replica.statements.clear()
+    assert authenticated_client.get("/posts/").status_code == 200
+    assert replica.statements == []
+
+
+def test_cached_pages_read_your_writes(
+    authenticated_client, test_another_dummy_user, replica, monkeypatch
+):
+    """
+    Tests that the author of a post sees it straight after writing it, even once
+    someone else's read went through a lagging replica and the response cache
+    """
+    # the test's writes are never committed -> the replica's own connections do not
+    # see them, like a replica that has not replayed them yet
+    replica.healthy, replica.lag = True, 1
+    other_user = {
+        "Authorization": "Bearer "
+        + create_access_token(
+            {
+                "user_id": test_another_dummy_user["id"],
+                "username": test_another_dummy_user["name"],
+            }
+        )
+    }
+
+    post_id = authenticated_client.post(
+        "/posts/", json={"title": "title", "content": "content"}
+    ).json()["id"]
+
+    res = authenticated_client.get("/posts/", headers=other_user)
+    assert (res.headers["X-Cache"], res.json()) == ("MISS", [])
+    # read behind the primary -> not cached
+    res = authenticated_client.get("/posts/", headers=other_user)
+    assert res.headers["X-Cache"] == "MISS"
+
+    # the author reads from the primary, past the cache
+    res = authenticated_client.get("/posts/")
+    assert "X-Cache" not in res.headers
+    assert [post["Post"]["id"] for post in res.json()] == [post_id]
+
+    # a replica caught up with the primary -> its pages are cached, the author still
+    # reads past them
+    replica.lag = 0
+    authenticated_client.get("/posts/", headers=other_user)
+    assert (
+        authenticated_client.get("/posts/", headers=other_user).headers["X-Cache"]
+        == "HIT"
+    )
+    res = authenticated_client.get("/posts/")
+    assert "X-Cache" not in res.headers
+    assert [post["Post"]["id"] for post in res.json()] == [post_id]
+
+
+@pytest.mark.parametrize(
+    "status, lag",
+    [
+        # the primary itself
+        ((False, False, None, None), 0),
+        # streaming, all replayed: an idle primary, however old the last transaction
+        ((True, True, True, 3600), 0),
+        ((True, True, False, 2.5), 2.5),
+        # cut off from the primary, with all it received replayed
+        ((True, False, True, 3600), 3600),
+        ((True, False, True, None), None),
+    ],
+)
+def test_replication_lag(status, lag):
+    """Tests that a replica no longer streaming is judged by the age of its last
+    replayed transaction, not by having caught up with what it received"""
+    assert replication_lag(*status) == lag
@@ -0,0 +1,162 @@
+import socketserver
+
+import anyio
+import pytest
+
+from app.config import config_settings
+from app.response_cache import MemoryBackend, RedisBackend, posts_cache
+
+
+@pytest.fixture
+def redis_posts_cache(redis_stand_in, monkeypatch):
+    """Switches the GET /posts/ cache over to the Redis backend"""
+    backend = RedisBackend(f"redis://127.0.0.1:{redis_stand_in.server_address[1]}")
+    monkeypatch.setattr(posts_cache, "backend", backend)
+    yield redis_stand_in
+    backend.clear()
+
+
+def test_posts_cache_hit(authenticated_client, test_posts, monkeypatch):
+    """
+    Tests that a repeated page is served from the cache, byte for byte what the
+    database would have answered, whatever the order or spelling of the parameters
+    """
+    res = authenticated_client.get("/posts/", params={"limit": 2})
+    assert res.headers["X-Cache"] == "MISS"
+
+    for params in ({"limit": 2}, {"skip": 0, "limit": 2}, {"limit": 2, "search": ""}):
+        cached = authenticated_client.get("/posts/", params=params)
+        assert cached.headers["X-Cache"] == "HIT"
+        assert cached.content == res.content
+        assert cached.headers["X-Next-Cursor"] == res.headers["X-Next-Cursor"]
+
+    # another page is another entry
+    res = authenticated_client.get("/posts/", params={"limit": 2, "skip": 2})
+    assert res.headers["X-Cache"] == "MISS"
+
+    stats = posts_cache.stats()
+    assert (stats["hits"], stats["misses"]) == (3, 2)
+    assert stats["entries"] == 2 and stats["bytes"] > 0
+
+    monkeypatch.setattr(posts_cache, "ttl", 0)
+    uncached = authenticated_client.get("/posts/", params={"limit": 2})
+    assert "X-Cache" not in uncached.headers
+    assert uncached.json() == cached.json()
+
+
+def test_posts_cache_invalidation(authenticated_client, test_posts):
+    """Tests that creating, liking, editing and deleting a post each invalidate the
+    cached pages"""
+
+    def first_page():
+        res = authenticated_client.get("/posts/", params={"limit": 100})
+        return res.headers["X-Cache"], {post["Post"]["id"]: post for post in res.json()}
+
+    liked_post_id = test_posts[0].id
+    first_page()
+    new_post_id = authenticated_client.post(
+        "/posts/", json={"title": "new title", "content": "new content"}
+    ).json()["id"]
+    cache_status, page = first_page()
+    assert cache_status == "MISS" and new_post_id in page
+
+    authenticated_client.post("/votes/", json={"post_id": liked_post_id, "vote_dir": 1})
+    cache_status, page = first_page()
+    assert cache_status == "MISS" and page[liked_post_id]["likes"] == 1
+
+    authenticated_client.patch(f"/posts/{new_post_id}", json={"content": "edited"})
+    cache_status, page = first_page()
+    assert cache_status == "MISS" and page[new_post_id]["Post"]["content"] == "edited"
+
+    authenticated_client.delete(f"/posts/{new_post_id}")
+    cache_status, page = first_page()
+    assert cache_status == "MISS" and new_post_id not in page
+
+    assert first_page()[0] == "HIT"
+
+
+def test_memory_backend_eviction():
+    """Tests that the memory backend evicts the least recently used pages to stay
+    within its byte budget, and drops expired ones"""
+    backend = MemoryBackend(max_bytes=10)
+
+    async def scenario():
+        await backend.set("a", b"aaaa", ttl=60)
+        await backend.set("b", b"bbbb", ttl=60)
+        # 'a' becomes the most recently used
+        assert await backend.get("a") == b"aaaa"
+        await backend.set("c", b"cccc", ttl=60)
+        assert await backend.get("b") is None
+        assert backend.stats()["bytes"] == 8
+
+        # larger than the whole budget -> not cached at all
+        await backend.set("d", b"d" * 11, ttl=60)
+        assert await backend.get("d") is None
+        assert await backend.get("a") == b"aaaa"
+
+        await backend.set("e", b"e", ttl=0)
+        assert await backend.get("e") is None
+
+    anyio.run(scenario)
+
+
+def test_posts_cache_redis(
+    authenticated_client, test_posts, redis_posts_cache, internal_headers
+):
+    """Tests the cache on the Redis backend, against a stand-in server"""
+    res = authenticated_client.get("/posts/")
+    assert res.headers["X-Cache"] == "MISS"
+    cached = authenticated_client.get("/posts/")
+    assert cached.headers["X-Cache"] == "HIT"
+    assert cached.content == res.content
+    # just the page, the generation counter is only written by the first write
+    assert len(redis_posts_cache.store) == 1
+
+    # the server's size, as it reports it
+    [(page, _)] = redis_posts_cache.store.values()
+    stats = authenticated_client.get("/internal/cache", headers=internal_headers)
+    stats = stats.json()["posts"]
+    assert stats["backend"] == "redis"
+    assert (stats["entries"], stats["bytes"]) == (1, len(page))
+    metrics = authenticated_client.get("/metrics", headers=internal_headers).text
+    assert f"posts_cache_bytes {len(page)}" in metrics
+
+    authenticated_client.post("/posts/", json={"title": "new", "content": "new"})
+    assert redis_posts_cache.store[b"posts:generation"][0] == b"1"
+    res = authenticated_client.get("/posts/")
+    assert res.headers["X-Cache"] == "MISS"
+    assert len(res.json()) == 5
+
+
+def test_posts_cache_backend_down(authenticated_client, test_posts, monkeypatch):
+    """Tests that pages are still served, straight from the database, when the cache
+    server cannot be reached"""
+    with socketserver.TCPServer(("127.0.0.1", 0), socketserver.BaseRequestHandler) as s:
+        # a port nothing listens on any more
+        port = s.server_address[1]
+    monkeypatch.setattr(
+        posts_cache, "backend", RedisBackend(f"redis://127.0.0.1:{port}")
+    )
+    errors = posts_cache.errors
+
+    res = authenticated_client.get("/posts/")
+
+    assert res.status_code == 200
+    assert len(res.json()) == 4
+    # the lookup failed, so nothing was stored either
+    assert posts_cache.errors == errors + 1
+
+
+def test_posts_cache_metrics(authenticated_client, test_posts, internal_headers):
+    """Tests that the cache's hit ratio and memory use are reported"""
+    authenticated_client.get("/posts/")
+    authenticated_client.get("/posts/")
+
+    stats = authenticated_client.get("/internal/cache", headers=internal_headers)
+    stats = stats.json()["posts"]
+    assert stats["backend"] == config_settings.fastapi_posts_cache_backend
+    assert stats["hit_ratio"] == 0.5
+
+    metrics = authenticated_client.get("/metrics", headers=internal_headers).text
+    assert "posts_cache_hits_total 1" in metrics
+    assert "posts_cache_bytes " in metrics
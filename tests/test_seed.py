@@ -0,0 +1,106 @@
+import pytest
+from sqlalchemy import func
+from sqlmodel import create_engine, select
+
+from app import models, seed as seed_cli, utils
+from app.seed import seed
+from .conftest import SQLMODEL_DATABASE_URL, test_engine
+
+# the generator writes (and truncates) through connections of its own
+pytestmark = pytest.mark.committed
+
+
+def dataset(session):
+    """Returns every generated row, in a comparable form"""
+    rows = (
+        session.exec(select(models.User.id, models.User.email)).all(),
+        session.exec(
+            select(models.Post.id, models.Post.title, models.Post.owner_id)
+        ).all(),
+        sorted(session.exec(select(models.Vote.post_id, models.Vote.user_id)).all()),
+    )
+    # ends the read transaction, which would otherwise block the next seed's TRUNCATE
+    session.rollback()
+    return rows
+
+
+def test_seed(session):
+    """Tests if the generator writes consistent users, posts and votes"""
+    written = seed(50, 200, 1000, bind=test_engine, chunk_size=64)
+
+    assert session.exec(select(func.count(models.User.id))).one() == 50
+    assert session.exec(select(func.count(models.Post.id))).one() == 200
+    votes = session.exec(select(models.Vote)).all()
+    assert len(votes) == written["votes"]
+
+    # the likes counters match the votes, as if cast through the API
+    true_likes = dict(
+        session.exec(
+            select(models.Vote.post_id, func.count()).group_by(models.Vote.post_id)
+        ).all()
+    )
+    for post in session.exec(select(models.Post)).all():
+        assert post.likes == true_likes.get(post.id, 0)
+
+    # the shared password works, and new rows get fresh ids
+    user = session.get(models.User, 1)
+    assert utils.verify("password", user.password)
+    new_user = models.User(email="new@user.com", name="New", password="x")
+    session.add(new_user)
+    session.commit()
+    assert new_user.id == 51
+
+
+def test_seed_deterministic(session):
+    """Tests if the same random seed generates the same dataset"""
+    seed(30, 100, 500, random_seed=7, bind=test_engine)
+    first = dataset(session)
+
+    seed(30, 100, 500, random_seed=7, bind=test_engine)
+    assert dataset(session) == first
+
+    seed(30, 100, 500, random_seed=8, bind=test_engine)
+    assert dataset(session) != first
+
+
+def test_seed_skew(session):
+    """Tests if a higher skew concentrates the likes on fewer posts"""
+    seed(100, 500, 2000, skew=0, bind=test_engine)
+    uniform = session.exec(select(func.max(models.Post.likes))).one()
+    session.rollback()
+
+    seed(100, 500, 2000, skew=1.2, bind=test_engine)
+    skewed = session.exec(select(func.max(models.Post.likes))).one()
+
+    assert uniform == 4
+    assert skewed > 10 * uniform
+
+
+def test_seed_cli_target(session, monkeypatch, capsys):
+    """
+    Tests that the command line only seeds the app's own database when told to
+    empty it, and says which tables it empties
+    """
+    arguments = ["--users", "5", "--posts", "10", "--votes", "20"]
+    # the test database stands in for the app's own
+    monkeypatch.setattr(seed_cli, "engine", test_engine)
+
+    with pytest.raises(SystemExit):
+        seed_cli.main(arguments)
+    output = capsys.readouterr()
+    # refused before announcing it would empty anything
+    assert not output.out
+    assert "--truncate" in output.err
+    assert session.exec(select(func.count(models.User.id))).one() == 0
+    session.rollback()
+
+    seed_cli.main(arguments + ["--truncate"])
+    output = capsys.readouterr()
+    assert "follows, post_scores, posts, refresh_tokens, timeline_entries" in output.out
+    assert session.exec(select(func.count(models.User.id))).one() == 5
+    session.rollback()
+
+    # any other database needs no confirmation
+    monkeypatch.setattr(seed_cli, "engine", create_engine("postgresql://app-db/app"))
+    seed_cli.main(arguments + ["--users", "7", "--database-url", SQLMODEL_DATABASE_URL])
+    assert session.exec(select(func.count(models.User.id))).one() == 7
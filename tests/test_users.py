@@ -1,8 +1,21 @@
+import time
+from types import SimpleNamespace
+
 import pytest
-from jose import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from jose import JWTError, jwt
+from sqlmodel import select
 
-from app import models
+from app import cache, models, utils
 from app.config import config_settings
+from app.oauth2 import (
+    TokenCodec,
+    create_access_token,
+    token_cache,
+    token_codec,
+    user_cache,
+)
 
 
 def test_root(client):
@@ -76,3 +89,221 @@ def test_incorrect_login(client, test_dummy_user, email, password, status_code):
 
     assert res.status_code == status_code
     # assert res.json().get("detail") == "Invalid credentials."
+
+
+def test_authenticated_user_cache(authenticated_client, test_dummy_user, session):
+    """
+    Tests that authenticated requests reuse the cached user, and that changing the
+    user drops it from the cache
+    """
+    authenticated_client.get("/posts/")
+    hits = user_cache.stats()["hits"]
+
+    authenticated_client.get("/posts/")
+    assert user_cache.stats()["hits"] == hits + 1
+    assert user_cache.get(test_dummy_user["id"])["name"] == "Goose"
+
+    user = session.get(models.User, test_dummy_user["id"])
+    user.name = "Maverick"
+    session.add(user)
+    session.commit()
+
+    assert user_cache.get(test_dummy_user["id"]) is None
+
+
+def test_verified_token_cache(client, test_dummy_user, monkeypatch):
+    """
+    Tests that a token's signature is only verified on its first use, that expired
+    or forged tokens are never cached, and that none is cached past its expiry
+    """
+    token = create_access_token(
+        {"user_id": test_dummy_user["id"], "username": test_dummy_user["name"]}
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+
+    assert client.get("/posts/", headers=headers).status_code == 200
+    stats = token_cache.stats()
+    assert client.get("/posts/", headers=headers).status_code == 200
+    assert token_cache.stats()["hits"] == stats["hits"] + 1
+
+    # signed with the app's own key: refused for its expiry, not its signature
+    expired = token_codec.encode(
+        {
+            "user_id": test_dummy_user["id"],
+            "jti": "expired",
+            "exp": int(time.time()) - 10,
+        }
+    )
+    forged = token[:-4] + ("AAAA" if not token.endswith("AAAA") else "BBBB")
+    for bad_token in (expired, forged):
+        res = client.get("/posts/", headers={"Authorization": f"Bearer {bad_token}"})
+        assert res.status_code == 401
+    assert token_cache.stats()["size"] == 1
+
+    # a token about to expire is only cached for what is left of its lifetime
+    expiring = token_codec.encode(
+        {
+            "user_id": test_dummy_user["id"],
+            "jti": "expiring",
+            "exp": int(time.time()) + 5,
+        }
+    )
+    headers = {"Authorization": f"Bearer {expiring}"}
+    assert client.get("/posts/", headers=headers).status_code == 200
+    stats = token_cache.stats()
+    assert client.get("/posts/", headers=headers).status_code == 200
+    assert token_cache.stats()["hits"] == stats["hits"] + 1
+
+    later = time.monotonic() + 10
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=lambda: later))
+    stats = token_cache.stats()
+    client.get("/posts/", headers=headers)
+    assert token_cache.stats()["hits"] == stats["hits"]
+    assert token_cache.stats()["misses"] == stats["misses"] + 1
+
+
+def pem_key_pair(private_key):
+    """Returns a private key and its public key, both as PEM strings"""
+    return (
+        private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode(),
+        private_key.public_key()
+        .public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+        .decode(),
+    )
+
+
+def p256_key():
+    return ec.generate_private_key(ec.SECP256R1())
+
+
+@pytest.mark.parametrize(
+    "backend, algorithm, generate_key",
+    [
+        ("jose", "ES256", p256_key),
+        ("pyjwt", "ES256", p256_key),
+        ("pyjwt", "EdDSA", ed25519.Ed25519PrivateKey.generate),
+    ],
+)
+def test_token_codec_key_pairs(backend, algorithm, generate_key):
+    """Tests signing and verifying tokens with asymmetric keys, on both backends"""
+    private_pem, public_pem = pem_key_pair(generate_key())
+    codec = TokenCodec(
+        backend, algorithm, private_key=private_pem, public_key=public_pem
+    )
+
+    token = codec.encode({"user_id": 1, "exp": int(time.time()) + 60})
+    assert codec.decode(token)["user_id"] == 1
+
+    # a service holding only the public key can verify, not sign
+    verifier = TokenCodec(backend, algorithm, public_key=public_pem)
+    assert verifier.decode(token)["user_id"] == 1
+    with pytest.raises(ValueError):
+        verifier.encode({"user_id": 1})
+
+    # signed with someone else's key
+    other_private_pem, other_public_pem = pem_key_pair(generate_key())
+    forger = TokenCodec(
+        backend, algorithm, private_key=other_private_pem, public_key=other_public_pem
+    )
+    with pytest.raises(JWTError):
+        codec.decode(forger.encode({"user_id": 1}))
+
+
+def test_token_codec_jose_eddsa():
+    """Tests that EdDSA is refused on python-jose, which cannot verify it"""
+    with pytest.raises(ValueError):
+        TokenCodec("jose", "EdDSA", public_key="unused")
+
+
+def test_login_rehashes_outdated_password(client, session):
+    """Tests that logging in upgrades a password hashed with another bcrypt cost"""
+    outdated_hash = utils.pwd_context.handler().using(rounds=4).hash("password123")
+    session.add(models.User(email="old@hash.com", name="Goose", password=outdated_hash))
+    session.commit()
+
+    res = client.post(
+        "/login", data={"username": "old@hash.com", "password": "password123"}
+    )
+    assert res.status_code == 200
+
+    session.expire_all()
+    new_hash = session.exec(
+        select(models.User.password).where(models.User.email == "old@hash.com")
+    ).one()
+    assert new_hash != outdated_hash
+    assert utils.pwd_context.verify("password123", new_hash)
+    assert not utils.pwd_context.needs_update(new_hash)
+
+
+def test_reject_login_when_hasher_saturated(client, test_dummy_user, monkeypatch):
+    """Tests that logins are turned away with a 503 once the bcrypt queue is full"""
+    monkeypatch.setattr(
+        utils.password_hasher, "queue_depth", -utils.password_hasher.workers
+    )
+
+    res = client.post(
+        "/login",
+        data={
+            "username": test_dummy_user["email"],
+            "password": test_dummy_user["password"],
+        },
+    )
+
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+
+
+def test_get_user_not_modified(authenticated_client, test_dummy_user):
+    """
+    Tests that a client revalidating its copy of a user gets a 304 until the user's
+    posts change
+    """
+    res = authenticated_client.get(f"/users/{test_dummy_user['id']}")
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+
+    res = authenticated_client.get(
+        f"/users/{test_dummy_user['id']}", headers={"If-None-Match": etag}
+    )
+    assert res.status_code == 304
+
+    authenticated_client.post("/posts/", json={"title": "new", "content": "post"})
+    res = authenticated_client.get(
+        f"/users/{test_dummy_user['id']}", headers={"If-None-Match": etag}
+    )
+    assert res.status_code == 200
+    assert len(res.json()["posts"]) == 1
+
+
+def test_get_nonexistent_user_conditional(client):
+    """Tests that a conditional request for a nonexistent user still gets a 404"""
+    res = client.get("/users/4567", headers={"If-None-Match": '"abc"'})
+    assert res.status_code == 404
+
+
+def test_get_user_constant_queries(client, test_dummy_user, session, max_queries):
+    """
+    Tests that a user with many posts costs a constant number of queries
+    """
+    session.bulk_insert_mappings(
+        models.Post,
+        [
+            {"title": "title", "content": "content", "owner_id": test_dummy_user["id"]}
+            for _ in range(10)
+        ],
+    )
+    session.commit()
+
+    # 1 for the user + 1 for all of their posts
+    with max_queries(2):
+        res = client.get(f"/users/{test_dummy_user['id']}")
+
+    assert res.status_code == 200
+    assert len(res.json()["posts"]) == 10
@@ -1,6 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, text
 
 from app import models
+from app.database import ThreadedSession, start_session
+from app.main import app
+from app.reconcile import reconcile_likes
+
+from .conftest import test_engine
 
 
 @pytest.fixture
@@ -60,6 +70,16 @@ def test_reject_unauthenticated_vote(client, test_dummy_user, test_posts):
     assert res.status_code == 401
 
 
+def test_reject_like_nonexistent_post(authenticated_client, test_dummy_user):
+    """
+    Tests that liking a post that does not exist is a 404, not a foreign key error
+    """
+    res = authenticated_client.post("/votes/", json={"post_id": 234567, "vote_dir": 1})
+
+    assert res.status_code == 404
+    assert res.json()["detail"] == "Post (id: 234567) Not Found."
+
+
 def test_reject_vote_nonexistent_post(authenticated_client, test_dummy_user):
     """
     Tests that a user cannot like a post that does not exist
@@ -67,3 +87,153 @@ def test_reject_vote_nonexistent_post(authenticated_client, test_dummy_user):
     res = authenticated_client.post("/votes/", json={"post_id": 234567, "vote_dir": 0})
 
     assert res.status_code == 404
+
+
+def test_vote_updates_likes_counter(authenticated_client, test_dummy_user, test_posts):
+    """
+    Tests that liking and un-liking a post keeps its denormalised like counter in step
+    """
+    post_id = test_posts[3].id
+
+    authenticated_client.post("/votes/", json={"post_id": post_id, "vote_dir": 1})
+    assert authenticated_client.get(f"/posts/{post_id}").json()["likes"] == 1
+
+    authenticated_client.post("/votes/", json={"post_id": post_id, "vote_dir": 0})
+    assert authenticated_client.get(f"/posts/{post_id}").json()["likes"] == 0
+
+
+def test_reconcile_likes(add_dummy_vote, session, test_posts):
+    """
+    Tests that the reconcile command repairs like counters that drifted from the votes table
+    """
+    # add_dummy_vote writes straight to the votes table, bypassing the vote router
+    assert reconcile_likes(session) == 1
+    assert session.get(models.Post, test_posts[3].id).likes == 1
+
+    # nothing left to repair
+    assert reconcile_likes(session) == 0
+
+
+def test_batch_votes(add_dummy_vote, authenticated_client, test_dummy_user, test_posts):
+    """
+    Tests applying several votes in one request, with one outcome per vote
+    """
+    post_ids = [post.id for post in test_posts]
+    res = authenticated_client.post(
+        "/votes/batch",
+        json=[
+            {"post_id": post_ids[0], "vote_dir": 1},
+            {"post_id": post_ids[1], "vote_dir": 1},
+            {"post_id": post_ids[2], "vote_dir": 0},
+            {"post_id": post_ids[3], "vote_dir": 1},
+            {"post_id": 234567, "vote_dir": 1},
+        ],
+    )
+
+    assert res.status_code == 200
+    assert [outcome["status_code"] for outcome in res.json()] == [
+        201,
+        201,
+        404,
+        409,
+        404,
+    ]
+    assert authenticated_client.get(f"/posts/{post_ids[0]}").json()["likes"] == 1
+
+    # un-liking in a batch
+    res = authenticated_client.post(
+        "/votes/batch", json=[{"post_id": post_ids[0], "vote_dir": 0}]
+    )
+    assert res.json()[0]["status_code"] == 201
+    assert authenticated_client.get(f"/posts/{post_ids[0]}").json()["likes"] == 0
+
+
+def test_reject_batch_duplicate_posts(authenticated_client, test_posts):
+    """
+    Tests that a batch cannot vote on the same post twice
+    """
+    res = authenticated_client.post(
+        "/votes/batch",
+        json=[
+            {"post_id": test_posts[0].id, "vote_dir": 1},
+            {"post_id": test_posts[0].id, "vote_dir": 0},
+        ],
+    )
+
+    assert res.status_code == 422
+
+
+@pytest.fixture
+def concurrent_client(authenticated_client):
+    """
+    Authenticated client whose requests each get their own database session,
+    so they can safely run at the same time
+    """
+
+    def override_start_session():
+        with Session(test_engine) as test_session:
+            yield ThreadedSession(test_session)
+
+    app.dependency_overrides[start_session] = override_start_session
+    return authenticated_client
+
+
+# separate sessions (connections) only see each other's committed writes
+@pytest.mark.committed
+def test_concurrent_votes_same_post(concurrent_client, test_dummy_user, test_posts):
+    """
+    Tests that a burst of identical votes (e.g. double-taps) on the same post by the
+    same user is applied exactly once
+    """
+    post_id = test_posts[3].id
+
+    def vote(vote_dir):
+        return concurrent_client.post(
+            "/votes/", json={"post_id": post_id, "vote_dir": vote_dir}
+        ).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        like_statuses = list(executor.map(vote, [1] * 24))
+    assert sorted(like_statuses) == [201] + [409] * 23
+    assert concurrent_client.get(f"/posts/{post_id}").json()["likes"] == 1
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        unlike_statuses = list(executor.map(vote, [0] * 24))
+    assert sorted(unlike_statuses) == [201] + [404] * 23
+    assert concurrent_client.get(f"/posts/{post_id}").json()["likes"] == 0
+
+
+@pytest.mark.committed
+def test_batch_votes_lock_posts(concurrent_client, test_posts):
+    """
+    Tests that the posts of a batch cannot be deleted while its votes are written
+    """
+    post_ids = [post.id for post in test_posts]
+    deletions = []
+
+    def delete_post(conn, cursor, statement, parameters, context, many):
+        # right before the batch writes its votes, another transaction deletes one
+        # of the posts
+        if statement.startswith("INSERT INTO votes") and not deletions:
+            with test_engine.connect() as other:
+                other.execute(text("SET lock_timeout = '200ms'"))
+                try:
+                    other.execute(
+                        text("DELETE FROM posts WHERE id = :id"), {"id": post_ids[0]}
+                    )
+                    deletions.append(True)
+                except OperationalError:
+                    deletions.append(False)
+
+    event.listen(test_engine, "before_cursor_execute", delete_post)
+    try:
+        res = concurrent_client.post(
+            "/votes/batch",
+            json=[{"post_id": post_id, "vote_dir": 1} for post_id in post_ids],
+        )
+    finally:
+        event.remove(test_engine, "before_cursor_execute", delete_post)
+
+    # the deletion waits for the batch, and gave up
+    assert deletions == [False]
+    assert [outcome["status_code"] for outcome in res.json()] == [201] * 4